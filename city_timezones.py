@@ -3,6 +3,8 @@
 Используется планировщиком для сравнения reminder_time с местным временем города.
 """
 
+from datetime import date, datetime
+from typing import NamedTuple
 from zoneinfo import ZoneInfo
 
 CITY_TIMEZONES: dict[str, str] = {
@@ -36,7 +38,40 @@ CITY_TIMEZONES: dict[str, str] = {
 }
 
 
+DEFAULT_TZ = ZoneInfo("Europe/Moscow")
+
+# Индекс город → пояс, строится один раз: городов 27, различных поясов — 6
+CITY_ZONES: dict[str, ZoneInfo] = {city: ZoneInfo(name) for city, name in CITY_TIMEZONES.items()}
+
+
 def get_city_tz(city: str) -> ZoneInfo:
     """Вернуть ZoneInfo для города. Если не найден — московский пояс."""
-    tz_name = CITY_TIMEZONES.get(city, "Europe/Moscow")
-    return ZoneInfo(tz_name)
+    return CITY_ZONES.get(city, DEFAULT_TZ)
+
+
+class LocalTime(NamedTuple):
+    date: date
+    hhmm: str
+    label: str      # дата как её пишет админ: ДД.ММ.ГГГГ
+
+
+class LocalClock:
+    """
+    Местное время городов на один момент UTC (тик планировщика).
+    Перевод считается один раз на пояс, а не на каждую смену, и все задачи тика
+    видят одну и ту же дату/время — независимо от того, сколько они выполнялись.
+    """
+
+    def __init__(self, now: datetime):
+        self.now = now
+        self._zones: dict[ZoneInfo, LocalTime] = {}
+
+    def __call__(self, city: str) -> LocalTime:
+        tz = get_city_tz(city)
+        local = self._zones.get(tz)
+        if local is None:
+            moment = self.now.astimezone(tz)
+            local = self._zones[tz] = LocalTime(
+                moment.date(), moment.strftime("%H:%M"), moment.strftime("%d.%m.%Y"),
+            )
+        return local
@@ -7,6 +7,10 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_ID = int(os.getenv("ADMIN_ID"))
 DATABASE_URL = os.getenv("DATABASE_URL")  
 
+# Свой адрес Bot API вместо api.telegram.org: локальный telegram-bot-api
+# или симулятор tools/bot_api_sim.py для нагрузочных проверок
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "")
+
 CITIES = [
     "Москва", "Санкт-Петербург", "Сургут", "Сочи",
     "Мурманск", "Краснодар", "Владикавказ", "Нальчик",
@@ -15,4 +19,86 @@ CITIES = [
     "Пятигорск", "Волгоград", "Кисловодск", "Новокузнецк",
     "Черкесск", "Улан-Удэ", "Саратов", "Грозный",
     "Нижний Новгород", "Архангельск", "Петрозаводск"
-]
\ No newline at end of file
+]
+
+# Рассылки: лимиты Telegram (~30 сообщений/сек на бота, ~1/сек в один чат)
+BROADCAST_RATE = float(os.getenv("BROADCAST_RATE", "28"))
+BROADCAST_PER_CHAT_RATE = float(os.getenv("BROADCAST_PER_CHAT_RATE", "1"))
+BROADCAST_CONCURRENCY = int(os.getenv("BROADCAST_CONCURRENCY", "20"))
+
+# Кэш пользователей/профилей (статус блокировки, город) — секунды и число записей.
+# Кэш свой у каждого процесса и между процессами не сбрасывается: если бот
+# запущен в нескольких процессах (BOT_MODE=webhook) — ставьте USER_CACHE_TTL=0
+USER_CACHE_TTL = float(os.getenv("USER_CACHE_TTL", "60"))
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "10000"))
+
+# Хранилище FSM: postgres | sqlite | memory
+FSM_STORAGE = os.getenv("FSM_STORAGE", "postgres")
+FSM_SQLITE_PATH = os.getenv("FSM_SQLITE_PATH", "fsm.sqlite3")
+FSM_TTL = float(os.getenv("FSM_TTL", str(7 * 24 * 3600)))       # брошенный диалог живёт неделю
+FSM_FLUSH_DELAY = float(os.getenv("FSM_FLUSH_DELAY", "0.3"))     # окно склейки записей, сек
+# Кэш чтения; если бот запущен в нескольких процессах — ставьте 0
+FSM_CACHE_TTL = float(os.getenv("FSM_CACHE_TTL", "30"))
+FSM_CACHE_SIZE = int(os.getenv("FSM_CACHE_SIZE", "5000"))
+
+# Приём обновлений: polling | webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling")
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "")          # публичный адрес сервиса, напр. https://bot.onrender.com
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "")
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("PORT", "8080"))
+WEBHOOK_QUEUE_SIZE = int(os.getenv("WEBHOOK_QUEUE_SIZE", "1000"))
+WEBHOOK_WORKERS = int(os.getenv("WEBHOOK_WORKERS", "16"))
+
+# Несколько процессов бота — только с BOT_MODE=webhook (в polling второй процесс
+# не запустится). Планировщик работает только у лидера (advisory lock в Postgres)
+LEADER_RETRY_INTERVAL = float(os.getenv("LEADER_RETRY_INTERVAL", "3"))
+LEADER_HEARTBEAT = float(os.getenv("LEADER_HEARTBEAT", "5"))
+
+# Excel-выгрузки собираются в отдельных потоках
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", "2"))
+
+# Кэш выгрузок: хранятся только file_id уже загруженных в Telegram файлов
+EXPORT_CACHE_SIZE = int(os.getenv("EXPORT_CACHE_SIZE", "200"))
+EXPORT_CACHE_TTL = float(os.getenv("EXPORT_CACHE_TTL", str(24 * 3600)))
+
+# Сводка рядовых событий админу — раз в столько секунд (срочные уходят сразу)
+ADMIN_DIGEST_INTERVAL = float(os.getenv("ADMIN_DIGEST_INTERVAL", "60"))
+
+# Outbox исходящих сообщений: размер пачки, опрос очереди (сек), попытки до dead,
+# сколько секунд сообщение закреплено за диспетчером, параллельные отправки,
+# сколько хранить отправленные (ключи идемпотентности) — сек
+OUTBOX_BATCH = int(os.getenv("OUTBOX_BATCH", "100"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "60"))
+OUTBOX_CONCURRENCY = int(os.getenv("OUTBOX_CONCURRENCY", "16"))
+OUTBOX_RETENTION = float(os.getenv("OUTBOX_RETENTION", str(30 * 24 * 3600)))
+
+# Пул соединений с базой. DB_STATEMENT_CACHE_SIZE=0 — если база за pgbouncer
+# в режиме transaction; DB_ACQUIRE_TIMEOUT / DB_COMMAND_TIMEOUT — секунды
+DB_POOL_MIN = int(os.getenv("DB_POOL_MIN", "1"))
+DB_POOL_MAX = int(os.getenv("DB_POOL_MAX", "5"))
+DB_ACQUIRE_TIMEOUT = float(os.getenv("DB_ACQUIRE_TIMEOUT", "10"))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", "30"))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "100"))
+DB_MAX_INACTIVE_LIFETIME = float(os.getenv("DB_MAX_INACTIVE_LIFETIME", "300"))
+
+# Запросы дольше стольких миллисекунд пишутся в лог (без значений параметров)
+DB_SLOW_QUERY_MS = float(os.getenv("DB_SLOW_QUERY_MS", "200"))
+
+# Метрики Prometheus (GET METRICS_PATH). В режиме webhook — на порту вебхука,
+# в polling — отдельный сервер METRICS_HOST:METRICS_PORT (0 — выключен).
+# METRICS_TOKEN — если задан, нужен заголовок Authorization: Bearer <token>
+METRICS_PATH = os.getenv("METRICS_PATH", "/metrics")
+METRICS_HOST = os.getenv("METRICS_HOST", "0.0.0.0")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9100"))
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+# Жизненный цикл смен: на следующий день после даты смены в этот час (местное время)
+# смена завершается сама и участникам уходит форма отчёта. Смены без разобранной
+# даты старше SHIFT_STALE_DAYS дней уходят в архив; смены, дата которых прошла
+# больше SHIFT_STALE_DAYS дней назад, завершаются молча, без форм отчёта.
+SHIFT_COMPLETE_HOUR = int(os.getenv("SHIFT_COMPLETE_HOUR", "10"))
+SHIFT_STALE_DAYS = int(os.getenv("SHIFT_STALE_DAYS", "14"))
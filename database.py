@@ -1,116 +1,67 @@
 import asyncpg
+import datetime
+import inspect
+import json
 from contextlib import asynccontextmanager
-from config import DATABASE_URL
+from typing import Callable
+from config import (
+    DATABASE_URL, USER_CACHE_TTL, USER_CACHE_SIZE,
+    DB_POOL_MIN, DB_POOL_MAX, DB_COMMAND_TIMEOUT,
+    DB_STATEMENT_CACHE_SIZE, DB_MAX_INACTIVE_LIFETIME,
+)
+from migrations import migrate
+from utils import db_stats
+from utils.cache import TTLCache, MISSING
+from utils.dates import shift_instants
 
 _pool: asyncpg.Pool | None = None
 
+# telegram_id → {"user": ..., "profile": ...}; любая запись в users/user_profiles
+# по пользователю обязана вызвать _users.invalidate(telegram_id). Сбрасывается только
+# в своём процессе — при нескольких процессах USER_CACHE_TTL=0 (см. config.py)
+_users = TTLCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
 
 async def init_db():
     """
-    Создаёт пул и таблицы в Postgres.
-    Структура таблиц сохранена максимально близко к SQLite-версии.
+    Создаёт пул и приводит схему к актуальной версии (см. migrations.py).
+    Если схема уже актуальна — DDL не выполняется.
     """
     global _pool
     if not DATABASE_URL:
         raise RuntimeError("DATABASE_URL is not set. Add it in Render Environment variables.")
 
     if _pool is None:
-        _pool = await asyncpg.create_pool(DATABASE_URL, min_size=1, max_size=5)
-
-    async with _pool.acquire() as conn:
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS users (
-                telegram_id BIGINT PRIMARY KEY,
-                username TEXT,
-                registered_at TIMESTAMPTZ DEFAULT NOW(),
-                is_active INTEGER DEFAULT 1
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS user_profiles (
-                telegram_id BIGINT PRIMARY KEY,
-                city TEXT,
-                full_name TEXT,
-                age INTEGER,
-                phone TEXT,
-                rating DOUBLE PRECISION DEFAULT 5.0,
-                total_shifts INTEGER DEFAULT 0,
-                confirmed_shifts INTEGER DEFAULT 0,
-                refused_shifts INTEGER DEFAULT 0,
-                ignored_shifts INTEGER DEFAULT 0,
-                consecutive_failures INTEGER DEFAULT 0,
-                is_active INTEGER DEFAULT 1,
-                CONSTRAINT fk_user_profiles_users
-                    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-                    ON DELETE CASCADE
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS shifts (
-                id BIGSERIAL PRIMARY KEY,
-                city TEXT NOT NULL,
-                date TEXT NOT NULL,
-                address TEXT NOT NULL,
-                payment TEXT NOT NULL,
-                conditions TEXT,
-                main_slots INTEGER NOT NULL,
-                reserve_slots INTEGER NOT NULL,
-                reminder_time TEXT,
-                morning_reminder_time TEXT,
-                status TEXT DEFAULT 'active',
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS shift_members (
-                id BIGSERIAL PRIMARY KEY,
-                shift_id BIGINT NOT NULL,
-                telegram_id BIGINT NOT NULL,
-                member_type TEXT NOT NULL,
-                position INTEGER,
-                status TEXT DEFAULT 'registered',
-                reminder_sent_at TIMESTAMPTZ,
-                morning_reminder_sent_at TIMESTAMPTZ,
-                joined_at TIMESTAMPTZ DEFAULT NOW(),
-                CONSTRAINT fk_shift_members_shifts
-                    FOREIGN KEY (shift_id) REFERENCES shifts(id)
-                    ON DELETE CASCADE,
-                CONSTRAINT fk_shift_members_users
-                    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-                    ON DELETE CASCADE
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS shift_results (
-                id BIGSERIAL PRIMARY KEY,
-                shift_id BIGINT NOT NULL,
-                telegram_id BIGINT NOT NULL,
-                worked INTEGER,
-                decline_reason TEXT,
-                CONSTRAINT fk_shift_results_shifts
-                    FOREIGN KEY (shift_id) REFERENCES shifts(id)
-                    ON DELETE CASCADE,
-                CONSTRAINT fk_shift_results_users
-                    FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
-                    ON DELETE CASCADE,
-                CONSTRAINT uq_shift_results UNIQUE (shift_id, telegram_id)
-            );
-        """)
-
-        await conn.execute("""
-            CREATE TABLE IF NOT EXISTS unblock_requests (
-                id BIGSERIAL PRIMARY KEY,
-                telegram_id BIGINT NOT NULL,
-                city TEXT,
-                message TEXT,
-                status TEXT DEFAULT 'pending',
-                created_at TIMESTAMPTZ DEFAULT NOW()
-            );
-        """)
+        _pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN,
+            max_size=DB_POOL_MAX,
+            command_timeout=DB_COMMAND_TIMEOUT,
+            statement_cache_size=DB_STATEMENT_CACHE_SIZE,
+            max_inactive_connection_lifetime=DB_MAX_INACTIVE_LIFETIME,
+            init=_init_connection,
+        )
+
+    async with _acquire() as conn:
+        await migrate(conn)
+
+
+async def _init_connection(conn: asyncpg.Connection):
+    conn.add_query_logger(db_stats.log_query)
+
+
+def _acquire():
+    """Соединение из пула с учётом ожидания и времени работы (utils/db_stats.py)."""
+    return db_stats.acquire(_pool)
+
+
+def pool_stats() -> dict:
+    return {
+        "size": _pool.get_size(),
+        "idle": _pool.get_idle_size(),
+        "min": _pool.get_min_size(),
+        "max": _pool.get_max_size(),
+    }
 
 
 def _rec_to_dict(r: asyncpg.Record | None) -> dict | None:
@@ -119,25 +70,44 @@ def _rec_to_dict(r: asyncpg.Record | None) -> dict | None:
 
 # ─── Users ────────────────────────────────────────────────────────────────────
 
+async def _user_entry(telegram_id: int) -> dict:
+    """Пользователь и профиль одним запросом; повторные обращения — из кэша."""
+    entry = _users.get(telegram_id)
+    if entry is not MISSING:
+        return entry
+
+    stamp = _users.stamp()
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT u, up
+               FROM (SELECT $1::BIGINT AS telegram_id) k
+               LEFT JOIN users u ON u.telegram_id = k.telegram_id
+               LEFT JOIN user_profiles up ON up.telegram_id = k.telegram_id""",
+            telegram_id
+        )
+    entry = {"user": _rec_to_dict(row["u"]), "profile": _rec_to_dict(row["up"])}
+    _users.set(telegram_id, entry, stamp)
+    return entry
+
+
 async def get_user(telegram_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM users WHERE telegram_id = $1", telegram_id)
-        return _rec_to_dict(row)
+    user = (await _user_entry(telegram_id))["user"]
+    return dict(user) if user else None
 
 
 async def create_user(telegram_id: int, username: str | None):
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "INSERT INTO users (telegram_id, username) VALUES ($1, $2) "
             "ON CONFLICT (telegram_id) DO NOTHING",
             telegram_id, username
         )
+    _users.invalidate(telegram_id)
 
 
 async def get_profile(telegram_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow("SELECT * FROM user_profiles WHERE telegram_id = $1", telegram_id)
-        return _rec_to_dict(row)
+    profile = (await _user_entry(telegram_id))["profile"]
+    return dict(profile) if profile else None
 
 
 async def upsert_profile(telegram_id: int, **fields):
@@ -147,7 +117,7 @@ async def upsert_profile(telegram_id: int, **fields):
     cols = list(fields.keys())
     values = list(fields.values())
 
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         insert_cols = ", ".join(["telegram_id"] + cols)
         insert_vals = ", ".join([f"${i}" for i in range(1, len(values) + 2)])
         updates = ", ".join([f"{c} = EXCLUDED.{c}" for c in cols])
@@ -157,10 +127,11 @@ async def upsert_profile(telegram_id: int, **fields):
             f"ON CONFLICT (telegram_id) DO UPDATE SET {updates}",
             telegram_id, *values
         )
+    _users.invalidate(telegram_id)
 
 
 async def get_users_by_city(city: str) -> list[dict]:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT u.telegram_id, up.full_name, up.phone, up.rating
                FROM users u
@@ -175,11 +146,12 @@ async def increment_stat(telegram_id: int, field: str):
     allowed = {"confirmed_shifts", "refused_shifts", "ignored_shifts", "total_shifts"}
     if field not in allowed:
         return
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             f"UPDATE user_profiles SET {field} = {field} + 1 WHERE telegram_id = $1",
             telegram_id
         )
+    _users.invalidate(telegram_id)
 
 
 # ─── Shifts ───────────────────────────────────────────────────────────────────
@@ -188,28 +160,36 @@ async def create_shift(
     city: str, date: str, address: str, payment: str, conditions: str,
     main_slots: int, reserve_slots: int,
     reminder_time: str, morning_reminder_time: str,
+    shift_date: datetime.date | None = None,
 ) -> int:
-    async with _pool.acquire() as conn:
+    """
+    date — подпись даты как её ввёл админ, shift_date — разобранная дата.
+    Моменты напоминаний (UTC) считаются сразу по часовому поясу города.
+    """
+    inst = shift_instants(city, shift_date, reminder_time, morning_reminder_time)
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """INSERT INTO shifts
                (city, date, address, payment, conditions, main_slots, reserve_slots,
-                reminder_time, morning_reminder_time)
-               VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9)
+                reminder_time, morning_reminder_time,
+                shift_date, starts_at, reminder_at, morning_reminder_at)
+               VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13)
                RETURNING id""",
             city, date, address, payment, conditions, main_slots, reserve_slots,
-            reminder_time, morning_reminder_time
+            reminder_time, morning_reminder_time,
+            shift_date, inst["starts_at"], inst["reminder_at"], inst["morning_reminder_at"]
         )
         return int(row["id"])
 
 
 async def get_shift(shift_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM shifts WHERE id = $1", shift_id)
         return _rec_to_dict(row)
 
 
 async def get_active_shift_by_city(city: str) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM shifts WHERE city = $1 AND status = 'active' "
             "ORDER BY created_at DESC LIMIT 1",
@@ -219,26 +199,74 @@ async def get_active_shift_by_city(city: str) -> dict | None:
 
 
 async def get_active_shift_by_id(shift_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM shifts WHERE id = $1", shift_id)
         return _rec_to_dict(row)
 
 
 async def get_all_active_shifts() -> list[dict]:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch("SELECT * FROM shifts WHERE status = 'active'")
         return [dict(r) for r in rows]
 
 
-async def update_shift_status(shift_id: int, status: str):
-    async with _pool.acquire() as conn:
-        await conn.execute("UPDATE shifts SET status = $1 WHERE id = $2", status, shift_id)
+# ─── Жизненный цикл смены ─────────────────────────────────────────────────────
+
+ReportRender = Callable[[dict, list[dict]], list[dict]]
+
+
+async def complete_shift(
+    shift_id: int, render: ReportRender | None = None,
+) -> tuple[dict | None, list[dict]]:
+    """
+    Завершить активную смену: (смена, участники для отчёта). Смена уже не активна —
+    (None, []): ручное «Завершить смену» и автозавершение не разошлют формы дважды.
+    render(shift, members) → сообщения outbox, ставятся той же транзакцией.
+    """
+    async with _acquire() as conn, conn.transaction():
+        row = await conn.fetchrow(
+            """UPDATE shifts SET status = 'completed'
+               WHERE id = $1 AND status = 'active'
+               RETURNING *""",
+            shift_id
+        )
+        if row is None:
+            return None, []
+        members = await conn.fetch(
+            """SELECT sm.telegram_id, sm.member_type, up.full_name
+               FROM shift_members sm
+               JOIN user_profiles up ON sm.telegram_id = up.telegram_id
+               WHERE sm.shift_id = $1
+                 AND sm.status NOT IN ('refused', 'removed')
+               ORDER BY sm.member_type, sm.position""",
+            shift_id
+        )
+        shift, members = dict(row), [dict(m) for m in members]
+        if render:
+            await _enqueue(conn, render(shift, members))
+    return shift, members
+
+
+async def archive_stale_shifts(days: int) -> list[dict]:
+    """
+    В архив: активные смены без разобранной даты (их нельзя завершить по дате,
+    а напоминания у них повторяются ежедневно), созданные раньше days дней.
+    """
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """UPDATE shifts SET status = 'archived'
+               WHERE created_at < NOW() - make_interval(days => $1)
+                 AND status = 'active' AND shift_date IS NULL
+               RETURNING id, city, date""",
+            days
+        )
+        return [dict(r) for r in rows]
 
 
 # ─── Shift members ────────────────────────────────────────────────────────────
 
 async def get_shift_members(shift_id: int) -> list[dict]:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT sm.*, up.full_name, up.phone
                FROM shift_members sm
@@ -251,7 +279,7 @@ async def get_shift_members(shift_id: int) -> list[dict]:
 
 
 async def get_member_count(shift_id: int, member_type: str) -> int:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             """SELECT COUNT(*) AS c FROM shift_members
                WHERE shift_id = $1 AND member_type = $2
@@ -261,17 +289,41 @@ async def get_member_count(shift_id: int, member_type: str) -> int:
         return int(row["c"])
 
 
-async def add_shift_member(shift_id: int, telegram_id: int, member_type: str, position: int):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "INSERT INTO shift_members (shift_id, telegram_id, member_type, position) "
-            "VALUES ($1,$2,$3,$4)",
-            shift_id, telegram_id, member_type, position
+async def reserve_slot(shift_id: int, telegram_id: int, member_type: str) -> dict:
+    """
+    Атомарно записать на смену: проверка «смена активна / уже записан / есть место»,
+    выдача позиции и вставка — одним вызовом функции reserve_slot() в базе.
+    outcome: 'ok' | 'already' | 'full' | 'closed'; taken/total — заполненность после записи.
+    """
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            "SELECT * FROM reserve_slot($1, $2, $3)",
+            shift_id, telegram_id, member_type
         )
+        return dict(row)
+
+
+async def get_signup_state(shift_id: int, telegram_id: int) -> dict | None:
+    """Активная смена + занятые места основы/резерва + записан ли пользователь — одним запросом."""
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT s.*,
+                      COUNT(*) FILTER (WHERE sm.member_type = 'main'
+                                         AND sm.status NOT IN ('refused','removed')) AS main_taken,
+                      COUNT(*) FILTER (WHERE sm.member_type = 'reserve'
+                                         AND sm.status NOT IN ('refused','removed')) AS reserve_taken,
+                      BOOL_OR(sm.telegram_id = $2) IS TRUE AS is_member
+               FROM shifts s
+               LEFT JOIN shift_members sm ON sm.shift_id = s.id
+               WHERE s.id = $1 AND s.status = 'active'
+               GROUP BY s.id""",
+            shift_id, telegram_id
+        )
+        return _rec_to_dict(row)
 
 
 async def get_user_shift_membership(shift_id: int, telegram_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM shift_members WHERE shift_id = $1 AND telegram_id = $2",
             shift_id, telegram_id
@@ -279,78 +331,333 @@ async def get_user_shift_membership(shift_id: int, telegram_id: int) -> dict | N
         return _rec_to_dict(row)
 
 
-async def update_member_status(shift_id: int, telegram_id: int, status: str):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE shift_members SET status = $1 WHERE shift_id = $2 AND telegram_id = $3",
-            status, shift_id, telegram_id
-        )
+# ─── Переходы состояния участника ─────────────────────────────────────────────
+# Нажатие «подтверждаю / не смогу» и снятие за игнор — одна транзакция: статус,
+# счётчики профиля, блокировка и перевод резерва вместе, без окон частичного
+# обновления. Возвращают всё, что нужно хендлеру для ответа.
+# Промоушен-сообщения строит render_promotion(shift, promoted) → сообщения outbox,
+# они ставятся в очередь той же транзакцией.
 
+PromotionRender = Callable[[dict, dict], list[dict]]
 
-async def set_reminder_sent_at(shift_id: int, telegram_id: int):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE shift_members SET reminder_sent_at = NOW() "
-            "WHERE shift_id = $1 AND telegram_id = $2",
-            shift_id, telegram_id
-        )
 
+def _transition_result(row: asyncpg.Record | None) -> dict | None:
+    if row is None:
+        return None
+    result = dict(row)
+    result["shift"] = dict(result.pop("s"))
+    return result
 
-async def set_morning_reminder_sent_at(shift_id: int, telegram_id: int):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE shift_members SET morning_reminder_sent_at = NOW() "
-            "WHERE shift_id = $1 AND telegram_id = $2",
-            shift_id, telegram_id
+
+async def confirm_member(shift_id: int, telegram_id: int, morning: bool = False) -> dict | None:
+    """
+    Подтверждение участия (вечер) или готовности (утро).
+    None — смены нет; иначе {"shift", "member_type", "prev_status", "changed", "full_name"}:
+    member_type None — не записан; changed — статус реально обновлён.
+    Вечером повторное подтверждение ничего не меняет, утром — допустимо.
+    Подтверждение сбрасывает consecutive_failures, вечернее — ещё и +1 confirmed_shifts.
+    """
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            """WITH m AS (
+                   SELECT id, member_type, status FROM shift_members
+                   WHERE shift_id = $1 AND telegram_id = $2
+                   FOR UPDATE
+               ),
+               confirmed AS (
+                   UPDATE shift_members sm SET status = 'confirmed'
+                   FROM m
+                   WHERE sm.id = m.id
+                     AND m.status NOT IN ('refused', 'removed')
+                     AND ($3 OR m.status <> 'confirmed')
+                   RETURNING sm.id
+               ),
+               profile AS (
+                   UPDATE user_profiles up
+                   SET confirmed_shifts = up.confirmed_shifts + (NOT $3)::INT,
+                       consecutive_failures = 0
+                   WHERE up.telegram_id = $2 AND EXISTS (SELECT 1 FROM confirmed)
+                   RETURNING up.full_name
+               )
+               SELECT s, m.member_type, m.status AS prev_status,
+                      EXISTS (SELECT 1 FROM confirmed) AS changed,
+                      COALESCE(
+                          (SELECT full_name FROM profile),
+                          (SELECT full_name FROM user_profiles WHERE telegram_id = $2)
+                      ) AS full_name
+               FROM shifts s
+               LEFT JOIN m ON TRUE
+               WHERE s.id = $1""",
+            shift_id, telegram_id, morning
         )
+    if row is not None and row["changed"]:
+        _users.invalidate(telegram_id)
+    return _transition_result(row)
 
 
-async def get_members_to_ignore_check(shift_id: int) -> list[dict]:
-    async with _pool.acquire() as conn:
-        rows = await conn.fetch(
-            """SELECT * FROM shift_members
-               WHERE shift_id = $1 AND status = 'registered'
-                 AND member_type = 'main'
-                 AND reminder_sent_at IS NOT NULL
-                 AND (NOW() - reminder_sent_at) >= INTERVAL '30 minutes'""",
-            shift_id
+async def refuse_member(
+    shift_id: int,
+    telegram_id: int,
+    render_promotion: PromotionRender | None = None,
+) -> dict | None:
+    """
+    Отказ от смены (вечер или утро): статус refused, +1 refused_shifts и
+    consecutive_failures, блокировка при 4 подряд, затем освободившиеся места
+    основы закрываются резервом (_fill_vacancies). Всё одной транзакцией.
+    None — смены нет; иначе {"shift", "member_type", "prev_status", "changed",
+    "full_name", "blocked", "promoted"}; promoted — список переведённых из резерва.
+    """
+    async with _acquire() as conn, conn.transaction():
+        # Сначала строка смены (подзапрос в WHERE), потом участник —
+        # тот же порядок блокировок, что у _fill_vacancies
+        row = await conn.fetchrow(
+            """WITH m AS (
+                   SELECT id, member_type, status FROM shift_members
+                   WHERE shift_id = (SELECT id FROM shifts WHERE id = $1 FOR UPDATE)
+                     AND telegram_id = $2
+                   FOR UPDATE
+               ),
+               refused AS (
+                   UPDATE shift_members sm SET status = 'refused'
+                   FROM m
+                   WHERE sm.id = m.id AND m.status NOT IN ('refused', 'removed')
+                   RETURNING sm.id
+               ),
+               profile AS (
+                   UPDATE user_profiles up
+                   SET refused_shifts = up.refused_shifts + 1,
+                       consecutive_failures = up.consecutive_failures + 1,
+                       is_active = CASE WHEN up.consecutive_failures + 1 >= 4
+                                        THEN 0 ELSE up.is_active END
+                   WHERE up.telegram_id = $2 AND EXISTS (SELECT 1 FROM refused)
+                   RETURNING up.full_name, up.consecutive_failures >= 4 AS blocked
+               ),
+               blocked_user AS (
+                   UPDATE users u SET is_active = 0
+                   FROM profile p
+                   WHERE u.telegram_id = $2 AND p.blocked
+               )
+               SELECT s, m.member_type, m.status AS prev_status,
+                      EXISTS (SELECT 1 FROM refused) AS changed,
+                      COALESCE(
+                          p.full_name,
+                          (SELECT full_name FROM user_profiles WHERE telegram_id = $2)
+                      ) AS full_name,
+                      COALESCE(p.blocked, FALSE) AS blocked
+               FROM shifts s
+               LEFT JOIN m ON TRUE
+               LEFT JOIN profile p ON TRUE
+               WHERE s.id = $1""",
+            shift_id, telegram_id
         )
-        return [dict(r) for r in rows]
+        result = _transition_result(row)
+        if result is None:
+            return None
 
+        result["promoted"] = []
+        if result["changed"]:
+            result["promoted"] = await _fill_vacancies(conn, [shift_id])
+            if render_promotion:
+                await _enqueue(conn, [
+                    m for p in result["promoted"] for m in render_promotion(result["shift"], p)
+                ])
 
-async def get_members_to_morning_ignore_check(shift_id: int) -> list[dict]:
-    async with _pool.acquire() as conn:
-        rows = await conn.fetch(
-            """SELECT * FROM shift_members
-               WHERE shift_id = $1 AND member_type = 'main' AND status = 'registered'
-                 AND morning_reminder_sent_at IS NOT NULL
-                 AND (NOW() - morning_reminder_sent_at) >= INTERVAL '10 minutes'""",
-            shift_id
-        )
-        return [dict(r) for r in rows]
+    if result["changed"]:
+        _users.invalidate(telegram_id)
+    return result
 
 
-async def get_first_reserve(shift_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            """SELECT * FROM shift_members
-               WHERE shift_id = $1 AND member_type = 'reserve'
+async def _fill_vacancies(conn: asyncpg.Connection, shift_ids: list[int]) -> list[dict]:
+    """
+    Закрыть все свободные места основы резервом — одним запросом (в транзакции
+    вызывающего): сколько мест свободно, столько первых в очереди резерва
+    (FOR UPDATE SKIP LOCKED — занятые своим отказом пропускаются) переходят в основу,
+    позиции активных в обоих списках перенумеровываются подряд с 1.
+    Строки смен блокируются, поэтому параллельные заполнения одной смены идут
+    по очереди и не переполняют основу. Вызывающий, который до этого блокировал
+    строки участников, обязан сначала заблокировать смену (порядок: смена → участники).
+    Возвращает переведённых: shift_id, telegram_id, position, full_name.
+    """
+    rows = await conn.fetch(
+        """WITH locked AS (
+               SELECT id, main_slots FROM shifts
+               WHERE id = ANY($1::BIGINT[])
+               ORDER BY id
+               FOR UPDATE
+           ),
+           vacancies AS (
+               SELECT l.id AS shift_id,
+                      l.main_slots - (
+                          SELECT COUNT(*) FROM shift_members sm
+                          WHERE sm.shift_id = l.id AND sm.member_type = 'main'
+                            AND sm.status NOT IN ('refused', 'removed')
+                      ) AS open
+               FROM locked l
+           ),
+           candidates AS (
+               SELECT id, shift_id, position FROM shift_members
+               WHERE shift_id = ANY($1::BIGINT[]) AND member_type = 'reserve'
                  AND status IN ('registered', 'confirmed')
-               ORDER BY position ASC LIMIT 1""",
-            shift_id
+               FOR UPDATE SKIP LOCKED
+           ),
+           chosen AS (
+               SELECT c.id
+               FROM (
+                   SELECT id, shift_id,
+                          ROW_NUMBER() OVER (PARTITION BY shift_id ORDER BY position, id) AS n
+                   FROM candidates
+               ) c
+               JOIN vacancies v ON v.shift_id = c.shift_id
+               WHERE c.n <= v.open
+           ),
+           numbered AS (
+               SELECT sm.id, ch.id IS NOT NULL AS promoted,
+                      ROW_NUMBER() OVER (
+                          PARTITION BY sm.shift_id,
+                                       CASE WHEN ch.id IS NOT NULL THEN 'main' ELSE sm.member_type END
+                          ORDER BY ch.id IS NOT NULL, sm.position, sm.id
+                      ) AS position
+               FROM shift_members sm
+               LEFT JOIN chosen ch ON ch.id = sm.id
+               WHERE sm.shift_id = ANY($1::BIGINT[])
+                 AND sm.status NOT IN ('refused', 'removed')
+           ),
+           updated AS (
+               UPDATE shift_members sm
+               SET position = n.position,
+                   member_type = CASE WHEN n.promoted THEN 'main' ELSE sm.member_type END,
+                   status = CASE WHEN n.promoted THEN 'registered' ELSE sm.status END,
+                   reminder_sent_at = CASE WHEN n.promoted THEN NULL ELSE sm.reminder_sent_at END,
+                   morning_reminder_sent_at = CASE WHEN n.promoted THEN NULL
+                                                   ELSE sm.morning_reminder_sent_at END
+               FROM numbered n
+               WHERE sm.id = n.id AND (n.promoted OR sm.position IS DISTINCT FROM n.position)
+               RETURNING sm.shift_id, sm.telegram_id, sm.position, n.promoted
+           )
+           SELECT u.shift_id, u.telegram_id, u.position, up.full_name
+           FROM updated u
+           LEFT JOIN user_profiles up ON up.telegram_id = u.telegram_id
+           WHERE u.promoted
+           ORDER BY u.shift_id, u.position""",
+        shift_ids
+    )
+    return [dict(r) for r in rows]
+
+
+async def remove_ignored_members(
+    morning: bool = False,
+    render: Callable[[dict], list[dict]] | None = None,
+    render_promotion: PromotionRender | None = None,
+) -> tuple[list[dict], list[dict]]:
+    """
+    Снять всю основу, не ответившую на напоминание (вечер — 30 мин, утро — 10 мин),
+    сразу по всем активным сменам: одна транзакция, один запрос.
+    Счётчики ignored_shifts / consecutive_failures и блокировка обновляются там же,
+    освободившиеся места закрываются резервом (_fill_vacancies).
+    render(строка) → сообщения снятому, render_promotion — переведённому;
+    кладутся в outbox в той же транзакции.
+    Возвращает (снятые: участник + данные смены + blocked, переведённые из резерва).
+    """
+    sent_col, timeout = (
+        ("morning_reminder_sent_at", "10 minutes") if morning
+        else ("reminder_sent_at", "30 minutes")
+    )
+    overdue = (
+        f"""sm.member_type = 'main' AND sm.status = 'registered'
+            AND sm.{sent_col} <= NOW() - INTERVAL '{timeout}'"""
+    )
+    async with _acquire() as conn, conn.transaction():
+        # Сначала смены, потом участники — порядок блокировок как у _fill_vacancies
+        shift_ids = await conn.fetch(
+            f"""SELECT s.id FROM shifts s
+                WHERE s.status = 'active'
+                  AND EXISTS (SELECT 1 FROM shift_members sm
+                              WHERE sm.shift_id = s.id AND {overdue})
+                ORDER BY s.id
+                FOR UPDATE"""
         )
-        return _rec_to_dict(row)
+        if not shift_ids:
+            return [], []
+        rows = await conn.fetch(
+            f"""WITH overdue AS (
+                    SELECT sm.id
+                    FROM shift_members sm
+                    WHERE sm.shift_id = ANY($1::BIGINT[]) AND {overdue}
+                    FOR UPDATE SKIP LOCKED
+                ),
+                removed AS (
+                    UPDATE shift_members sm SET status = 'removed'
+                    FROM overdue o
+                    WHERE sm.id = o.id
+                    RETURNING sm.shift_id, sm.telegram_id, sm.member_type
+                ),
+                per_user AS (
+                    SELECT telegram_id, COUNT(*) AS n FROM removed GROUP BY telegram_id
+                ),
+                profiles AS (
+                    UPDATE user_profiles up
+                    SET ignored_shifts = up.ignored_shifts + pu.n,
+                        consecutive_failures = up.consecutive_failures + pu.n,
+                        is_active = CASE WHEN up.consecutive_failures + pu.n >= 4
+                                         THEN 0 ELSE up.is_active END
+                    FROM per_user pu
+                    WHERE up.telegram_id = pu.telegram_id
+                    RETURNING up.telegram_id, up.full_name,
+                              up.consecutive_failures >= 4 AS blocked
+                ),
+                blocked_users AS (
+                    UPDATE users u SET is_active = 0
+                    FROM profiles p
+                    WHERE u.telegram_id = p.telegram_id AND p.blocked
+                )
+                SELECT r.shift_id, r.telegram_id, r.member_type,
+                       p.full_name, COALESCE(p.blocked, FALSE) AS blocked,
+                       s.city, s.date, s.address, s.payment,
+                       s.main_slots, s.morning_reminder_time
+                FROM removed r
+                JOIN shifts s ON s.id = r.shift_id
+                LEFT JOIN profiles p ON p.telegram_id = r.telegram_id
+                ORDER BY r.shift_id""",
+            [r["id"] for r in shift_ids]
+        )
+        rows = [dict(r) for r in rows]
+        promoted = await _fill_vacancies(conn, sorted({r["shift_id"] for r in rows}))
 
+        messages = []
+        if render:
+            messages += [m for r in rows for m in render(r)]
+        if render_promotion:
+            shifts = {r["shift_id"]: r for r in rows}
+            messages += [m for p in promoted for m in render_promotion(shifts[p["shift_id"]], p)]
+        await _enqueue(conn, messages)
+    _users.invalidate(*(r["telegram_id"] for r in rows))
+    return rows, promoted
 
-async def promote_to_main(shift_id: int, telegram_id: int, new_position: int):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            """UPDATE shift_members
-               SET member_type = 'main', position = $1, status = 'registered',
-                   reminder_sent_at = NULL, morning_reminder_sent_at = NULL
-               WHERE shift_id = $2 AND telegram_id = $3""",
-            new_position, shift_id, telegram_id
+
+async def get_pending_ignore_deadlines() -> list[dict]:
+    """
+    Основа, ждущая ответа на напоминание, по сменам: первое и последнее время отправки.
+    Новый лидер планировщика по ним восстанавливает ещё не наступившие проверки игнора.
+    """
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT sm.shift_id, FALSE AS morning,
+                      MIN(sm.reminder_sent_at) AS first_sent, MAX(sm.reminder_sent_at) AS last_sent
+               FROM shift_members sm
+               JOIN shifts s ON s.id = sm.shift_id AND s.status = 'active'
+               WHERE sm.member_type = 'main' AND sm.status = 'registered'
+                 AND sm.reminder_sent_at IS NOT NULL
+               GROUP BY sm.shift_id
+               UNION ALL
+               SELECT sm.shift_id, TRUE,
+                      MIN(sm.morning_reminder_sent_at), MAX(sm.morning_reminder_sent_at)
+               FROM shift_members sm
+               JOIN shifts s ON s.id = sm.shift_id AND s.status = 'active'
+               WHERE sm.member_type = 'main' AND sm.status = 'registered'
+                 AND sm.morning_reminder_sent_at IS NOT NULL
+               GROUP BY sm.shift_id"""
         )
+        return [dict(r) for r in rows]
 
 
 # ─── shift_results ────────────────────────────────────────────────────────────
@@ -361,7 +668,7 @@ async def save_shift_result(
     worked: bool,
     decline_reason: str = None,
 ):
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             """INSERT INTO shift_results (shift_id, telegram_id, worked, decline_reason)
                VALUES ($1,$2,$3,$4)
@@ -385,10 +692,11 @@ async def save_shift_result(
                    WHERE telegram_id = $1""",
                 telegram_id
             )
+            _users.invalidate(telegram_id)
 
 
 async def get_shift_result(shift_id: int, telegram_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow(
             "SELECT * FROM shift_results WHERE shift_id = $1 AND telegram_id = $2",
             shift_id, telegram_id
@@ -396,102 +704,51 @@ async def get_shift_result(shift_id: int, telegram_id: int) -> dict | None:
         return _rec_to_dict(row)
 
 
-async def get_shift_members_for_report(shift_id: int) -> list[dict]:
-    async with _pool.acquire() as conn:
-        rows = await conn.fetch(
-            """SELECT sm.telegram_id, sm.member_type, up.full_name
-               FROM shift_members sm
-               JOIN user_profiles up ON sm.telegram_id = up.telegram_id
-               WHERE sm.shift_id = $1
-                 AND sm.status NOT IN ('refused', 'removed')""",
-            shift_id
-        )
-        return [dict(r) for r in rows]
-
-
 async def get_shift_results_full(shift_id: int) -> tuple[list, list, list]:
-    async with _pool.acquire() as conn:
-        worked = await conn.fetch(
-            """SELECT sr.telegram_id, up.full_name, up.phone, sm.member_type
-               FROM shift_results sr
-               JOIN user_profiles up ON sr.telegram_id = up.telegram_id
-               JOIN shift_members sm
-                 ON sm.shift_id = sr.shift_id AND sm.telegram_id = sr.telegram_id
-               WHERE sr.shift_id = $1 AND sr.worked = 1""",
-            shift_id
-        )
-
-        not_worked = await conn.fetch(
-            """SELECT sr.telegram_id, up.full_name, up.phone,
-                      sr.decline_reason, sm.member_type
-               FROM shift_results sr
-               JOIN user_profiles up ON sr.telegram_id = up.telegram_id
-               JOIN shift_members sm
-                 ON sm.shift_id = sr.shift_id AND sm.telegram_id = sr.telegram_id
-               WHERE sr.shift_id = $1 AND sr.worked = 0""",
-            shift_id
-        )
-
-        no_response = await conn.fetch(
-            """SELECT sm.telegram_id, up.full_name, up.phone, sm.member_type
+    """Отработали / не вышли / не ответили — одним запросом по составу смены."""
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """SELECT sm.telegram_id, up.full_name, up.phone, sm.member_type,
+                      sr.worked, sr.decline_reason
                FROM shift_members sm
                JOIN user_profiles up ON sm.telegram_id = up.telegram_id
+               LEFT JOIN shift_results sr
+                 ON sr.shift_id = sm.shift_id AND sr.telegram_id = sm.telegram_id
                WHERE sm.shift_id = $1
-                 AND sm.status NOT IN ('removed', 'refused')
-                 AND sm.telegram_id NOT IN (
-                     SELECT telegram_id FROM shift_results WHERE shift_id = $1
-                 )""",
+                 AND (sr.telegram_id IS NOT NULL OR sm.status NOT IN ('removed', 'refused'))
+               ORDER BY sm.member_type, sm.position""",
             shift_id
         )
 
-    return [dict(r) for r in worked], [dict(r) for r in not_worked], [dict(r) for r in no_response]
+    worked, not_worked, no_response = [], [], []
+    for r in rows:
+        bucket = {1: worked, 0: not_worked}.get(r["worked"], no_response)
+        bucket.append(dict(r))
+    return worked, not_worked, no_response
 
 
-# ─── Блок 7 ───────────────────────────────────────────────────────────────────
-
-async def increment_consecutive_failures(telegram_id: int):
-    async with _pool.acquire() as conn:
+async def set_shift_summary_message(shift_id: int, message_id: int):
+    async with _acquire() as conn:
         await conn.execute(
-            """UPDATE user_profiles
-               SET consecutive_failures = consecutive_failures + 1
-               WHERE telegram_id = $1""",
-            telegram_id
+            "UPDATE shifts SET summary_message_id = $1 WHERE id = $2",
+            message_id, shift_id
         )
 
 
-async def reset_consecutive_failures(telegram_id: int):
-    async with _pool.acquire() as conn:
-        await conn.execute(
-            "UPDATE user_profiles SET consecutive_failures = 0 WHERE telegram_id = $1",
-            telegram_id
-        )
-
-
-async def check_and_block_if_needed(telegram_id: int) -> bool:
-    async with _pool.acquire() as conn:
-        row = await conn.fetchrow(
-            "SELECT consecutive_failures FROM user_profiles WHERE telegram_id = $1",
-            telegram_id
-        )
-        if not row or int(row["consecutive_failures"]) < 4:
-            return False
-
-        await conn.execute("UPDATE user_profiles SET is_active = 0 WHERE telegram_id = $1", telegram_id)
-        await conn.execute("UPDATE users SET is_active = 0 WHERE telegram_id = $1", telegram_id)
-        return True
-
+# ─── Блок 7 ───────────────────────────────────────────────────────────────────
 
 async def unblock_user(telegram_id: int):
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "UPDATE user_profiles SET is_active = 1, consecutive_failures = 0 WHERE telegram_id = $1",
             telegram_id
         )
         await conn.execute("UPDATE users SET is_active = 1 WHERE telegram_id = $1", telegram_id)
+    _users.invalidate(telegram_id)
 
 
 async def create_unblock_request(telegram_id: int, city: str, message: str) -> bool:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         existing = await conn.fetchrow(
             "SELECT id FROM unblock_requests WHERE telegram_id = $1 AND status = 'pending'",
             telegram_id
@@ -507,7 +764,7 @@ async def create_unblock_request(telegram_id: int, city: str, message: str) -> b
 
 
 async def get_pending_unblock_requests() -> list[dict]:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         rows = await conn.fetch(
             """SELECT ur.*, up.full_name, up.phone, up.refused_shifts,
                       up.ignored_shifts, up.consecutive_failures
@@ -520,7 +777,7 @@ async def get_pending_unblock_requests() -> list[dict]:
 
 
 async def resolve_unblock_request(request_id: int, status: str):
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         await conn.execute(
             "UPDATE unblock_requests SET status = $1 WHERE id = $2",
             status, request_id
@@ -528,12 +785,312 @@ async def resolve_unblock_request(request_id: int, status: str):
 
 
 async def get_unblock_request(request_id: int) -> dict | None:
-    async with _pool.acquire() as conn:
+    async with _acquire() as conn:
         row = await conn.fetchrow("SELECT * FROM unblock_requests WHERE id = $1", request_id)
         return _rec_to_dict(row)
 
 
+# ─── Версии данных выгрузок ───────────────────────────────────────────────────
+
+async def get_export_versions(*scopes: str) -> tuple[int, ...]:
+    """
+    Версии данных ('city:Москва', 'shift:12') — поднимаются триггерами при любой
+    записи в user_profiles / shift_members / shift_results (миграция 6).
+    """
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            "SELECT scope, version FROM export_versions WHERE scope = ANY($1::TEXT[])",
+            list(scopes)
+        )
+    versions = {r["scope"]: r["version"] for r in rows}
+    return tuple(versions.get(scope, 0) for scope in scopes)
+
+
+# ─── Межпроцессные события ────────────────────────────────────────────────────
+
+TIMERS_CHANNEL = "shift_timers"
+
+
+async def notify_timers(payload: str):
+    """Передать событие планировщика процессу-лидеру (LISTEN shift_timers)."""
+    async with _acquire() as conn:
+        await conn.execute("SELECT pg_notify($1, $2)", TIMERS_CHANNEL, payload)
+
+
+# ─── FSM storage ──────────────────────────────────────────────────────────────
+
+async def fsm_load(key: str, ttl: float) -> tuple[str | None, dict] | None:
+    """Состояние и данные диалога; записи старше ttl секунд считаются истёкшими."""
+    async with _acquire() as conn:
+        row = await conn.fetchrow(
+            """SELECT state, data FROM fsm_storage
+               WHERE key = $1 AND updated_at > NOW() - make_interval(secs => $2)""",
+            key, ttl
+        )
+        return (row["state"], json.loads(row["data"])) if row else None
+
+
+async def fsm_save(records: dict[str, tuple[str | None, dict]]):
+    """Пачка изменений одной транзакцией; пустые записи (state.clear()) удаляются."""
+    keep = {k: v for k, v in records.items() if v[0] is not None or v[1]}
+    drop = [k for k in records if k not in keep]
+    async with _acquire() as conn:
+        async with conn.transaction():
+            if keep:
+                await conn.execute(
+                    """INSERT INTO fsm_storage (key, state, data, updated_at)
+                       SELECT k, s, d, NOW()
+                       FROM unnest($1::TEXT[], $2::TEXT[], $3::JSONB[]) AS t(k, s, d)
+                       ON CONFLICT (key) DO UPDATE SET
+                           state = EXCLUDED.state,
+                           data = EXCLUDED.data,
+                           updated_at = EXCLUDED.updated_at""",
+                    list(keep),
+                    [v[0] for v in keep.values()],
+                    [json.dumps(v[1], ensure_ascii=False) for v in keep.values()],
+                )
+            if drop:
+                await conn.execute("DELETE FROM fsm_storage WHERE key = ANY($1::TEXT[])", drop)
+
+
+async def fsm_purge(ttl: float) -> int:
+    """Удалить брошенные диалоги (без изменений дольше ttl секунд)."""
+    async with _acquire() as conn:
+        result = await conn.execute(
+            "DELETE FROM fsm_storage WHERE updated_at < NOW() - make_interval(secs => $1)",
+            ttl
+        )
+        return int(result.split()[-1])
+
+
+async def fsm_count() -> int:
+    async with _acquire() as conn:
+        return await conn.fetchval("SELECT COUNT(*) FROM fsm_storage")
+
+
+# ─── Outbox ───────────────────────────────────────────────────────────────────
+# Сообщение: {"key", "chat_id", "payload", "on_sent"}. key — ключ идемпотентности:
+# повторная постановка того же сообщения (перезапуск задачи, повтор хендлера) — no-op.
+# on_sent — что отметить в базе после фактической отправки (см. complete_outbox).
+# Очередь общая для всех смен и разбирается по deadline (по умолчанию — момент
+# постановки); scheduled_at — когда сообщение должно было уйти, для сравнения с sent_at.
+
+async def _enqueue(conn: asyncpg.Connection, messages: list[dict]) -> int:
+    if not messages:
+        return 0
+    result = await conn.execute(
+        """INSERT INTO outbox (dedup_key, chat_id, payload, on_sent, scheduled_at, deadline)
+           SELECT k, c, p, o, s, COALESCE(d, NOW())
+           FROM unnest($1::TEXT[], $2::BIGINT[], $3::JSONB[], $4::JSONB[],
+                       $5::TIMESTAMPTZ[], $6::TIMESTAMPTZ[]) AS t(k, c, p, o, s, d)
+           ON CONFLICT (dedup_key) DO NOTHING""",
+        [m["key"] for m in messages],
+        [m["chat_id"] for m in messages],
+        [json.dumps(m["payload"], ensure_ascii=False) for m in messages],
+        [json.dumps(m["on_sent"]) if m.get("on_sent") else None for m in messages],
+        [m.get("scheduled_at") for m in messages],
+        [m.get("deadline") for m in messages],
+    )
+    return int(result.split()[-1])
+
+
+async def enqueue_outbox(messages: list[dict]) -> int:
+    """Поставить сообщения в очередь; возвращает число новых (без дублей по key)."""
+    async with _acquire() as conn:
+        return await _enqueue(conn, messages)
+
+
+async def enqueue_shift_reminders(
+    shift_id: int,
+    morning: bool,
+    main: dict,
+    main_on_sent: dict,
+    reserve: dict | None,
+    today: str,
+    scheduled_at: datetime.datetime,
+    reserve_deadline: datetime.datetime,
+) -> int:
+    """
+    Напоминания смены одним INSERT … SELECT из shift_members: текст и клавиатура
+    посчитаны один раз на смену (main / reserve — payload outbox), участники
+    в процесс не читаются. Кому отправлять — как раньше в планировщике:
+    • вечер: registered/confirmed без reminder_sent_at, основе — main с on_sent,
+      резерву — reserve (ключ с датой: инфо раз в день);
+    • утро: основа confirmed без morning_reminder_sent_at; резерв confirmed —
+      только если основа укомплектована.
+    Срок основы — scheduled_at (у неё идёт отсчёт игнора), резерва — reserve_deadline:
+    в общей очереди основа всех смен этого момента уходит раньше информации резерву.
+    """
+    prefix = "morning" if morning else "evening"
+    async with _acquire() as conn:
+        result = await conn.execute(
+            """WITH main_active AS (
+                   SELECT COUNT(*) AS n FROM shift_members
+                   WHERE shift_id = $1 AND member_type = 'main'
+                     AND status NOT IN ('refused','removed')
+               )
+               INSERT INTO outbox (dedup_key, chat_id, payload, on_sent, scheduled_at, deadline)
+               SELECT CASE WHEN sm.member_type = 'main'
+                           THEN $2 || ':' || $1 || ':' || sm.telegram_id
+                           ELSE $2 || '_info:' || $1 || ':' || sm.telegram_id || ':' || $7
+                      END,
+                      sm.telegram_id,
+                      CASE WHEN sm.member_type = 'main' THEN $4::JSONB ELSE $6::JSONB END,
+                      CASE WHEN sm.member_type = 'main' THEN $5::JSONB END,
+                      $8::TIMESTAMPTZ,
+                      CASE WHEN sm.member_type = 'main' THEN $8::TIMESTAMPTZ ELSE $9::TIMESTAMPTZ END
+               FROM shift_members sm
+               JOIN shifts s ON s.id = sm.shift_id
+               WHERE sm.shift_id = $1
+                 AND (sm.member_type = 'main' OR $6::JSONB IS NOT NULL)
+                 AND CASE
+                     WHEN NOT $3 THEN
+                         sm.reminder_sent_at IS NULL
+                         AND sm.status IN ('registered','confirmed')
+                     WHEN sm.member_type = 'main' THEN
+                         sm.morning_reminder_sent_at IS NULL AND sm.status = 'confirmed'
+                     ELSE
+                         sm.morning_reminder_sent_at IS NULL AND sm.status = 'confirmed'
+                         AND (SELECT n FROM main_active) >= s.main_slots
+                 END
+               ORDER BY sm.member_type, sm.position
+               ON CONFLICT (dedup_key) DO NOTHING""",
+            shift_id, prefix, morning,
+            json.dumps(main, ensure_ascii=False), json.dumps(main_on_sent),
+            json.dumps(reserve, ensure_ascii=False) if reserve else None,
+            today, scheduled_at, reserve_deadline,
+        )
+        return int(result.split()[-1])
+
+
+async def claim_outbox(limit: int, lease: float) -> list[dict]:
+    """
+    Забрать пачку готовых к отправке сообщений — самые ранние сроки первыми.
+    Строки не держатся под блокировкой:
+    next_attempt_at сдвигается на lease секунд, и другие диспетчеры их не видят.
+    Упал посреди отправки — через lease сообщение уйдёт повторно (at-least-once).
+    """
+    async with _acquire() as conn:
+        rows = await conn.fetch(
+            """UPDATE outbox o
+               SET next_attempt_at = NOW() + make_interval(secs => $2)
+               WHERE o.id IN (
+                   SELECT id FROM outbox
+                   WHERE status = 'pending' AND next_attempt_at <= NOW()
+                   ORDER BY deadline, id
+                   LIMIT $1
+                   FOR UPDATE SKIP LOCKED
+               )
+               RETURNING o.id, o.dedup_key, o.chat_id, o.payload, o.on_sent, o.attempts,
+                         o.scheduled_at, o.deadline""",
+            limit, lease
+        )
+    rows = sorted(rows, key=lambda r: (r["deadline"], r["id"]))
+    return [
+        {
+            **dict(r),
+            "payload": json.loads(r["payload"]),
+            "on_sent": json.loads(r["on_sent"]) if r["on_sent"] else None,
+        }
+        for r in rows
+    ]
+
+
+async def complete_outbox(
+    sent: list[tuple[int, datetime.datetime]],
+    retry: list[tuple[int, float, bool, str]],
+    dead: list[tuple[int, str]],
+) -> list[dict]:
+    """
+    Итоги пачки одной транзакцией.
+    sent  — (id, момент отправки): статус sent + отметки on_sent["stamp"] у участника смены
+            фактическим временем отправки;
+    retry — (id, задержка, считать ли попытку, ошибка);
+    dead  — (id, ошибка): попытки кончились или ошибка окончательная.
+    Возвращает пары {kind, shift_id} для on_sent["ignore_check"] отправленных сообщений.
+    """
+    async with _acquire() as conn, conn.transaction():
+        checks = []
+        if sent:
+            checks = await conn.fetch(
+                """WITH done AS (
+                       UPDATE outbox o
+                       SET status = 'sent', sent_at = t.sent_at, attempts = o.attempts + 1
+                       FROM unnest($1::BIGINT[], $2::TIMESTAMPTZ[]) AS t(id, sent_at)
+                       WHERE o.id = t.id AND o.status = 'pending'
+                       RETURNING o.chat_id, o.on_sent, t.sent_at
+                   ),
+                   evening AS (
+                       UPDATE shift_members sm SET reminder_sent_at = d.sent_at
+                       FROM done d
+                       WHERE d.on_sent->>'stamp' = 'reminder_sent_at'
+                         AND sm.shift_id = (d.on_sent->>'shift_id')::BIGINT
+                         AND sm.telegram_id = d.chat_id
+                   ),
+                   morning AS (
+                       UPDATE shift_members sm SET morning_reminder_sent_at = d.sent_at
+                       FROM done d
+                       WHERE d.on_sent->>'stamp' = 'morning_reminder_sent_at'
+                         AND sm.shift_id = (d.on_sent->>'shift_id')::BIGINT
+                         AND sm.telegram_id = d.chat_id
+                   )
+                   SELECT DISTINCT d.on_sent->>'ignore_check' AS kind,
+                          (d.on_sent->>'shift_id')::BIGINT AS shift_id
+                   FROM done d
+                   WHERE d.on_sent ? 'ignore_check'""",
+                [i for i, _ in sent], [t for _, t in sent]
+            )
+        if retry:
+            await conn.execute(
+                """UPDATE outbox o
+                   SET next_attempt_at = NOW() + make_interval(secs => t.delay),
+                       attempts = o.attempts + t.counted::INT,
+                       last_error = t.error
+                   FROM unnest($1::BIGINT[], $2::FLOAT8[], $3::BOOLEAN[], $4::TEXT[])
+                        AS t(id, delay, counted, error)
+                   WHERE o.id = t.id AND o.status = 'pending'""",
+                [r[0] for r in retry], [r[1] for r in retry],
+                [r[2] for r in retry], [r[3] for r in retry]
+            )
+        if dead:
+            await conn.execute(
+                """UPDATE outbox o
+                   SET status = 'dead', attempts = o.attempts + 1, last_error = t.error
+                   FROM unnest($1::BIGINT[], $2::TEXT[]) AS t(id, error)
+                   WHERE o.id = t.id AND o.status = 'pending'""",
+                [d[0] for d in dead], [d[1] for d in dead]
+            )
+    return [dict(r) for r in checks]
+
+
+async def purge_outbox(retention: float) -> int:
+    """Удалить отправленные и «мёртвые» сообщения старше retention секунд."""
+    async with _acquire() as conn:
+        result = await conn.execute(
+            """DELETE FROM outbox
+               WHERE status <> 'pending'
+                 AND created_at < NOW() - make_interval(secs => $1)""",
+            retention
+        )
+        return int(result.split()[-1])
+
+
 @asynccontextmanager
-async def get_db():
-    async with _pool.acquire() as conn:
-        yield conn
\ No newline at end of file
+async def get_db(name: str = "get_db"):
+    """Соединение для запросов вне этого модуля; name — под каким именем учитывать."""
+    token = db_stats.current_query.set(name)
+    try:
+        async with _acquire() as conn:
+            yield conn
+    finally:
+        db_stats.current_query.reset(token)
+
+
+# Все запросы модуля — под учёт времени: имя запроса = имя функции
+for _name, _fn in list(globals().items()):
+    if (
+        inspect.iscoroutinefunction(_fn)
+        and _fn.__module__ == __name__
+        and not _name.startswith("_")
+    ):
+        globals()[_name] = db_stats.timed(_fn)
\ No newline at end of file
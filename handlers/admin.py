@@ -5,38 +5,44 @@
 • Публикация смены (рассылка всем сотрудникам города)
 • Статус текущей смены (основа / резерв)
 • Панель-шпаргалка команд
+• /dbstats — пул соединений и время запросов к базе
 • Просмотр запросов на разблокировку (просмотр + ручная разблокировка)
 """
 
+from datetime import date, datetime
+
 from aiogram import Router, F, Bot
-from aiogram.types import (
-    Message, CallbackQuery,
-    InlineKeyboardMarkup, InlineKeyboardButton,
-)
+from aiogram.types import Message, CallbackQuery
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
 from config import ADMIN_ID, CITIES
-from aiogram.types import BufferedInputFile                          
+from city_timezones import get_city_tz
 from utils.excel_export import excel_city_base, excel_shift_report
+from utils.export_cache import send_export
+from utils.broadcast import broadcast, deliver, progress_line
+from utils.timer_heap import schedule_shift, unschedule_shift
+from utils.dates import parse_shift_date, format_date
+from utils.db_stats import report as db_report
 from database import (
     create_shift,
     get_shift,
     get_active_shift_by_city,
-    get_active_shift_by_id,
     get_shift_members,
-    get_shift_members_for_report,
     get_member_count,
     get_users_by_city,
-    update_shift_status,
+    complete_shift,
     upsert_profile,
     # Блок 7
     get_pending_unblock_requests,
     resolve_unblock_request,
     unblock_user,
     get_db,
+    get_export_versions,
+    pool_stats,
 )
+from handlers.shift_report import report_keyboard, report_text, summary_keyboard, forget_summary
 from utils.states import AdminStates
 
 router = Router()
@@ -144,6 +150,7 @@ CHEATSHEET = """
 📋 <b>Шпаргалка команд</b>
 
 /admin — открыть панель управления
+/dbstats — пул соединений и время запросов к базе
 
 <b>Создание смены:</b>
 ➕ Создать смену → выбери город → заполни данные → опубликуй
@@ -177,6 +184,15 @@ async def show_cheatsheet(callback: CallbackQuery):
     )
 
 
+# ─── Статистика базы ─────────────────────────────────────────────────────────
+
+@router.message(Command("dbstats"))
+async def cmd_dbstats(message: Message):
+    if not is_admin(message.from_user.id):
+        return
+    await message.answer(db_report(pool_stats()), parse_mode="HTML")
+
+
 # ─── Создание смены (FSM) ─────────────────────────────────────────────────────
 
 @router.callback_query(F.data == "admin:create_shift")
@@ -206,7 +222,21 @@ async def admin_choose_city(callback: CallbackQuery, state: FSMContext):
 async def admin_enter_date(message: Message, state: FSMContext):
     if not is_admin(message.from_user.id):
         return
-    await state.update_data(date=message.text.strip())
+    data = await state.get_data()
+    today = datetime.now(get_city_tz(data["city"])).date()
+    shift_date = parse_shift_date(message.text, today)
+    if shift_date is None:
+        await message.answer(
+            "Не удалось распознать дату. Введи, например, <code>25.07.2025</code> "
+            "или <code>Суббота 26 июля</code>:",
+            parse_mode="HTML",
+        )
+        return
+    if shift_date < today:
+        await message.answer("Эта дата уже прошла. Введи дату смены ещё раз:")
+        return
+
+    await state.update_data(date=message.text.strip(), shift_date=shift_date.isoformat())
     await state.set_state(AdminStates.entering_address)
     await message.answer("📍 Введи адрес объекта:")
 
@@ -339,9 +369,14 @@ async def admin_enter_morning_reminder_time(message: Message, state: FSMContext)
 
 
 def build_shift_preview(data: dict) -> str:
+    date_line = data["date"]
+    if data.get("shift_date"):
+        exact = format_date(date.fromisoformat(data["shift_date"]))
+        if exact not in date_line:
+            date_line += f" ({exact})"
     text = (
         f"🏙 Город: <b>{data['city']}</b>\n"
-        f"📅 Дата: {data['date']}\n"
+        f"📅 Дата: {date_line}\n"
         f"📍 Адрес: {data['address']}\n"
         f"💰 Оплата: {data['payment']}\n"
     )
@@ -387,36 +422,40 @@ async def publish_shift(callback: CallbackQuery, state: FSMContext, bot: Bot):
         reserve_slots=data["reserve_slots"],
         reminder_time=data["reminder_time"],
         morning_reminder_time=data.get("morning_reminder_time", "08:00"),
+        shift_date=date.fromisoformat(data["shift_date"]) if data.get("shift_date") else None,
     )
+    await schedule_shift(await get_shift(shift_id))
 
     announcement = build_announcement(data, shift_id)
     users = await get_users_by_city(data["city"])
-    sent = 0
-    failed = 0
-
-    for user in users:
-        try:
-            from aiogram.utils.keyboard import InlineKeyboardBuilder as IKB
-            kb = IKB()
-            kb.button(text="✅ Записаться", callback_data=f"register_shift:{shift_id}")
-            await bot.send_message(
-                user["telegram_id"],
-                announcement,
-                parse_mode="HTML",
-                reply_markup=kb.as_markup(),
-            )
-            sent += 1
-        except Exception:
-            failed += 1
 
-    await callback.message.edit_text(
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✅ Записаться", callback_data=f"register_shift:{shift_id}")
+    markup = kb.as_markup()
+
+    header = (
         f"✅ <b>Смена опубликована!</b>\n\n"
         f"{build_shift_preview(data)}\n\n"
-        f"📨 Рассылка: отправлено {sent}, не доставлено {failed}\n"
-        f"🆔 ID смены: <code>{shift_id}</code>",
+    )
+    footer = f"\n🆔 ID смены: <code>{shift_id}</code>"
+
+    await callback.answer()
+    result = await broadcast(
+        (u["telegram_id"] for u in users),
+        lambda chat_id: bot.send_message(
+            chat_id, announcement, parse_mode="HTML", reply_markup=markup,
+        ),
+        progress=callback.message,
+        render=lambda r: header + progress_line(r) + footer,
+    )
+
+    await deliver(callback.message.chat.id, lambda: callback.message.edit_text(
+        f"{header}"
+        f"📨 Рассылка: отправлено {result.sent}, не доставлено {result.failed}"
+        f"{footer}",
         parse_mode="HTML",
         reply_markup=admin_main_keyboard(),
-    )
+    ))
 
 
 def build_announcement(data: dict, shift_id: int) -> str:
@@ -549,28 +588,33 @@ async def send_reminder_manual(callback: CallbackQuery, bot: Bot):
         )
         return
 
-    from aiogram.utils.keyboard import InlineKeyboardBuilder as IKB
-    sent = 0
-    for m in active:
-        try:
-            kb = IKB()
-            kb.button(text="✅ Подтверждаю", callback_data=f"confirm_shift:{shift_id}")
-            kb.button(text="❌ Не смогу",    callback_data=f"refuse_shift:{shift_id}")
-            kb.adjust(2)
-            await bot.send_message(
-                m["telegram_id"],
-                f"⏰ <b>Напоминание о смене</b>\n\n"
-                f"📅 {shift['date']}\n"
-                f"📍 {shift['address']}\n\n"
-                f"Пожалуйста, подтверди своё участие:",
-                parse_mode="HTML",
-                reply_markup=kb.as_markup(),
-            )
-            sent += 1
-        except Exception:
-            pass
-
-    await callback.answer(f"Напоминание отправлено {sent} участникам", show_alert=True)
+    kb = InlineKeyboardBuilder()
+    kb.button(text="✅ Подтверждаю", callback_data=f"confirm_shift:{shift_id}")
+    kb.button(text="❌ Не смогу",    callback_data=f"refuse_shift:{shift_id}")
+    kb.adjust(2)
+    markup = kb.as_markup()
+    text = (
+        f"⏰ <b>Напоминание о смене</b>\n\n"
+        f"📅 {shift['date']}\n"
+        f"📍 {shift['address']}\n\n"
+        f"Пожалуйста, подтверди своё участие:"
+    )
+
+    await callback.answer("Отправляю напоминание...")
+    progress = await callback.message.answer("📨 Рассылка напоминания...")
+    result = await broadcast(
+        (m["telegram_id"] for m in active),
+        lambda chat_id: bot.send_message(
+            chat_id, text, parse_mode="HTML", reply_markup=markup,
+        ),
+        progress=progress,
+        render=progress_line,
+    )
+
+    await deliver(progress.chat.id, lambda: progress.edit_text(
+        f"⏰ Напоминание отправлено {result.sent} участникам"
+        + (f", не доставлено {result.failed}" if result.failed else "")
+    ))
 
 
 # ─── Завершить смену — рассылка форм отчёта ───────────────────────────────────
@@ -582,64 +626,43 @@ async def finish_shift(callback: CallbackQuery):
         return
 
     shift_id = int(callback.data.split(":")[2])
-    shift = await get_active_shift_by_id(shift_id)
+    # Атомарно: если смену уже завершили (автоматически или повторным нажатием) — None
+    shift, members = await complete_shift(shift_id)
 
     if not shift:
-        await callback.answer("Смена не найдена.", show_alert=True)
+        await callback.answer("Смена не найдена или уже завершена.", show_alert=True)
         return
 
-    await update_shift_status(shift_id, "completed")
-
-    members = await get_shift_members_for_report(shift_id)
+    await unschedule_shift(shift_id)
+    forget_summary(shift_id)
 
     if not members:
         await callback.message.answer("⚠️ Нет участников для отчёта.")
         await callback.answer()
         return
 
-    report_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [
-            InlineKeyboardButton(
-                text="✅ Отработал",
-                callback_data=f"report_worked_{shift_id}",
-            ),
-            InlineKeyboardButton(
-                text="❌ Не смог выйти",
-                callback_data=f"report_failed_{shift_id}",
-            ),
-        ]
-    ])
-
-    sent_count = 0
-    for member in members:
-        try:
-            await callback.bot.send_message(
-                member["telegram_id"],
-                f"📋 <b>Смена завершена!</b>\n\n"
-                f"📍 {shift['city']} | {shift['date']}\n\n"
-                f"Пожалуйста, отметь результат своего участия:",
-                reply_markup=report_kb,
-                parse_mode="HTML",
-            )
-            sent_count += 1
-        except Exception:
-            pass
-
-    summary_kb = InlineKeyboardMarkup(inline_keyboard=[
-        [InlineKeyboardButton(
-            text="📊 Итоговый отчёт",
-            callback_data=f"admin_report_summary_{shift_id}",
-        )]
-    ])
-
-    await callback.message.answer(
+    report_kb = report_keyboard(shift_id)
+    text = report_text(shift)
+
+    await callback.answer()
+    progress = await callback.message.answer("📨 Рассылка форм отчёта...")
+    result = await broadcast(
+        (m["telegram_id"] for m in members),
+        lambda chat_id: callback.bot.send_message(
+            chat_id, text, reply_markup=report_kb, parse_mode="HTML",
+        ),
+        progress=progress,
+        render=progress_line,
+    )
+    sent_count = result.sent
+
+    await deliver(callback.message.chat.id, lambda: callback.message.answer(
         f"✅ <b>Смена завершена!</b>\n\n"
         f"Форма отчёта отправлена <b>{sent_count}</b> участникам.\n"
         f"Когда все ответят — нажми кнопку ниже.",
-        reply_markup=summary_kb,
+        reply_markup=summary_keyboard(shift_id),
         parse_mode="HTML",
-    )
-    await callback.answer()
+    ))
 
 
 # ─── Запросы на разблокировку — Блок 7 ───────────────────────────────────────
@@ -764,9 +787,12 @@ async def excel_send_city_base(callback: CallbackQuery):
         return
     city = callback.data.split(":")[1]
     await callback.answer("Формирую файл...")
-    buf = await excel_city_base(city)
-    file = BufferedInputFile(buf.read(), filename=f"base_{city}.xlsx")
-    await callback.message.answer_document(file, caption=f"📊 База — {city}")
+    version = await get_export_versions(f"city:{city}")
+    await send_export(
+        callback.message, ("city", city, version),
+        lambda: excel_city_base(city),
+        filename=f"base_{city}.xlsx", caption=f"📊 База — {city}",
+    )
 
 
 @router.callback_query(F.data == "excel_choose_shift")
@@ -774,7 +800,7 @@ async def excel_choose_shift(callback: CallbackQuery):
     if not is_admin(callback.from_user.id):
         return
 
-    async with get_db() as db:
+    async with get_db("excel_choose_shift") as db:
         shifts = await db.fetch(
             """
             SELECT id, city, date, address
@@ -805,6 +831,12 @@ async def excel_send_shift_report(callback: CallbackQuery):
         return
     shift_id = int(callback.data.split(":")[1])
     await callback.answer("Формирую файл...")
-    buf = await excel_shift_report(shift_id)
-    file = BufferedInputFile(buf.read(), filename=f"shift_{shift_id}.xlsx")
-    await callback.message.answer_document(file, caption=f"📋 Отчёт по смене #{shift_id}")
\ No newline at end of file
+    # ФИО/телефоны участников — из профилей, поэтому учитываем и версию города
+    shift = await get_shift(shift_id)
+    city = shift["city"] if shift else ""
+    version = await get_export_versions(f"shift:{shift_id}", f"city:{city}")
+    await send_export(
+        callback.message, ("shift", shift_id, version),
+        lambda: excel_shift_report(shift_id),
+        filename=f"shift_{shift_id}.xlsx", caption=f"📋 Отчёт по смене #{shift_id}",
+    )
\ No newline at end of file
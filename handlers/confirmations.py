@@ -5,23 +5,21 @@
 Блок 7 — добавлена логика счётчика отказов/игноров и блокировки
 """
 
+import html
+import logging
+
 from aiogram import Router, F, Bot
 from aiogram.types import CallbackQuery
 from aiogram.filters import StateFilter
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from config import ADMIN_ID
-from database import (
-    get_shift, get_user_shift_membership, update_member_status,
-    get_member_count, get_first_reserve, promote_to_main,
-    increment_stat, get_profile, set_morning_reminder_sent_at,
-    # Блок 7
-    increment_consecutive_failures,
-    reset_consecutive_failures,
-    check_and_block_if_needed,
-)
+from utils.admin_digest import admin_event, admin_alert
+from utils.outbox import outbox, outbox_message
+from utils.timer_heap import MORNING_IGNORES
+from database import confirm_member, refuse_member
 
 router = Router()
+logger = logging.getLogger(__name__)
 
 BLOCK_MESSAGE = (
     "🚫 <b>Ваш аккаунт временно заблокирован.</b>\n\n"
@@ -30,13 +28,6 @@ BLOCK_MESSAGE = (
 )
 
 
-async def notify_admin(bot: Bot, text: str):
-    try:
-        await bot.send_message(ADMIN_ID, text, parse_mode="HTML")
-    except Exception:
-        pass
-
-
 def confirm_keyboard(shift_id: int):
     builder = InlineKeyboardBuilder()
     builder.button(text="✅ Подтверждаю", callback_data=f"confirm_shift:{shift_id}")
@@ -54,33 +45,27 @@ def morning_confirm_keyboard(shift_id: int):
 
 
 # ─── Вечернее подтверждение ───────────────────────────────────────────────────
+# Проверки и все изменения — в confirm_member / refuse_member одной транзакцией.
 
 @router.callback_query(F.data.startswith("confirm_shift:"), StateFilter("*"))
 async def confirm_shift(callback: CallbackQuery, bot: Bot):
     shift_id = int(callback.data.split(":")[1])
-    shift = await get_shift(shift_id)
-    if not shift:
+    result = await confirm_member(shift_id, callback.from_user.id)
+    if not result:
         await callback.answer("❌ Смена не найдена", show_alert=True)
         return
-
-    member = await get_user_shift_membership(shift_id, callback.from_user.id)
-    if not member:
+    if not result["member_type"]:
         await callback.answer("Ты не записан на эту смену", show_alert=True)
         return
-    if member["status"] == "confirmed":
+    if result["prev_status"] == "confirmed":
         await callback.answer("Ты уже подтвердил ✅", show_alert=True)
         return
-    if member["status"] in ("refused", "removed"):
+    if result["prev_status"] in ("refused", "removed"):
         await callback.answer("Ты снят с этой смены", show_alert=True)
         return
 
-    await update_member_status(shift_id, callback.from_user.id, "confirmed")
-    await increment_stat(callback.from_user.id, "confirmed_shifts")
-
-    # Блок 7: сброс счётчика провалов при подтверждении
-    await reset_consecutive_failures(callback.from_user.id)
-
-    slot = member["member_type"]
+    shift = result["shift"]
+    slot = result["member_type"]
 
     if slot == "main":
         text = (
@@ -101,15 +86,9 @@ async def confirm_shift(callback: CallbackQuery, bot: Bot):
 
     await callback.message.edit_text(text, parse_mode="HTML")
 
-    profile = await get_profile(callback.from_user.id)
-    name = profile.get("full_name", "Без имени") if profile else "Без имени"
+    name = result["full_name"] or "Без имени"
     slot_label = "основной состав" if slot == "main" else "резерв"
-    await notify_admin(
-        bot,
-        f"✅ <b>Подтверждение</b>\n"
-        f"👤 {name} | {slot_label}\n"
-        f"📅 {shift['date']} | {shift['city']}",
-    )
+    admin_event("confirm", shift, f"{name} ({slot_label})")
 
 
 # ─── Утреннее подтверждение готовности ───────────────────────────────────────
@@ -117,21 +96,15 @@ async def confirm_shift(callback: CallbackQuery, bot: Bot):
 @router.callback_query(F.data.startswith("morning_confirm:"), StateFilter("*"))
 async def morning_confirm(callback: CallbackQuery, bot: Bot):
     shift_id = int(callback.data.split(":")[1])
-    shift = await get_shift(shift_id)
-    if not shift:
+    result = await confirm_member(shift_id, callback.from_user.id, morning=True)
+    if not result:
         await callback.answer("❌ Смена не найдена", show_alert=True)
         return
-
-    member = await get_user_shift_membership(shift_id, callback.from_user.id)
-    if not member or member["status"] in ("refused", "removed"):
+    if not result["member_type"] or result["prev_status"] in ("refused", "removed"):
         await callback.answer("Ты снят с этой смены", show_alert=True)
         return
 
-    await update_member_status(shift_id, callback.from_user.id, "confirmed")
-
-    # Блок 7: сброс счётчика провалов при утреннем подтверждении
-    await reset_consecutive_failures(callback.from_user.id)
-
+    shift = result["shift"]
     await callback.message.edit_text(
         f"💪 <b>Отлично, ждём тебя!</b>\n\n"
         f"📅 {shift['date']}\n"
@@ -141,14 +114,7 @@ async def morning_confirm(callback: CallbackQuery, bot: Bot):
         parse_mode="HTML",
     )
 
-    profile = await get_profile(callback.from_user.id)
-    name = profile.get("full_name", "Без имени") if profile else "Без имени"
-    await notify_admin(
-        bot,
-        f"🌅 <b>Утреннее подтверждение</b>\n"
-        f"👤 {name} подтвердил готовность\n"
-        f"📅 {shift['date']} | {shift['city']}",
-    )
+    admin_event("morning_confirm", shift, result["full_name"] or "Без имени")
 
 
 # ─── Отказ (вечер или утро) ───────────────────────────────────────────────────
@@ -156,35 +122,29 @@ async def morning_confirm(callback: CallbackQuery, bot: Bot):
 @router.callback_query(F.data.startswith("refuse_shift:"), StateFilter("*"))
 async def refuse_shift(callback: CallbackQuery, bot: Bot):
     shift_id = int(callback.data.split(":")[1])
-    shift = await get_shift(shift_id)
-    if not shift:
+    telegram_id = callback.from_user.id
+    result = await refuse_member(shift_id, telegram_id, render_promotion=promotion_notice)
+    if not result:
         await callback.answer("❌ Смена не найдена", show_alert=True)
         return
-
-    member = await get_user_shift_membership(shift_id, callback.from_user.id)
-    if not member:
+    if not result["member_type"]:
         await callback.answer("Ты не записан на эту смену", show_alert=True)
         return
-    if member["status"] in ("refused", "removed"):
+    if result["prev_status"] in ("refused", "removed"):
         await callback.answer("Ты уже снят с этой смены", show_alert=True)
         return
 
-    telegram_id = callback.from_user.id
-
-    await update_member_status(shift_id, telegram_id, "refused")
-    await increment_stat(telegram_id, "refused_shifts")
-
-    # Блок 7: счётчик + проверка блокировки
-    await increment_consecutive_failures(telegram_id)
-    blocked = await check_and_block_if_needed(telegram_id)
+    shift = result["shift"]
+    promoted = result["promoted"]
+    if promoted:
+        outbox.wake()
 
-    if blocked:
+    if result["blocked"]:
         await callback.message.edit_text(BLOCK_MESSAGE, parse_mode="HTML")
-        await notify_admin(
-            bot,
+        admin_alert(
             f"🚫 <b>Сотрудник заблокирован</b>\n"
             f"👤 ID {telegram_id} | 4 отказа/игнора подряд\n"
-            f"📅 {shift['date']} | {shift['city']}",
+            f"📅 {html.escape(shift['date'])} | {shift['city']}",
         )
     else:
         await callback.message.edit_text(
@@ -194,189 +154,155 @@ async def refuse_shift(callback: CallbackQuery, bot: Bot):
             parse_mode="HTML",
         )
 
-    slot_type = member["member_type"]
-    profile = await get_profile(telegram_id)
-    name = profile.get("full_name", "Без имени") if profile else "Без имени"
+    slot_type = result["member_type"]
+    name = result["full_name"] or "Без имени"
 
-    if slot_type == "main":
-        await _promote_first_reserve(bot, shift, shift_id)
+    report_promotions(shift, promoted, vacated=1 if slot_type == "main" else 0)
 
-    await notify_admin(
-        bot,
-        f"❌ <b>Отказ от смены</b>\n"
-        f"👤 {name} | {'основной состав' if slot_type == 'main' else 'резерв'}\n"
-        f"📅 {shift['date']} | {shift['city']}",
-    )
+    admin_event("refuse", shift, f"{name} ({'основной состав' if slot_type == 'main' else 'резерв'})")
 
 
-# ─── Автоснятие за игнор (вечер, 30 мин) ─────────────────────────────────────
+# ─── Автоснятие за игнор ──────────────────────────────────────────────────────
+# Снятия, счётчики и перевод резерва делает remove_ignored_members() одной
+# транзакцией по всем сменам; сообщения снятому (ignored_notice) и переведённым
+# (promotion_notice) уходят в outbox там же. Здесь — только сводка админу.
 
-async def auto_remove_ignored(bot: Bot, shift_id: int, telegram_id: int):
-    shift = await get_shift(shift_id)
-    if not shift:
-        return
-    member = await get_user_shift_membership(shift_id, telegram_id)
-    if not member or member["status"] != "registered":
-        return
+def _shift_from_removed(removed: dict) -> dict:
+    return {
+        "id": removed["shift_id"],
+        "city": removed["city"],
+        "date": removed["date"],
+        "address": removed["address"],
+        "payment": removed["payment"],
+        "main_slots": removed["main_slots"],
+        "morning_reminder_time": removed["morning_reminder_time"],
+    }
 
-    await update_member_status(shift_id, telegram_id, "removed")
-    await increment_stat(telegram_id, "ignored_shifts")
-
-    # Блок 7: счётчик + проверка блокировки
-    await increment_consecutive_failures(telegram_id)
-    blocked = await check_and_block_if_needed(telegram_id)
-
-    try:
-        if blocked:
-            await bot.send_message(telegram_id, BLOCK_MESSAGE, parse_mode="HTML")
-        else:
-            await bot.send_message(
-                telegram_id,
-                f"⚠️ <b>Ты снят со смены за игнор напоминания</b>\n\n"
-                f"📅 {shift['date']} | {shift['address']}\n\n"
-                f"Ты не ответил в течение 30 минут.\n"
-                f"⚠️ Это влияет на твой рейтинг. После 4 игноров подряд — аккаунт блокируется.",
-                parse_mode="HTML",
-            )
-    except Exception:
-        pass
-
-    profile = await get_profile(telegram_id)
-    name = profile.get("full_name", f"ID {telegram_id}") if profile else f"ID {telegram_id}"
-
-    if member["member_type"] == "main":
-        await _promote_first_reserve(bot, shift, shift_id)
-
-    admin_text = (
-        f"🚫 <b>Сотрудник заблокирован после игнора</b>\n"
-        if blocked else
-        f"⏰ <b>Автоснятие за игнор (вечер)</b>\n"
-    )
-    await notify_admin(
-        bot,
-        admin_text +
-        f"👤 {name}\n"
-        f"📅 {shift['date']} | {shift['city']}",
-    )
 
+def ignored_notice(removed: dict, morning: bool = False) -> list[dict]:
+    """Сообщение снятому за игнор: вечер — 30 мин, утро — 10 мин."""
+    telegram_id = removed["telegram_id"]
+    if removed["blocked"]:
+        text = BLOCK_MESSAGE
+    elif morning:
+        text = (
+            f"⚠️ <b>Ты снят со смены</b>\n\n"
+            f"Не подтвердил готовность утром в течение 10 минут.\n"
+            f"📅 {removed['date']} | {removed['address']}\n\n"
+            f"⚠️ Это влияет на твой рейтинг."
+        )
+    else:
+        text = (
+            f"⚠️ <b>Ты снят со смены за игнор напоминания</b>\n\n"
+            f"📅 {removed['date']} | {removed['address']}\n\n"
+            f"Ты не ответил в течение 30 минут.\n"
+            f"⚠️ Это влияет на твой рейтинг. После 4 игноров подряд — аккаунт блокируется."
+        )
+    key = f"ignored:{removed['shift_id']}:{telegram_id}:{'morning' if morning else 'evening'}"
+    return [outbox_message(key, telegram_id, text)]
 
-# ─── Автоснятие за утренний игнор (10 мин) ───────────────────────────────────
 
-async def auto_remove_morning_ignored(bot: Bot, shift_id: int, telegram_id: int):
-    shift = await get_shift(shift_id)
-    if not shift:
-        return
-    member = await get_user_shift_membership(shift_id, telegram_id)
-    if not member or member["status"] != "registered":
-        return
+def morning_ignored_notice(removed: dict) -> list[dict]:
+    return ignored_notice(removed, morning=True)
 
-    await update_member_status(shift_id, telegram_id, "removed")
-    await increment_stat(telegram_id, "ignored_shifts")
-
-    # Блок 7: счётчик + проверка блокировки
-    await increment_consecutive_failures(telegram_id)
-    blocked = await check_and_block_if_needed(telegram_id)
-
-    try:
-        if blocked:
-            await bot.send_message(telegram_id, BLOCK_MESSAGE, parse_mode="HTML")
-        else:
-            await bot.send_message(
-                telegram_id,
-                f"⚠️ <b>Ты снят со смены</b>\n\n"
-                f"Не подтвердил готовность утром в течение 10 минут.\n"
-                f"📅 {shift['date']} | {shift['address']}\n\n"
-                f"⚠️ Это влияет на твой рейтинг.",
-                parse_mode="HTML",
-            )
-    except Exception:
-        pass
-
-    profile = await get_profile(telegram_id)
-    name = profile.get("full_name", f"ID {telegram_id}") if profile else f"ID {telegram_id}"
-
-    await _promote_first_reserve(bot, shift, shift_id, morning=True)
-
-    admin_text = (
-        f"🚫 <b>Сотрудник заблокирован после утреннего игнора</b>\n"
-        if blocked else
-        f"⏰ <b>Автоснятие за игнор (утро)</b>\n"
-    )
-    await notify_admin(
-        bot,
-        admin_text +
-        f"👤 {name}\n"
-        f"📅 {shift['date']} | {shift['city']}",
-    )
 
+def notify_ignored_removed(removed: list[dict], promoted: list[dict], morning: bool = False):
+    """Сводка админу по снятым за игнор и переводу резерва на их места — по сменам."""
+    shifts: dict[int, dict] = {}
+    vacated: dict[int, int] = {}
+    for member in removed:
+        shifts.setdefault(member["shift_id"], _shift_from_removed(member))
+        vacated[member["shift_id"]] = vacated.get(member["shift_id"], 0) + 1
+        _report_ignored(member, morning)
 
-# ─── Поднять первого из резерва ───────────────────────────────────────────────
+    for shift_id, shift in shifts.items():
+        report_promotions(
+            shift, [p for p in promoted if p["shift_id"] == shift_id],
+            vacated=vacated[shift_id], morning=morning,
+        )
 
-async def _promote_first_reserve(bot: Bot, shift: dict, shift_id: int, morning: bool = False):
-    import logging
-    logger = logging.getLogger(__name__)
 
-    reserve = await get_first_reserve(shift_id)
-    logger.info(f"[PROMOTE] shift={shift_id}, reserve найден: {reserve}")
-    if not reserve:
-        logger.warning(f"[PROMOTE] Резерв не найден для смены {shift_id}")
-        return
+def _report_ignored(removed: dict, morning: bool):
+    shift = _shift_from_removed(removed)
+    telegram_id = removed["telegram_id"]
+    name = removed.get("full_name") or f"ID {telegram_id}"
 
-    logger.info(f"[PROMOTE] Переводим {reserve['telegram_id']} в основу")
+    if removed["blocked"]:
+        admin_text = (
+            f"🚫 <b>Сотрудник заблокирован после утреннего игнора</b>\n"
+            if morning else
+            f"🚫 <b>Сотрудник заблокирован после игнора</b>\n"
+        )
+        admin_alert(
+            admin_text +
+            f"👤 {html.escape(name)}\n"
+            f"📅 {html.escape(shift['date'])} | {shift['city']}",
+        )
+    else:
+        admin_event("ignored", shift, f"{name} ({'утро' if morning else 'вечер'})")
 
-    main_count = await get_member_count(shift_id, "main")
-    new_position = main_count + 1
-    await promote_to_main(shift_id, reserve["telegram_id"], new_position)
 
+# ─── Перевод из резерва ───────────────────────────────────────────────────────
+
+def promotion_notice(shift: dict, promoted: dict, morning: bool = False) -> list[dict]:
+    """Сообщение переведённому в основу (ставится в outbox вместе с переводом)."""
+    shift_id = promoted["shift_id"]
     morning_time = shift.get("morning_reminder_time", "8:00")
 
-    try:
-        kb = InlineKeyboardBuilder()
-        kb.button(
-            text="✅ Готов!",
-            callback_data=f"morning_confirm:{shift_id}" if morning else f"confirm_shift:{shift_id}",
+    kb = InlineKeyboardBuilder()
+    kb.button(
+        text="✅ Готов!",
+        callback_data=f"morning_confirm:{shift_id}" if morning else f"confirm_shift:{shift_id}",
+    )
+    kb.button(text="❌ Не смогу", callback_data=f"refuse_shift:{shift_id}")
+    kb.adjust(2)
+
+    if morning:
+        text = (
+            f"🎉 <b>Для тебя нашлось место в основном составе!</b>\n\n"
+            f"📅 {shift['date']}\n"
+            f"📍 {shift['address']}\n"
+            f"💰 {shift['payment']}\n\n"
+            f"⚡ Подтверди готовность в течение <b>10 минут</b>!\n"
+            f"⚠️ Если не ответишь — место перейдёт следующему."
         )
-        kb.button(text="❌ Не смогу", callback_data=f"refuse_shift:{shift_id}")
-        kb.adjust(2)
-
-        if morning:
-            text = (
-                f"🎉 <b>Для тебя нашлось место в основном составе!</b>\n\n"
-                f"📅 {shift['date']}\n"
-                f"📍 {shift['address']}\n"
-                f"💰 {shift['payment']}\n\n"
-                f"⚡ Подтверди готовность в течение <b>10 минут</b>!\n"
-                f"⚠️ Если не ответишь — место перейдёт следующему."
-            )
-        else:
-            text = (
-                f"🎉 <b>Поздравляем! Тебя переводят в основной состав!</b>\n\n"
-                f"📅 {shift['date']}\n"
-                f"📍 {shift['address']}\n"
-                f"💰 {shift['payment']}\n\n"
-                f"Утром в <b>{morning_time}</b> придёт финальное подтверждение готовности.\n"
-                f"⚠️ Если не ответишь — будешь снят автоматически. Будь на связи! 📱"
-            )
-
-        await bot.send_message(
-            reserve["telegram_id"], text,
-            parse_mode="HTML", reply_markup=kb.as_markup(),
+        # Отсчёт 10 минут — от фактической отправки, его отметит outbox
+        on_sent = {
+            "stamp": "morning_reminder_sent_at",
+            "shift_id": shift_id,
+            "ignore_check": MORNING_IGNORES,
+        }
+    else:
+        text = (
+            f"🎉 <b>Поздравляем! Тебя переводят в основной состав!</b>\n\n"
+            f"📅 {shift['date']}\n"
+            f"📍 {shift['address']}\n"
+            f"💰 {shift['payment']}\n\n"
+            f"Утром в <b>{morning_time}</b> придёт финальное подтверждение готовности.\n"
+            f"⚠️ Если не ответишь — будешь снят автоматически. Будь на связи! 📱"
         )
-        if morning:
-            await set_morning_reminder_sent_at(shift_id, reserve["telegram_id"])
+        on_sent = None
 
-    except Exception:
-        pass
+    return [outbox_message(
+        f"promote:{shift_id}:{promoted['telegram_id']}", promoted["telegram_id"], text,
+        reply_markup=kb.as_markup(), on_sent=on_sent,
+    )]
 
-    profile = await get_profile(reserve["telegram_id"])
-    name = (
-        profile.get("full_name", f"ID {reserve['telegram_id']}")
-        if profile else f"ID {reserve['telegram_id']}"
-    )
-    await notify_admin(
-        bot,
-        f"🔄 <b>Резерв переведён в основу</b>\n"
-        f"👤 {name}\n"
-        f"📅 {shift['date']} | {shift['city']}"
-        + (" (утренняя замена)" if morning else ""),
-    )
+
+def morning_promotion_notice(shift: dict, promoted: dict) -> list[dict]:
+    return promotion_notice(shift, promoted, morning=True)
+
+
+def report_promotions(shift: dict, promoted: list[dict], vacated: int, morning: bool = False):
+    """Админу: кто переведён из резерва; если освободившиеся места не закрыты — тревога."""
+    for p in promoted:
+        logger.info(f"[PROMOTE] shift={shift['id']}: {p['telegram_id']} → основа (#{p['position']})")
+        name = p.get("full_name") or f"ID {p['telegram_id']}"
+        admin_event("promoted", shift, name + (" (утренняя замена)" if morning else ""))
+
+    if len(promoted) < vacated:
+        logger.warning(f"[PROMOTE] Резерв не найден для смены {shift['id']}")
+        admin_alert(
+            f"⚠️ <b>Резерв пуст — место в основе не закрыто</b>\n"
+            f"📅 {html.escape(shift['date'])} | {shift['city']}",
+        )
@@ -3,16 +3,15 @@ from aiogram.types import Message, CallbackQuery
 from aiogram.fsm.context import FSMContext
 from aiogram.utils.keyboard import InlineKeyboardBuilder
 
-from config import ADMIN_ID
 from database import (
     get_profile,
     upsert_profile,
     get_shift,
     get_active_shift_by_id,   # ← исправлено: импортируется из database.py
-    get_member_count,
-    add_shift_member,
-    get_user_shift_membership,
+    get_signup_state,
+    reserve_slot,
 )
+from utils.admin_digest import admin_event
 from utils.states import RegistrationStates
 
 router = Router()
@@ -36,33 +35,23 @@ def slot_keyboard(shift_id: int, main_free: int, reserve_free: int):
     return builder.as_markup()
 
 
-async def notify_admin(bot, text: str):
-    try:
-        await bot.send_message(ADMIN_ID, text, parse_mode="HTML")
-    except Exception:
-        pass
-
-
 # ─── Step 1: нажали «Записаться» ─────────────────────────────────────────────
 
 @router.callback_query(F.data.startswith("register_shift:"))
 async def start_register(callback: CallbackQuery, state: FSMContext):
     shift_id = int(callback.data.split(":")[1])
-    shift = await get_active_shift_by_id(shift_id)
+    shift = await get_signup_state(shift_id, callback.from_user.id)
 
     if not shift:
         await callback.answer("❌ Смена уже недоступна", show_alert=True)
         return
 
-    already = await get_user_shift_membership(shift_id, callback.from_user.id)
-    if already:
+    if shift["is_member"]:
         await callback.answer("⚠️ Ты уже записан на эту смену", show_alert=True)
         return
 
-    main_taken = await get_member_count(shift_id, "main")
-    reserve_taken = await get_member_count(shift_id, "reserve")
-    main_free = max(0, shift["main_slots"] - main_taken)
-    reserve_free = max(0, shift["reserve_slots"] - reserve_taken)
+    main_free = max(0, shift["main_slots"] - shift["main_taken"])
+    reserve_free = max(0, shift["reserve_slots"] - shift["reserve_taken"])
 
     if main_free == 0 and reserve_free == 0:
         await callback.answer("😔 Все места заняты", show_alert=True)
@@ -161,22 +150,24 @@ async def finalize_registration(event, state: FSMContext, profile: dict, shift:
     slot_type = data.get("slot_type", "main")
     telegram_id = event.from_user.id
 
-    # Считаем позицию
-    count = await get_member_count(shift_id, slot_type)
-    slots_total = shift["main_slots"] if slot_type == "main" else shift["reserve_slots"]
+    # Проверка мест, позиция и вставка — атомарно, одним запросом
+    slot = await reserve_slot(shift_id, telegram_id, slot_type)
+    await state.clear()
 
-    if count >= slots_total:
-        await state.clear()
-        msg = "😔 Место только что заняли. Попробуй другой тип записи."
+    if slot["outcome"] != "ok":
+        msg = {
+            "full": "😔 Место только что заняли. Попробуй другой тип записи.",
+            "already": "⚠️ Ты уже записан на эту смену",
+            "closed": "❌ Смена уже недоступна.",
+        }[slot["outcome"]]
         if hasattr(event, "message"):
             await event.message.edit_text(msg)
         else:
             await event.answer(msg)
         return
 
-    position = count + 1
-    await add_shift_member(shift_id, telegram_id, slot_type, position)
-    await state.clear()
+    position = slot["slot_position"]
+    new_count, slots_total = slot["taken"], slot["total"]
 
     slot_label = "основной состав" if slot_type == "main" else "резерв"
     confirm_text = (
@@ -190,20 +181,14 @@ async def finalize_registration(event, state: FSMContext, profile: dict, shift:
 
     if hasattr(event, "message"):
         await event.message.edit_text(confirm_text, parse_mode="HTML")
-        bot = event.message.bot
     else:
         await event.answer(confirm_text, parse_mode="HTML")
-        bot = event.bot
-
-    # Уведомление админу
-    new_count = await get_member_count(shift_id, slot_type)
-    admin_text = (
-        f"🔔 <b>Новая запись на смену</b>\n"
-        f"👤 {profile.get('full_name', 'Без имени')} (@{event.from_user.username or 'нет'})\n"
-        f"📅 {shift['date']} | {shift['city']}\n"
-        f"Тип: {slot_label} ({new_count}/{slots_total})"
+
+    # Уведомление админу — в сводку
+    admin_event(
+        "signup", shift,
+        f"{profile.get('full_name', 'Без имени')} (@{event.from_user.username or 'нет'}, "
+        f"{slot_label} {new_count}/{slots_total})",
     )
     if new_count == slots_total:
-        admin_text += f"\n\n🎉 <b>{'Основной состав' if slot_type == 'main' else 'Резерв'} заполнен!</b>"
-
-    await notify_admin(bot, admin_text)
+        admin_event("filled", shift, "Основной состав" if slot_type == "main" else "Резерв")
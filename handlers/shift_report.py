@@ -1,7 +1,13 @@
+import asyncio
+import html
+import logging
+import time
+
 from aiogram import Router, F
 from aiogram.types import CallbackQuery, Message, InlineKeyboardMarkup, InlineKeyboardButton
 from aiogram.fsm.context import FSMContext
 from aiogram.filters import StateFilter
+from aiogram.exceptions import TelegramBadRequest
 
 from config import ADMIN_ID
 from database import (
@@ -9,39 +15,179 @@ from database import (
     get_shift_result,
     get_shift_results_full,
     get_active_shift_by_id,
+    set_shift_summary_message,
 )
+from utils.outbox import outbox_message
 from utils.states import ShiftReportStates
 
 router = Router()
+logger = logging.getLogger(__name__)
+
+
+# ─── Форма отчёта ─────────────────────────────────────────────────────────────
+# Рассылается при завершении смены: вручную (admin.finish_shift) или автоматически
+# на следующий день после даты смены (scheduler.job_complete_shift).
+
+def report_keyboard(shift_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [
+            InlineKeyboardButton(
+                text="✅ Отработал",
+                callback_data=f"report_worked_{shift_id}",
+            ),
+            InlineKeyboardButton(
+                text="❌ Не смог выйти",
+                callback_data=f"report_failed_{shift_id}",
+            ),
+        ]
+    ])
+
+
+def report_text(shift: dict) -> str:
+    return (
+        f"📋 <b>Смена завершена!</b>\n\n"
+        f"📍 {shift['city']} | {html.escape(shift['date'])}\n\n"
+        f"Пожалуйста, отметь результат своего участия:"
+    )
 
 
-# ─── Вспомогательная функция: отправить итог админу ───────────────────────────
-
-async def send_admin_summary(bot, shift_id: int, shift_info: dict):
+def summary_keyboard(shift_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup(inline_keyboard=[
+        [InlineKeyboardButton(
+            text="📊 Итоговый отчёт",
+            callback_data=f"admin_report_summary_{shift_id}",
+        )]
+    ])
+
+
+def report_messages(shift: dict, members: list[dict]) -> list[dict]:
+    """Автозавершение: формы участникам и уведомление админу — сообщения outbox."""
+    text, markup = report_text(shift), report_keyboard(shift["id"])
+    messages = [
+        outbox_message(f"report:{shift['id']}:{m['telegram_id']}", m["telegram_id"], text, markup)
+        for m in members
+    ]
+    messages.append(outbox_message(
+        f"report_admin:{shift['id']}", ADMIN_ID,
+        f"🏁 <b>Смена завершена автоматически</b>\n\n"
+        f"📍 {shift['city']} | {html.escape(shift['date'])}\n"
+        f"Форма отчёта отправлена <b>{len(members)}</b> участникам.\n"
+        f"Когда все ответят — нажми кнопку ниже.",
+        summary_keyboard(shift["id"]),
+    ))
+    return messages
+
+
+# ─── Живая сводка у админа ────────────────────────────────────────────────────
+# Одно сообщение на смену, которое правится по мере поступления отчётов.
+# Отчёты, пришедшие в течение SUMMARY_EDIT_INTERVAL секунд, дают одну правку.
+
+SUMMARY_EDIT_INTERVAL = 5
+MESSAGE_LIMIT = 4000  # Telegram режет на 4096
+# Место под строку «… и ещё N» — всегда остаётся свободным
+OVERFLOW_RESERVE = 40
+# Состояние сводки в памяти держим, пока по смене идут отчёты
+SUMMARY_RETENTION = 3600
+
+_summary_tasks: dict[int, asyncio.Task] = {}
+_summary_last_edit: dict[int, float] = {}
+_summary_messages: dict[int, int] = {}
+
+
+def forget_summary(*shift_ids: int):
+    """Смена завершена/в архиве или отчёты давно не идут — id сообщения остаётся в базе."""
+    for shift_id in shift_ids:
+        _summary_last_edit.pop(shift_id, None)
+        _summary_messages.pop(shift_id, None)
+
+
+def _prune_summaries():
+    now = time.monotonic()
+    forget_summary(*(
+        shift_id for shift_id, at in _summary_last_edit.items()
+        if now - at > SUMMARY_RETENTION and shift_id not in _summary_tasks
+    ))
+
+
+def _summary_text(shift_info: dict, worked: list, not_worked: list, no_response: list) -> str:
+    header = (
+        f"📊 <b>Текущий итог смены</b>\n"
+        f"📍 {shift_info['city']} | {html.escape(shift_info['date'])}\n"
+    )
+    lines = [header]
+    length = len(header)
+
+    def tag(r):
+        return "🔵осн." if r['member_type'] == 'main' else "🟡рез."
+
+    def person(r):
+        return f"  {tag(r)} {html.escape(r['full_name'] or '')} | {html.escape(r['phone'] or '')}"
+
+    def reason(r):
+        return f"\n    ↳ {html.escape(r['decline_reason'] or 'причина не указана')}"
+
+    sections = [
+        (f"✅ <b>Отработали ({len(worked)}):</b>", worked, person),
+        (f"\n❌ <b>Не вышли ({len(not_worked)}):</b>", not_worked, lambda r: person(r) + reason(r)),
+        (f"\n⏳ <b>Не ответили ({len(no_response)}):</b>", no_response, person),
+    ]
+    # Каждый кусок — заголовок раздела или строка — влезает, только если после него
+    # остаётся OVERFLOW_RESERVE: тогда строка «… и ещё N» не выведет за лимит
+    for i, (title, rows, render) in enumerate(sections):
+        if not rows:
+            continue
+        for n, piece in enumerate([title] + [render(r) for r in rows]):
+            if length + len(piece) + 1 + OVERFLOW_RESERVE > MESSAGE_LIMIT:
+                rest = len(rows) - max(n - 1, 0) + sum(len(r) for _, r, _ in sections[i + 1:])
+                lines.append(f"  … и ещё {rest}")
+                return "\n".join(lines)
+            lines.append(piece)
+            length += len(piece) + 1
+    return "\n".join(lines)
+
+
+async def send_admin_summary(bot, shift_id: int, shift_info: dict, new_message: bool = False):
+    """Обновить сводку смены (или прислать новую — по запросу админа / если старую не править)."""
     worked, not_worked, no_response = await get_shift_results_full(shift_id)
-
-    lines = [f"📊 <b>Текущий итог смены</b>\n📍 {shift_info['city']} | {shift_info['date']}\n"]
-
-    if worked:
-        lines.append(f"✅ <b>Отработали ({len(worked)}):</b>")
-        for r in worked:
-            tag = "🔵осн." if r['member_type'] == 'main' else "🟡рез."
-            lines.append(f"  {tag} {r['full_name']} | {r['phone']}")
-
-    if not_worked:
-        lines.append(f"\n❌ <b>Не вышли ({len(not_worked)}):</b>")
-        for r in not_worked:
-            tag = "🔵осн." if r['member_type'] == 'main' else "🟡рез."
-            reason = r['decline_reason'] or "причина не указана"
-            lines.append(f"  {tag} {r['full_name']} | {r['phone']}\n    ↳ {reason}")
-
-    if no_response:
-        lines.append(f"\n⏳ <b>Не ответили ({len(no_response)}):</b>")
-        for r in no_response:
-            tag = "🔵осн." if r['member_type'] == 'main' else "🟡рез."
-            lines.append(f"  {tag} {r['full_name']} | {r['phone']}")
-
-    await bot.send_message(ADMIN_ID, "\n".join(lines), parse_mode="HTML")
+    text = _summary_text(shift_info, worked, not_worked, no_response)
+
+    message_id = _summary_messages.get(shift_id) or shift_info.get("summary_message_id")
+    if message_id and not new_message:
+        try:
+            await bot.edit_message_text(
+                text, chat_id=ADMIN_ID, message_id=message_id, parse_mode="HTML",
+            )
+            return
+        except TelegramBadRequest as e:
+            if "not modified" in str(e):
+                return
+            logger.warning(f"Сводка смены {shift_id}: не удалось обновить ({e}), шлём новую")
+
+    sent = await bot.send_message(ADMIN_ID, text, parse_mode="HTML")
+    _summary_messages[shift_id] = sent.message_id
+    await set_shift_summary_message(shift_id, sent.message_id)
+
+
+async def _debounced_summary(bot, shift_id: int, shift_info: dict):
+    try:
+        wait = _summary_last_edit.get(shift_id, 0) + SUMMARY_EDIT_INTERVAL - time.monotonic()
+        if wait > 0:
+            await asyncio.sleep(wait)
+        # Отчёты, пришедшие пока строим сводку, запланируют следующую правку
+        _summary_tasks.pop(shift_id, None)
+        _summary_last_edit[shift_id] = time.monotonic()
+        await send_admin_summary(bot, shift_id, shift_info)
+    except Exception as e:
+        logger.error(f"Сводка смены {shift_id}: {e}")
+    finally:
+        if _summary_tasks.get(shift_id) is asyncio.current_task():
+            del _summary_tasks[shift_id]
+
+
+def schedule_admin_summary(bot, shift_id: int, shift_info: dict):
+    _prune_summaries()
+    if shift_id not in _summary_tasks:
+        _summary_tasks[shift_id] = asyncio.create_task(_debounced_summary(bot, shift_id, shift_info))
 
 
 # ─── Нажал «Отработал ✅» ──────────────────────────────────────────────────────
@@ -71,7 +217,7 @@ async def handle_report_worked(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
     # Уведомляем админа
-    await send_admin_summary(callback.bot, shift_id, shift)
+    schedule_admin_summary(callback.bot, shift_id, shift)
 
 
 # ─── Нажал «Не смог выйти ❌» ─────────────────────────────────────────────────
@@ -137,7 +283,7 @@ async def handle_decline_reason(message: Message, state: FSMContext):
 
     # Уведомляем админа
     if shift:
-        await send_admin_summary(message.bot, shift_id, shift)
+        schedule_admin_summary(message.bot, shift_id, shift)
 
 
 # ─── Команда админа: запросить итоговый отчёт ─────────────────────────────────
@@ -155,6 +301,6 @@ async def admin_request_summary(callback: CallbackQuery):
         await callback.answer("Смена не найдена.", show_alert=True)
         return
 
-    await send_admin_summary(callback.bot, shift_id, shift)
+    await send_admin_summary(callback.bot, shift_id, shift, new_message=True)
     await callback.answer("Итог отправлен 👆")
     
\ No newline at end of file
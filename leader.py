@@ -0,0 +1,140 @@
+"""
+Выбор лидера планировщика при запуске нескольких процессов бота.
+В режиме webhook все процессы обрабатывают обновления, но напоминания и проверки
+игнора выполняет только тот, кто держит advisory lock в Postgres. Lock живёт вместе
+с отдельным соединением: процесс упал или потерял базу — соединение закрылось,
+lock освободился, и следующий процесс забирает его за LEADER_RETRY_INTERVAL.
+
+В режиме polling getUpdates по токену может читать только один процесс (второму
+Telegram отвечает 409 Conflict), поэтому там несколько процессов не запускаются:
+второй экземпляр не получит POLLING_LOCK_KEY и остановится (см. acquire_polling_lock).
+"""
+
+import asyncio
+import json
+import logging
+from datetime import datetime
+
+import asyncpg
+from aiogram import Bot
+
+from config import DATABASE_URL, LEADER_RETRY_INTERVAL, LEADER_HEARTBEAT
+from database import get_shift, notify_timers, TIMERS_CHANNEL
+from scheduler import setup_scheduler, ReminderScheduler
+from utils.timer_heap import set_publisher, arm_shift, disarm_shift, arm_ignore_check
+
+logger = logging.getLogger(__name__)
+
+SCHEDULER_LOCK_KEY = 7_401_002
+POLLING_LOCK_KEY = 7_401_003
+
+
+async def _connect() -> asyncpg.Connection:
+    conn = await asyncpg.connect(DATABASE_URL)
+    # Оборвавшуюся связь с держателем lock база заметит за ~10 с, а не за часы
+    await conn.execute(
+        "SET tcp_keepalives_idle = 5; SET tcp_keepalives_interval = 2; "
+        "SET tcp_keepalives_count = 3"
+    )
+    return conn
+
+
+async def acquire_polling_lock() -> asyncpg.Connection:
+    """
+    Polling — только в одном процессе. Соединение держит lock, пока открыто;
+    закрыть его при остановке. Lock занят — RuntimeError: для нескольких
+    процессов нужен BOT_MODE=webhook.
+    """
+    conn = await _connect()
+    if not await conn.fetchval("SELECT pg_try_advisory_lock($1)", POLLING_LOCK_KEY):
+        await conn.close()
+        raise RuntimeError(
+            "Другой процесс бота уже работает в режиме polling. "
+            "Несколько процессов — только с BOT_MODE=webhook."
+        )
+    return conn
+
+
+class LeaderElection:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self.scheduler: ReminderScheduler | None = None
+        self._task: asyncio.Task | None = None
+        # Цикл событий держит задачи слабыми ссылками — без этого событие может пропасть
+        self._pending: set[asyncio.Task] = set()
+
+    @property
+    def is_leader(self) -> bool:
+        return self.scheduler is not None
+
+    def start(self):
+        # Пока lock не взят, события из хендлеров уходят лидеру (возможно, себе же)
+        set_publisher(notify_timers)
+        self._task = asyncio.create_task(self._run())
+
+    def shutdown(self):
+        if self._task:
+            self._task.cancel()
+        for task in self._pending:
+            task.cancel()
+        self._pending.clear()
+        self._step_down()
+
+    async def _run(self):
+        while True:
+            conn = None
+            try:
+                conn = await _connect()
+                while not await conn.fetchval("SELECT pg_try_advisory_lock($1)", SCHEDULER_LOCK_KEY):
+                    await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+                await conn.add_listener(TIMERS_CHANNEL, self._on_event)
+                set_publisher(None)
+                self.scheduler = setup_scheduler(self.bot)
+                self.scheduler.start()
+                logger.info("Планировщик: этот процесс — лидер")
+
+                while True:
+                    await asyncio.sleep(LEADER_HEARTBEAT)
+                    await asyncio.wait_for(conn.fetchval("SELECT 1"), LEADER_HEARTBEAT)
+
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Планировщик: выбор лидера: {e}")
+            finally:
+                if self.is_leader:
+                    logger.warning("Планировщик: лидерство потеряно")
+                self._step_down()
+                if conn is not None:
+                    conn.terminate()
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+
+    def _step_down(self):
+        if self.scheduler:
+            self.scheduler.shutdown()
+            self.scheduler = None
+        set_publisher(notify_timers)
+
+    def _on_event(self, conn, pid, channel, payload):
+        task = asyncio.create_task(self._apply(payload))
+        self._pending.add(task)
+        task.add_done_callback(self._pending.discard)
+
+    async def _apply(self, payload: str):
+        """Событие от хендлера любого процесса → в кучу лидера."""
+        if not self.is_leader:
+            return
+        try:
+            event = json.loads(payload)
+            shift_id = event["shift_id"]
+            if event["op"] == "arm":
+                shift = await get_shift(shift_id)
+                if shift and shift.get("status") == "active":
+                    arm_shift(shift)
+            elif event["op"] == "disarm":
+                disarm_shift(shift_id)
+            elif event["op"] == "ignores":
+                arm_ignore_check(event["kind"], shift_id, datetime.fromisoformat(event["sent_at"]))
+        except Exception as e:
+            logger.error(f"Планировщик: событие {payload}: {e}")
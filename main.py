@@ -2,25 +2,50 @@ import asyncio
 import logging
 
 from aiogram import Bot, Dispatcher
-from aiogram.fsm.storage.memory import MemoryStorage
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
 
-from config import BOT_TOKEN
+from config import BOT_TOKEN, BOT_MODE, TELEGRAM_API_URL
 from database import init_db
 from handlers import user, shift_register, admin, confirmations
 from handlers import shift_report
 from handlers import unblock
-from scheduler import setup_scheduler
+from leader import LeaderElection, acquire_polling_lock
+from utils.admin_digest import digest
+from utils.fsm_storage import make_storage
+from utils.metrics import (
+    MetricsServer, TelegramMetricsMiddleware, UpdateMetricsMiddleware, watch_fsm,
+)
+from utils.outbox import outbox
+from webhook import run_webhook
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 
+def make_bot() -> Bot:
+    session = None
+    if TELEGRAM_API_URL:
+        session = AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL))
+        logger.info(f"Bot API: {TELEGRAM_API_URL}")
+    return Bot(token=BOT_TOKEN, session=session)
+
+
 async def main():
     await init_db()
     logger.info("✅ База данных инициализирована")
 
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    # Polling — строго один процесс на токен; несколько процессов — только webhook
+    polling_lock = None
+    if BOT_MODE != "webhook":
+        polling_lock = await acquire_polling_lock()
+
+    bot = make_bot()
+    bot.session.middleware(TelegramMetricsMiddleware())
+    storage = make_storage()
+    dp = Dispatcher(storage=storage)
+    dp.update.outer_middleware(UpdateMetricsMiddleware())
+    watch_fsm(storage)
 
     # Подключаем роутеры (порядок важен!)
     dp.include_router(admin.router)               # Блок 4
@@ -30,15 +55,32 @@ async def main():
     dp.include_router(shift_register.router)       # Блок 3
     dp.include_router(unblock.router)              # Блок 7 — последним (перехватчик)
 
-    # Запускаем планировщик
-    scheduler = setup_scheduler(bot)
+    # Запускаем планировщик (в одном из процессов — см. leader.py)
+    scheduler = LeaderElection(bot)
     scheduler.start()
+    digest.start(bot)
+    # Outbox разбирают все процессы: строки делятся через SKIP LOCKED
+    outbox.start(bot)
+    # В режиме webhook метрики отдаёт сервер вебхука
+    metrics_server = MetricsServer()
+    if BOT_MODE != "webhook":
+        await metrics_server.start()
     logger.info("🤖 Бот запущен")
 
     try:
-        await dp.start_polling(bot, skip_updates=True)
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Вебхук мог остаться от запуска в режиме webhook — с ним getUpdates не работает
+            await bot.delete_webhook()
+            await dp.start_polling(bot, skip_updates=True)
     finally:
         scheduler.shutdown()
+        await metrics_server.stop()
+        await outbox.shutdown()
+        await digest.shutdown()
+        if polling_lock is not None:
+            await polling_lock.close()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,529 @@
+"""
+Версионированные миграции схемы Postgres.
+Каждая миграция — (версия, описание, шаги); шаг — SQL-строка или
+async-функция от соединения (для пересчёта данных, который не выразить в SQL).
+Миграции применяются по порядку, каждая в своей транзакции; номер применённой
+версии пишется в schema_version. Если схема актуальна — DDL не выполняется вовсе.
+"""
+
+import logging
+from datetime import datetime, timezone
+
+import asyncpg
+
+from city_timezones import get_city_tz
+from utils.dates import parse_shift_date, shift_instants
+
+logger = logging.getLogger(__name__)
+
+# Ключ advisory-lock: несколько процессов не должны мигрировать одновременно
+MIGRATION_LOCK_KEY = 7_401_001
+
+
+async def _backfill_shift_dates(conn: asyncpg.Connection):
+    """Разобрать текстовые даты существующих смен и посчитать моменты напоминаний."""
+    rows = await conn.fetch(
+        """SELECT id, city, date, reminder_time, morning_reminder_time, created_at
+           FROM shifts WHERE shift_date IS NULL"""
+    )
+    updates = []
+    for r in rows:
+        created_at = r["created_at"] or datetime.now(timezone.utc)
+        created_local = created_at.astimezone(get_city_tz(r["city"])).date()
+        shift_date = parse_shift_date(r["date"], created_local)
+        if shift_date is None:
+            logger.warning(f"Смена {r['id']}: не удалось разобрать дату «{r['date']}»")
+            continue
+        inst = shift_instants(
+            r["city"], shift_date, r["reminder_time"], r["morning_reminder_time"], created_at,
+        )
+        updates.append((
+            r["id"], shift_date, inst["starts_at"], inst["reminder_at"], inst["morning_reminder_at"],
+        ))
+
+    await conn.executemany(
+        """UPDATE shifts
+           SET shift_date = $2, starts_at = $3, reminder_at = $4, morning_reminder_at = $5
+           WHERE id = $1""",
+        updates
+    )
+
+
+MIGRATIONS: list[tuple[int, str, list]] = [
+    (1, "Базовые таблицы", [
+        """
+        CREATE TABLE IF NOT EXISTS users (
+            telegram_id BIGINT PRIMARY KEY,
+            username TEXT,
+            registered_at TIMESTAMPTZ DEFAULT NOW(),
+            is_active INTEGER DEFAULT 1
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_profiles (
+            telegram_id BIGINT PRIMARY KEY,
+            city TEXT,
+            full_name TEXT,
+            age INTEGER,
+            phone TEXT,
+            rating DOUBLE PRECISION DEFAULT 5.0,
+            total_shifts INTEGER DEFAULT 0,
+            confirmed_shifts INTEGER DEFAULT 0,
+            refused_shifts INTEGER DEFAULT 0,
+            ignored_shifts INTEGER DEFAULT 0,
+            consecutive_failures INTEGER DEFAULT 0,
+            is_active INTEGER DEFAULT 1,
+            CONSTRAINT fk_user_profiles_users
+                FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+                ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS shifts (
+            id BIGSERIAL PRIMARY KEY,
+            city TEXT NOT NULL,
+            date TEXT NOT NULL,
+            address TEXT NOT NULL,
+            payment TEXT NOT NULL,
+            conditions TEXT,
+            main_slots INTEGER NOT NULL,
+            reserve_slots INTEGER NOT NULL,
+            reminder_time TEXT,
+            morning_reminder_time TEXT,
+            status TEXT DEFAULT 'active',
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS shift_members (
+            id BIGSERIAL PRIMARY KEY,
+            shift_id BIGINT NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            member_type TEXT NOT NULL,
+            position INTEGER,
+            status TEXT DEFAULT 'registered',
+            reminder_sent_at TIMESTAMPTZ,
+            morning_reminder_sent_at TIMESTAMPTZ,
+            joined_at TIMESTAMPTZ DEFAULT NOW(),
+            CONSTRAINT fk_shift_members_shifts
+                FOREIGN KEY (shift_id) REFERENCES shifts(id)
+                ON DELETE CASCADE,
+            CONSTRAINT fk_shift_members_users
+                FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+                ON DELETE CASCADE
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS shift_results (
+            id BIGSERIAL PRIMARY KEY,
+            shift_id BIGINT NOT NULL,
+            telegram_id BIGINT NOT NULL,
+            worked INTEGER,
+            decline_reason TEXT,
+            CONSTRAINT fk_shift_results_shifts
+                FOREIGN KEY (shift_id) REFERENCES shifts(id)
+                ON DELETE CASCADE,
+            CONSTRAINT fk_shift_results_users
+                FOREIGN KEY (telegram_id) REFERENCES users(telegram_id)
+                ON DELETE CASCADE,
+            CONSTRAINT uq_shift_results UNIQUE (shift_id, telegram_id)
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS unblock_requests (
+            id BIGSERIAL PRIMARY KEY,
+            telegram_id BIGINT NOT NULL,
+            city TEXT,
+            message TEXT,
+            status TEXT DEFAULT 'pending',
+            created_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+    ]),
+
+    (2, "Индексы горячих путей", [
+        # get_user_shift_membership / update_member_status / promote_to_main
+        """
+        CREATE INDEX IF NOT EXISTS ix_shift_members_shift_user
+            ON shift_members (shift_id, telegram_id);
+        """,
+        # get_member_count / get_first_reserve — без обращения к таблице
+        """
+        CREATE INDEX IF NOT EXISTS ix_shift_members_shift_type_status
+            ON shift_members (shift_id, member_type, status)
+            INCLUDE (position, telegram_id);
+        """,
+        # get_active_shift_by_city
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_city_status_created
+            ON shifts (city, status, created_at DESC);
+        """,
+        # create_unblock_request — проверка незакрытой заявки
+        """
+        CREATE INDEX IF NOT EXISTS ix_unblock_requests_user_status
+            ON unblock_requests (telegram_id, status);
+        """,
+        # get_users_by_city — рассылка по городу
+        """
+        CREATE INDEX IF NOT EXISTS ix_user_profiles_city_active
+            ON user_profiles (city, is_active) INCLUDE (telegram_id);
+        """,
+        # remove_ignored_members — только основа, ждущая ответа на напоминание
+        """
+        CREATE INDEX IF NOT EXISTS ix_shift_members_evening_pending
+            ON shift_members (reminder_sent_at)
+            WHERE status = 'registered' AND member_type = 'main'
+              AND reminder_sent_at IS NOT NULL;
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_shift_members_morning_pending
+            ON shift_members (morning_reminder_sent_at)
+            WHERE status = 'registered' AND member_type = 'main'
+              AND morning_reminder_sent_at IS NOT NULL;
+        """,
+    ]),
+
+    (3, "Типизированные дата и моменты напоминаний смены", [
+        """
+        ALTER TABLE shifts
+            ADD COLUMN IF NOT EXISTS shift_date DATE,
+            ADD COLUMN IF NOT EXISTS starts_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS reminder_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS morning_reminder_at TIMESTAMPTZ;
+        """,
+        _backfill_shift_dates,
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_active_reminder_at
+            ON shifts (reminder_at) WHERE status = 'active';
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_active_morning_reminder_at
+            ON shifts (morning_reminder_at) WHERE status = 'active';
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_shift_date
+            ON shifts (shift_date);
+        """,
+    ]),
+
+    (4, "Уникальная запись на смену и атомарное бронирование места", [
+        # Дубли, которые успели появиться из-за гонки, — оставляем самую раннюю запись
+        """
+        DELETE FROM shift_members a
+        USING shift_members b
+        WHERE a.shift_id = b.shift_id AND a.telegram_id = b.telegram_id AND a.id > b.id;
+        """,
+        """
+        ALTER TABLE shift_members
+            ADD CONSTRAINT uq_shift_members_shift_user UNIQUE (shift_id, telegram_id);
+        """,
+        # Уникальный индекс заменяет обычный из миграции 2
+        """
+        DROP INDEX IF EXISTS ix_shift_members_shift_user;
+        """,
+        # Строка смены блокируется FOR UPDATE — записи на одну смену идут строго по очереди,
+        # а каждый следующий оператор функции видит уже закоммиченные записи соседей
+        """
+        CREATE OR REPLACE FUNCTION reserve_slot(
+            p_shift_id BIGINT, p_telegram_id BIGINT, p_member_type TEXT
+        )
+        RETURNS TABLE (outcome TEXT, slot_position INTEGER, taken INTEGER, total INTEGER)
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_total INTEGER;
+            v_taken INTEGER;
+            v_max_position INTEGER;
+        BEGIN
+            SELECT CASE WHEN p_member_type = 'main' THEN s.main_slots ELSE s.reserve_slots END
+              INTO v_total
+              FROM shifts s
+             WHERE s.id = p_shift_id AND s.status = 'active'
+               FOR UPDATE;
+            IF NOT FOUND THEN
+                RETURN QUERY SELECT 'closed'::TEXT, NULL::INTEGER, 0, 0;
+                RETURN;
+            END IF;
+
+            SELECT COUNT(*) FILTER (WHERE sm.status NOT IN ('refused', 'removed')),
+                   COALESCE(MAX(sm.position), 0)
+              INTO v_taken, v_max_position
+              FROM shift_members sm
+             WHERE sm.shift_id = p_shift_id AND sm.member_type = p_member_type;
+
+            IF EXISTS (
+                SELECT 1 FROM shift_members sm
+                 WHERE sm.shift_id = p_shift_id AND sm.telegram_id = p_telegram_id
+            ) THEN
+                RETURN QUERY SELECT 'already'::TEXT, NULL::INTEGER, v_taken, v_total;
+                RETURN;
+            END IF;
+
+            IF v_taken >= v_total THEN
+                RETURN QUERY SELECT 'full'::TEXT, NULL::INTEGER, v_taken, v_total;
+                RETURN;
+            END IF;
+
+            INSERT INTO shift_members (shift_id, telegram_id, member_type, position)
+            VALUES (p_shift_id, p_telegram_id, p_member_type, v_max_position + 1);
+
+            RETURN QUERY SELECT 'ok'::TEXT, v_max_position + 1, v_taken + 1, v_total;
+        END
+        $$;
+        """,
+    ]),
+
+    (5, "Хранилище FSM (состояния диалогов переживают перезапуск)", [
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            key TEXT PRIMARY KEY,
+            state TEXT,
+            data JSONB NOT NULL DEFAULT '{}',
+            updated_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_fsm_storage_updated_at
+            ON fsm_storage (updated_at);
+        """,
+    ]),
+
+    (6, "Версии данных для кэша Excel-выгрузок", [
+        """
+        CREATE TABLE IF NOT EXISTS export_versions (
+            scope TEXT PRIMARY KEY,
+            version BIGINT NOT NULL DEFAULT 0
+        );
+        """,
+        # ORDER BY — строки счётчиков блокируются в одном порядке, без взаимоблокировок
+        """
+        CREATE OR REPLACE FUNCTION bump_export_versions(scopes TEXT[])
+        RETURNS VOID LANGUAGE sql AS $$
+            INSERT INTO export_versions (scope, version)
+            SELECT DISTINCT s, 1 FROM unnest(scopes) AS s WHERE s IS NOT NULL ORDER BY 1
+            ON CONFLICT (scope) DO UPDATE SET version = export_versions.version + 1
+        $$;
+        """,
+        # Триггер на оператор, а не на строку: массовое обновление (снятие игноров,
+        # рассылка) поднимает версию каждого затронутого города/смены один раз
+        """
+        CREATE OR REPLACE FUNCTION trg_bump_export_version()
+        RETURNS TRIGGER LANGUAGE plpgsql AS $$
+        DECLARE
+            expr TEXT := format('%L || %I', TG_ARGV[0], TG_ARGV[1]);
+            scopes TEXT[];
+        BEGIN
+            IF TG_OP = 'INSERT' THEN
+                EXECUTE format('SELECT array_agg(%s) FROM new_rows', expr) INTO scopes;
+            ELSIF TG_OP = 'UPDATE' THEN
+                EXECUTE format(
+                    'SELECT array_agg(s) FROM (SELECT %1$s AS s FROM new_rows '
+                    'UNION SELECT %1$s FROM old_rows) t', expr
+                ) INTO scopes;
+            ELSE
+                EXECUTE format('SELECT array_agg(%s) FROM old_rows', expr) INTO scopes;
+            END IF;
+            IF scopes IS NOT NULL THEN
+                PERFORM bump_export_versions(scopes);
+            END IF;
+            RETURN NULL;
+        END
+        $$;
+        """,
+        *[
+            f"""
+            CREATE TRIGGER export_version_{op.lower()}
+                AFTER {op} ON {table}
+                REFERENCING {transition}
+                FOR EACH STATEMENT
+                EXECUTE FUNCTION trg_bump_export_version('{prefix}', '{column}');
+            """
+            for table, prefix, column in (
+                ("user_profiles", "city:", "city"),
+                ("shift_members", "shift:", "shift_id"),
+                ("shift_results", "shift:", "shift_id"),
+            )
+            for op, transition in (
+                ("INSERT", "NEW TABLE AS new_rows"),
+                ("UPDATE", "OLD TABLE AS old_rows NEW TABLE AS new_rows"),
+                ("DELETE", "OLD TABLE AS old_rows"),
+            )
+        ],
+    ]),
+
+    (7, "Живая сводка отчётов смены у админа", [
+        """
+        ALTER TABLE shifts ADD COLUMN IF NOT EXISTS summary_message_id BIGINT;
+        """,
+    ]),
+
+    (8, "Outbox исходящих сообщений", [
+        """
+        CREATE TABLE IF NOT EXISTS outbox (
+            id BIGSERIAL PRIMARY KEY,
+            dedup_key TEXT NOT NULL UNIQUE,
+            chat_id BIGINT NOT NULL,
+            payload JSONB NOT NULL,
+            on_sent JSONB,
+            status TEXT NOT NULL DEFAULT 'pending',
+            attempts INTEGER NOT NULL DEFAULT 0,
+            next_attempt_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            last_error TEXT,
+            created_at TIMESTAMPTZ NOT NULL DEFAULT NOW(),
+            sent_at TIMESTAMPTZ
+        );
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_outbox_due
+            ON outbox (next_attempt_at, id) WHERE status = 'pending';
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_outbox_done
+            ON outbox (created_at) WHERE status <> 'pending';
+        """,
+    ]),
+
+    (9, "Сплошная нумерация активных участников смены", [
+        # Позиции активных (не refused/removed) — 1..n в каждом списке без дыр;
+        # у снятых остаётся прежняя позиция для истории
+        """
+        UPDATE shift_members sm SET position = o.n
+        FROM (
+            SELECT id, ROW_NUMBER() OVER (
+                       PARTITION BY shift_id, member_type ORDER BY position, id
+                   ) AS n
+            FROM shift_members
+            WHERE status NOT IN ('refused', 'removed')
+        ) o
+        WHERE sm.id = o.id AND sm.position IS DISTINCT FROM o.n;
+        """,
+        # Новая запись встаёт за последним активным, а не за последним когда-либо записанным
+        """
+        CREATE OR REPLACE FUNCTION reserve_slot(
+            p_shift_id BIGINT, p_telegram_id BIGINT, p_member_type TEXT
+        )
+        RETURNS TABLE (outcome TEXT, slot_position INTEGER, taken INTEGER, total INTEGER)
+        LANGUAGE plpgsql AS $$
+        DECLARE
+            v_total INTEGER;
+            v_taken INTEGER;
+            v_max_position INTEGER;
+        BEGIN
+            SELECT CASE WHEN p_member_type = 'main' THEN s.main_slots ELSE s.reserve_slots END
+              INTO v_total
+              FROM shifts s
+             WHERE s.id = p_shift_id AND s.status = 'active'
+               FOR UPDATE;
+            IF NOT FOUND THEN
+                RETURN QUERY SELECT 'closed'::TEXT, NULL::INTEGER, 0, 0;
+                RETURN;
+            END IF;
+
+            SELECT COUNT(*) FILTER (WHERE sm.status NOT IN ('refused', 'removed')),
+                   COALESCE(MAX(sm.position) FILTER (WHERE sm.status NOT IN ('refused', 'removed')), 0)
+              INTO v_taken, v_max_position
+              FROM shift_members sm
+             WHERE sm.shift_id = p_shift_id AND sm.member_type = p_member_type;
+
+            IF EXISTS (
+                SELECT 1 FROM shift_members sm
+                 WHERE sm.shift_id = p_shift_id AND sm.telegram_id = p_telegram_id
+            ) THEN
+                RETURN QUERY SELECT 'already'::TEXT, NULL::INTEGER, v_taken, v_total;
+                RETURN;
+            END IF;
+
+            IF v_taken >= v_total THEN
+                RETURN QUERY SELECT 'full'::TEXT, NULL::INTEGER, v_taken, v_total;
+                RETURN;
+            END IF;
+
+            INSERT INTO shift_members (shift_id, telegram_id, member_type, position)
+            VALUES (p_shift_id, p_telegram_id, p_member_type, v_max_position + 1);
+
+            RETURN QUERY SELECT 'ok'::TEXT, v_max_position + 1, v_taken + 1, v_total;
+        END
+        $$;
+        """,
+    ]),
+
+    (10, "Outbox: срок отправки и запланированное время", [
+        # deadline — порядок разбора очереди (самые срочные первыми),
+        # scheduled_at — когда сообщение должно было уйти (напоминания) — для сравнения с sent_at
+        """
+        ALTER TABLE outbox
+            ADD COLUMN IF NOT EXISTS scheduled_at TIMESTAMPTZ,
+            ADD COLUMN IF NOT EXISTS deadline TIMESTAMPTZ NOT NULL DEFAULT NOW();
+        """,
+        "DROP INDEX IF EXISTS ix_outbox_due;",
+        """
+        CREATE INDEX IF NOT EXISTS ix_outbox_deadline
+            ON outbox (deadline, id) WHERE status = 'pending';
+        """,
+    ]),
+
+    (11, "Жизненный цикл смен: индексы только по активным", [
+        # Завершённые и архивные смены копятся, а все «живые» запросы (планировщик,
+        # запись, активная смена города) смотрят только на status = 'active'
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_active
+            ON shifts (id) WHERE status = 'active';
+        """,
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_active_city_created
+            ON shifts (city, created_at DESC) WHERE status = 'active';
+        """,
+        "DROP INDEX IF EXISTS ix_shifts_city_status_created;",
+        # archive_stale_shifts: активные смены без даты — по возрасту
+        """
+        CREATE INDEX IF NOT EXISTS ix_shifts_stale_candidates
+            ON shifts (created_at)
+            WHERE status = 'active' AND shift_date IS NULL;
+        """,
+    ]),
+]
+
+LATEST_VERSION = MIGRATIONS[-1][0]
+
+
+async def _current_version(conn: asyncpg.Connection) -> int:
+    exists = await conn.fetchval("SELECT to_regclass('schema_version') IS NOT NULL")
+    if not exists:
+        return 0
+    return await conn.fetchval("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+
+
+async def migrate(conn: asyncpg.Connection) -> int:
+    """Применить недостающие миграции. Возвращает итоговую версию схемы."""
+    if await _current_version(conn) >= LATEST_VERSION:
+        return LATEST_VERSION
+
+    await conn.execute("SELECT pg_advisory_lock($1)", MIGRATION_LOCK_KEY)
+    try:
+        await conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                description TEXT,
+                applied_at TIMESTAMPTZ DEFAULT NOW()
+            );
+        """)
+        current = await _current_version(conn)
+
+        for version, description, steps in MIGRATIONS:
+            if version <= current:
+                continue
+            async with conn.transaction():
+                for step in steps:
+                    if callable(step):
+                        await step(conn)
+                    else:
+                        await conn.execute(step)
+                await conn.execute(
+                    "INSERT INTO schema_version (version, description) VALUES ($1, $2)",
+                    version, description
+                )
+            logger.info(f"Миграция {version}: {description}")
+            current = version
+
+        return current
+    finally:
+        await conn.execute("SELECT pg_advisory_unlock($1)", MIGRATION_LOCK_KEY)
@@ -1,197 +1,322 @@
+"""
+Планировщик напоминаний на куче таймеров.
+Для каждой смены заранее вычисляются моменты (UTC) вечернего и утреннего напоминания,
+после отправки — моменты проверки игнора, на следующий день после даты — завершение
+смены. Между событиями планировщик спит и не делает запросов к базе.
+Сами сообщения уходят через outbox (utils/outbox.py).
+"""
+
+import asyncio
+import html
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta, timezone
 
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from aiogram import Bot
-from aiogram.utils.keyboard import InlineKeyboardBuilder
 
+from config import SHIFT_STALE_DAYS
 from database import (
-    get_all_active_shifts, get_shift_members,
-    set_reminder_sent_at, set_morning_reminder_sent_at,
-    get_members_to_ignore_check, get_members_to_morning_ignore_check,
+    get_all_active_shifts, get_shift,
+    remove_ignored_members, get_pending_ignore_deadlines, enqueue_shift_reminders,
+    complete_shift, archive_stale_shifts,
+)
+from handlers.confirmations import (
+    confirm_keyboard, morning_confirm_keyboard,
+    notify_ignored_removed, ignored_notice, morning_ignored_notice,
+    promotion_notice, morning_promotion_notice,
+)
+from handlers.shift_report import report_messages, forget_summary
+from city_timezones import LocalClock
+from utils.admin_digest import admin_alert
+from utils.metrics import job_timer
+from utils.outbox import outbox, outbox_payload
+from utils.timer_heap import (
+    timers, arm_shift, arm_ignore_check, next_local_occurrence,
+    EVENING_REMINDER, MORNING_REMINDER, EVENING_IGNORES, MORNING_IGNORES,
+    SHIFT_COMPLETE, SHIFT_SWEEP,
 )
-from handlers.confirmations import auto_remove_ignored, auto_remove_morning_ignored
-from city_timezones import get_city_tz
 
 logger = logging.getLogger(__name__)
 
+# Напоминание, пропущенное (бот лежал/тормозил) не более чем на столько, всё равно отправляем
+MISFIRE_GRACE = timedelta(hours=1)
 
-def _local_hhmm(city: str) -> str:
-    return datetime.now(get_city_tz(city)).strftime("%H:%M")
-
-
-def _local_hour(city: str) -> int:
-    return datetime.now(get_city_tz(city)).hour
+# Информация резерву не ждёт ответа — в общей очереди outbox она уступает
+# основе всех смен, запланированных на тот же момент
+RESERVE_INFO_SLACK = timedelta(minutes=5)
 
+# Архивация зависших черновиков и смен без даты — раз в столько
+SWEEP_INTERVAL = timedelta(hours=6)
 
-def _local_date(city: str) -> str:
-    return datetime.now(get_city_tz(city)).strftime("%d.%m.%Y")
 
-
-async def job_send_evening_reminders(bot: Bot):
-    """Вечернее напоминание — основе с кнопками, резерву просто инфо."""
+async def job_send_evening_reminders(
+    bot: Bot, shift: dict, clock: LocalClock, scheduled_at: datetime,
+):
+    """
+    Вечернее напоминание — основе с кнопками, резерву просто инфо.
+    Тексты собираются один раз на смену, очередь outbox заполняется одним запросом;
+    reminder_sent_at основе и проверку игнора outbox отмечает по факту отправки.
+    """
     try:
-        shifts = await get_all_active_shifts()
-        for shift in shifts:
-            if not shift.get("reminder_time"):
-                continue
-            if shift["reminder_time"] != _local_hhmm(shift["city"]):
-                continue
-
-            members = await get_shift_members(shift["id"])
-            morning_time = shift.get("morning_reminder_time", "8:00")
-
-            for member in members:
-                if member["status"] not in ("registered", "confirmed"):
-                    continue
-                if member.get("reminder_sent_at"):
-                    continue  # уже отправляли
-
-                try:
-                    if member["member_type"] == "main":
-                        kb = InlineKeyboardBuilder()
-                        kb.button(text="✅ Подтверждаю", callback_data=f"confirm_shift:{shift['id']}")
-                        kb.button(text="❌ Не смогу", callback_data=f"refuse_shift:{shift['id']}")
-                        kb.adjust(2)
-                        text = (
-                            f"⏰ <b>Напоминание о смене!</b>\n\n"
-                            f"📅 {shift['date']}\n"
-                            f"📍 {shift['address']}\n"
-                            f"💰 {shift['payment']}\n\n"
-                            f"Подтверди участие.\n"
-                            f"⚠️ Если не ответишь в течение <b>30 минут</b> — будешь снят автоматически!"
-                        )
-                        await bot.send_message(
-                            member["telegram_id"], text,
-                            parse_mode="HTML", reply_markup=kb.as_markup(),
-                        )
-                        # Ставим время только основе — для отсчёта 30 мин игнора
-                        await set_reminder_sent_at(shift["id"], member["telegram_id"])
-                        logger.info(f"Вечернее напоминание (основа) → {member['telegram_id']}")
-
-                    else:
-                        # Резерв — только информация, reminder_sent_at НЕ ставим!
-                        text = (
-                            f"🔔 <b>Информация о смене</b>\n\n"
-                            f"📅 {shift['date']}\n"
-                            f"📍 {shift['address']}\n"
-                            f"💰 {shift['payment']}\n\n"
-                            f"Ты в очереди резерва. Основной состав сейчас подтверждает участие.\n\n"
-                            f"Если кто-то откажется — тебе придёт сообщение о переводе в основу.\n"
-                            f"Утром в <b>{morning_time}</b> придёт финальная информация.\n"
-                            f"📱 Будь на связи!"
-                        )
-                        await bot.send_message(
-                            member["telegram_id"], text, parse_mode="HTML",
-                        )
-                        logger.info(f"Вечернее инфо (резерв) → {member['telegram_id']}")
-                        # set_reminder_sent_at для резерва НЕ вызываем!
-
-                except Exception as e:
-                    logger.warning(f"Вечернее напоминание {member['telegram_id']}: {e}")
+        morning_time = shift.get("morning_reminder_time", "8:00")
+        main_text = (
+            f"⏰ <b>Напоминание о смене!</b>\n\n"
+            f"📅 {shift['date']}\n"
+            f"📍 {shift['address']}\n"
+            f"💰 {shift['payment']}\n\n"
+            f"Подтверди участие.\n"
+            f"⚠️ Если не ответишь в течение <b>30 минут</b> — будешь снят автоматически!"
+        )
+        # Резерв — только информация, reminder_sent_at НЕ ставим!
+        reserve_text = (
+            f"🔔 <b>Информация о смене</b>\n\n"
+            f"📅 {shift['date']}\n"
+            f"📍 {shift['address']}\n"
+            f"💰 {shift['payment']}\n\n"
+            f"Ты в очереди резерва. Основной состав сейчас подтверждает участие.\n\n"
+            f"Если кто-то откажется — тебе придёт сообщение о переводе в основу.\n"
+            f"Утром в <b>{morning_time}</b> придёт финальная информация.\n"
+            f"📱 Будь на связи!"
+        )
+
+        # Время ставим только основе — для отсчёта 30 мин игнора
+        queued = await enqueue_shift_reminders(
+            shift["id"], morning=False,
+            main=outbox_payload(main_text, confirm_keyboard(shift["id"])),
+            main_on_sent={
+                "stamp": "reminder_sent_at",
+                "shift_id": shift["id"],
+                "ignore_check": EVENING_IGNORES,
+            },
+            reserve=outbox_payload(reserve_text),
+            today=clock(shift["city"]).date.isoformat(),
+            scheduled_at=scheduled_at,
+            reserve_deadline=scheduled_at + RESERVE_INFO_SLACK,
+        )
+        outbox.wake()
+        logger.info(f"Вечерние напоминания: смена {shift['id']}, в очереди {queued}")
 
     except Exception as e:
         logger.error(f"job_send_evening_reminders: {e}")
 
 
 async def job_check_evening_ignores(bot: Bot):
-    """Снимаем ТОЛЬКО основу кто не ответил 30+ мин на вечернее напоминание."""
+    """Снимаем ТОЛЬКО основу кто не ответил 30+ мин на вечернее напоминание (все смены сразу)."""
     try:
-        shifts = await get_all_active_shifts()
-        for shift in shifts:
-            ignored = await get_members_to_ignore_check(shift["id"])
-            for member in ignored:
-                logger.info(f"Игнор (вечер): {member['telegram_id']} смена {shift['id']}")
-                await auto_remove_ignored(bot, shift["id"], member["telegram_id"])
+        removed, promoted = await remove_ignored_members(
+            morning=False, render=ignored_notice, render_promotion=promotion_notice,
+        )
+        outbox.wake()
+        for member in removed:
+            logger.info(f"Игнор (вечер): {member['telegram_id']} смена {member['shift_id']}")
+        notify_ignored_removed(removed, promoted)
     except Exception as e:
         logger.error(f"job_check_evening_ignores: {e}")
 
 
-async def job_send_morning_reminders(bot: Bot):
-    """Утреннее подтверждение готовности — основе."""
+async def job_send_morning_reminders(
+    bot: Bot, shift: dict, clock: LocalClock, scheduled_at: datetime,
+):
+    """Утреннее подтверждение готовности — основе (через outbox, как вечером)."""
     try:
-        shifts = await get_all_active_shifts()
-        for shift in shifts:
-            if not shift.get("morning_reminder_time"):
-                continue
-            if shift["morning_reminder_time"] != _local_hhmm(shift["city"]):
-                continue
-
-            today = _local_date(shift["city"])
-            if today not in shift["date"]:
-                continue
-
-            members = await get_shift_members(shift["id"])
-
-            for member in members:
-                if member.get("morning_reminder_sent_at"):
-                    continue
-
-                try:
-                    if member["member_type"] == "main" and member["status"] == "confirmed":
-                        kb = InlineKeyboardBuilder()
-                        kb.button(text="✅ Готов, выхожу!", callback_data=f"morning_confirm:{shift['id']}")
-                        kb.button(text="❌ Не смогу выйти", callback_data=f"refuse_shift:{shift['id']}")
-                        kb.adjust(2)
-                        text = (
-                            f"🌅 <b>Доброе утро! Сегодня твоя смена</b>\n\n"
-                            f"📅 {shift['date']}\n"
-                            f"📍 {shift['address']}\n"
-                            f"💰 {shift['payment']}\n\n"
-                            f"Подтверди что выходишь!\n"
-                            f"⚠️ Если не ответишь в течение <b>10 минут</b> — будешь снят."
-                        )
-                        await bot.send_message(
-                            member["telegram_id"], text,
-                            parse_mode="HTML", reply_markup=kb.as_markup(),
-                        )
-                        await set_morning_reminder_sent_at(shift["id"], member["telegram_id"])
-                        logger.info(f"Утреннее напоминание (основа) → {member['telegram_id']}")
-
-                    elif member["member_type"] == "reserve" and member["status"] == "confirmed":
-                        # Считаем сколько основы подтверждено
-                        main_confirmed = sum(
-                            1 for m in members
-                            if m["member_type"] == "main"
-                            and m["status"] not in ("refused", "removed")
-                        )
-                        if main_confirmed >= shift["main_slots"]:
-                            # Основа заполнена — резерву просто инфо
-                            text = (
-                                f"🌅 <b>Доброе утро!</b>\n\n"
-                                f"Сегодня смена в {shift['city']}.\n"
-                                f"📅 {shift['date']} | 📍 {shift['address']}\n\n"
-                                f"Основной состав заполнен, ты в резерве.\n"
-                                f"Если кто-то не выйдет — тебе придёт сообщение. Будь на связи! 📱"
-                            )
-                            await bot.send_message(
-                                member["telegram_id"], text, parse_mode="HTML",
-                            )
-
-                except Exception as e:
-                    logger.warning(f"Утреннее напоминание {member['telegram_id']}: {e}")
+        local = clock(shift["city"])
+        if shift.get("shift_date"):
+            if shift["shift_date"] != local.date:
+                return
+        elif local.label not in shift["date"]:
+            return
+
+        main_text = (
+            f"🌅 <b>Доброе утро! Сегодня твоя смена</b>\n\n"
+            f"📅 {shift['date']}\n"
+            f"📍 {shift['address']}\n"
+            f"💰 {shift['payment']}\n\n"
+            f"Подтверди что выходишь!\n"
+            f"⚠️ Если не ответишь в течение <b>10 минут</b> — будешь снят."
+        )
+        # Резерву — только если основа заполнена (решает запрос), просто инфо
+        reserve_text = (
+            f"🌅 <b>Доброе утро!</b>\n\n"
+            f"Сегодня смена в {shift['city']}.\n"
+            f"📅 {shift['date']} | 📍 {shift['address']}\n\n"
+            f"Основной состав заполнен, ты в резерве.\n"
+            f"Если кто-то не выйдет — тебе придёт сообщение. Будь на связи! 📱"
+        )
+
+        queued = await enqueue_shift_reminders(
+            shift["id"], morning=True,
+            main=outbox_payload(main_text, morning_confirm_keyboard(shift["id"])),
+            main_on_sent={
+                "stamp": "morning_reminder_sent_at",
+                "shift_id": shift["id"],
+                "ignore_check": MORNING_IGNORES,
+            },
+            reserve=outbox_payload(reserve_text),
+            today=local.date.isoformat(),
+            scheduled_at=scheduled_at,
+            reserve_deadline=scheduled_at + RESERVE_INFO_SLACK,
+        )
+        outbox.wake()
+        logger.info(f"Утренние напоминания: смена {shift['id']}, в очереди {queued}")
 
     except Exception as e:
         logger.error(f"job_send_morning_reminders: {e}")
 
 
 async def job_check_morning_ignores(bot: Bot):
-    """Снимаем тех кто не ответил 10+ мин на утреннее напоминание."""
+    """Снимаем тех кто не ответил 10+ мин на утреннее напоминание (все смены сразу)."""
     try:
-        shifts = await get_all_active_shifts()
-        for shift in shifts:
-            ignored = await get_members_to_morning_ignore_check(shift["id"])
-            for member in ignored:
-                logger.info(f"Игнор (утро): {member['telegram_id']} смена {shift['id']}")
-                await auto_remove_morning_ignored(bot, shift["id"], member["telegram_id"])
+        removed, promoted = await remove_ignored_members(
+            morning=True, render=morning_ignored_notice, render_promotion=morning_promotion_notice,
+        )
+        outbox.wake()
+        for member in removed:
+            logger.info(f"Игнор (утро): {member['telegram_id']} смена {member['shift_id']}")
+        notify_ignored_removed(removed, promoted, morning=True)
     except Exception as e:
         logger.error(f"job_check_morning_ignores: {e}")
 
 
-def setup_scheduler(bot: Bot) -> AsyncIOScheduler:
-    scheduler = AsyncIOScheduler(timezone="UTC")
-    scheduler.add_job(job_send_evening_reminders, "cron", minute="*", kwargs={"bot": bot}, id="evening_reminders", replace_existing=True)
-    scheduler.add_job(job_check_evening_ignores,  "cron", minute="*", kwargs={"bot": bot}, id="evening_ignores",  replace_existing=True)
-    scheduler.add_job(job_send_morning_reminders, "cron", minute="*", kwargs={"bot": bot}, id="morning_reminders", replace_existing=True)
-    scheduler.add_job(job_check_morning_ignores,  "cron", minute="*", kwargs={"bot": bot}, id="morning_ignores",  replace_existing=True)
-    return scheduler
+async def job_complete_shift(
+    bot: Bot, shift: dict, clock: LocalClock, scheduled_at: datetime,
+):
+    """
+    Дата смены прошла — смена уходит в completed, участникам форма отчёта.
+    Если админ уже завершил смену вручную, complete_shift ничего не сделает.
+    Давно забытые смены (первый запуск после _backfill_shift_dates, долгий простой)
+    закрываются молча: форма отчёта за смену многонедельной давности никому не нужна.
+    """
+    try:
+        stale = datetime.now(timezone.utc) - scheduled_at > timedelta(days=SHIFT_STALE_DAYS)
+        completed, members = await complete_shift(
+            shift["id"], render=None if stale else report_messages,
+        )
+        timers.cancel(shift["id"])
+        forget_summary(shift["id"])
+        if completed and stale:
+            logger.info(f"Смена {shift['id']} от {shift['date']} закрыта без отчёта (давно прошла)")
+        elif completed:
+            outbox.wake()
+            logger.info(f"Смена {shift['id']} завершена автоматически, форм отчёта: {len(members)}")
+    except Exception as e:
+        logger.error(f"job_complete_shift: {e}")
+
+
+async def job_sweep_shifts(bot: Bot):
+    """Смены без даты старше SHIFT_STALE_DAYS — в архив, из кучи — долой."""
+    try:
+        archived = await archive_stale_shifts(SHIFT_STALE_DAYS)
+        for shift in archived:
+            timers.cancel(shift["id"])
+        forget_summary(*(s["id"] for s in archived))
+        if archived:
+            lines = "\n".join(f"• #{s['id']} {s['city']} | {html.escape(s['date'])}" for s in archived)
+            admin_alert(f"🗄 <b>В архив: {len(archived)} смен</b>\n\n{lines}")
+            logger.info(f"Архивировано смен: {len(archived)}")
+    except Exception as e:
+        logger.error(f"job_sweep_shifts: {e}")
+    timers.push(datetime.now(timezone.utc) + SWEEP_INTERVAL, SHIFT_SWEEP, 0)
+
+
+JOBS = {
+    EVENING_REMINDER: job_send_evening_reminders,
+    MORNING_REMINDER: job_send_morning_reminders,
+    SHIFT_COMPLETE: job_complete_shift,
+}
+
+# Задачи не привязаны к смене: один запрос покрывает все смены,
+# поэтому сколько бы таких событий ни созрело одновременно — запускаем один раз
+GLOBAL_JOBS = {
+    EVENING_IGNORES: job_check_evening_ignores,
+    MORNING_IGNORES: job_check_morning_ignores,
+    SHIFT_SWEEP: job_sweep_shifts,
+}
+
+# Смены со старой текстовой датой (без shift_date): напоминания повторяются
+# ежедневно, пока смена активна. Для остальных моменты заданы один раз.
+RECURRING = {
+    EVENING_REMINDER: "reminder_time",
+    MORNING_REMINDER: "morning_reminder_time",
+}
+
+
+class ReminderScheduler:
+    def __init__(self, bot: Bot):
+        self.bot = bot
+        self._task: asyncio.Task | None = None
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    def shutdown(self):
+        if self._task:
+            self._task.cancel()
+        timers.clear()
+
+    async def _load(self):
+        """Старт: ставим в кучу все активные смены и догоняем пропущенное."""
+        now = datetime.now(timezone.utc)
+        shifts = await get_all_active_shifts()
+        for shift in shifts:
+            arm_shift(shift, now, grace=MISFIRE_GRACE)
+        # Игноры могли «созреть», пока бот был выключен, — проверяем сразу;
+        # ещё не созревшие восстанавливаем по времени отправки напоминаний
+        timers.push(now, EVENING_IGNORES, 0)
+        timers.push(now, MORNING_IGNORES, 0)
+        timers.push(now, SHIFT_SWEEP, 0)
+        for row in await get_pending_ignore_deadlines():
+            kind = MORNING_IGNORES if row["morning"] else EVENING_IGNORES
+            arm_ignore_check(kind, row["shift_id"], row["first_sent"])
+            arm_ignore_check(kind, row["shift_id"], row["last_sent"])
+        logger.info(f"Планировщик: {len(shifts)} активных смен, {len(timers)} событий")
+
+    async def _fire(self, when: datetime, kind: str, shift_id: int, clock: LocalClock):
+        shift = await get_shift(shift_id)
+        if not shift or shift.get("status") != "active":
+            timers.cancel(shift_id)
+            return
+
+        await JOBS[kind](self.bot, shift, clock, when)
+
+        field = RECURRING.get(kind)
+        if field and not shift.get("shift_date"):
+            next_at = next_local_occurrence(
+                shift["city"], shift.get(field), when + timedelta(minutes=1),
+            )
+            if next_at:
+                timers.push(next_at, kind, shift_id)
+
+    async def _run(self):
+        while True:
+            try:
+                await self._load()
+                break
+            except Exception as e:
+                logger.error(f"Планировщик: загрузка смен: {e}")
+                await asyncio.sleep(30)
+
+        while True:
+            await timers.wait()
+            # Один момент на тик: местные дата/время — один раз на пояс (см. LocalClock)
+            now = datetime.now(timezone.utc)
+            due = timers.pop_due(now)
+            clock = LocalClock(now)
+            # Задачи по всем сменам — один прогон на вид, отставание от самой ранней
+            checks: dict[str, datetime] = {}
+            for when, kind, _ in due:
+                if kind in GLOBAL_JOBS:
+                    checks[kind] = min(when, checks.get(kind, when))
+            for when, kind, shift_id in due:
+                if kind in GLOBAL_JOBS:
+                    continue
+                with job_timer(kind, when):
+                    try:
+                        await self._fire(when, kind, shift_id, clock)
+                    except Exception as e:
+                        logger.error(f"Планировщик {kind} смена {shift_id}: {e}")
+            for kind, when in checks.items():
+                with job_timer(kind, when):
+                    await GLOBAL_JOBS[kind](self.bot)
+
+
+def setup_scheduler(bot: Bot) -> ReminderScheduler:
+    return ReminderScheduler(bot)
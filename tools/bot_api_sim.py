@@ -0,0 +1,277 @@
+"""
+Локальная замена Telegram Bot API для нагрузочных проверок без сети.
+
+    python tools/bot_api_sim.py --port 8081 --latency 50 --jitter 30 \
+        --global-rate 30 --chat-rate 1 --error-rate 0.01 --blocked 900000001 \
+        --record calls.jsonl
+
+    TELEGRAM_API_URL=http://127.0.0.1:8081 python main.py
+
+Методы: getMe, getUpdates, setWebhook, deleteWebhook, sendMessage, editMessageText,
+answerCallbackQuery, sendDocument; остальные — 404, как у Telegram.
+• --latency/--jitter — задержка ответа, мс
+• --global-rate/--chat-rate (+ --*-burst) — лимиты отправки в чаты, сверх — 429 с retry_after
+• --error-rate — доля ответов 502, --blocked — чаты, где «бот заблокирован» (403)
+• каждый вызов пишется в --record (JSONL); сводка — GET /sim/stats
+
+Обновления для бота: POST /sim/updates со списком Update (JSON). Без вебхука они
+отдаются через getUpdates, после setWebhook — POST-ятся на адрес вебхука с секретом.
+"""
+
+import argparse
+import asyncio
+import json
+import logging
+import math
+import random
+import time
+from collections import Counter, defaultdict
+
+import aiohttp
+from aiohttp import web
+
+logger = logging.getLogger("bot_api_sim")
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+SEND_METHODS = {"sendmessage", "editmessagetext", "senddocument"}
+
+
+class Bucket:
+    """Token bucket: rate в секунду, не больше burst подряд."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self) -> float:
+        """0 — можно; иначе через сколько секунд появится токен."""
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class BotApiSimulator:
+    def __init__(self, args):
+        self.args = args
+        self.global_bucket = Bucket(args.global_rate, args.global_burst)
+        self.chat_buckets: dict[int, Bucket] = {}
+        self.blocked = set(args.blocked)
+        self.message_ids: Counter = Counter()
+        self.file_ids = 0
+        self.updates: list[dict] = []
+        self.update_id = 0
+        self.new_updates = asyncio.Event()
+        self.webhook: dict | None = None
+        self.stats: dict[str, Counter] = defaultdict(Counter)
+        self.record = open(args.record, "a", encoding="utf-8", buffering=1) if args.record else None
+        self.client: aiohttp.ClientSession | None = None
+
+        self.app = web.Application(client_max_size=50 * 1024 * 1024)
+        self.app.router.add_post("/bot{token}/{method}", self.handle)
+        self.app.router.add_get("/bot{token}/{method}", self.handle)
+        self.app.router.add_post("/sim/updates", self.inject)
+        self.app.router.add_get("/sim/stats", self.get_stats)
+        self.app.router.add_post("/sim/reset", self.reset)
+        self.app.on_shutdown.append(self._close)
+
+    # ─── Ответы ──────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def ok(result) -> web.Response:
+        return web.json_response({"ok": True, "result": result})
+
+    @staticmethod
+    def error(code: int, description: str, **parameters) -> web.Response:
+        body = {"ok": False, "error_code": code, "description": description}
+        if parameters:
+            body["parameters"] = parameters
+        return web.json_response(body, status=code)
+
+    def bot_user(self, token: str) -> dict:
+        bot_id = int(token.split(":")[0]) if token.split(":")[0].isdigit() else 1
+        return {"id": bot_id, "is_bot": True, "first_name": "Sim", "username": "sim_bot"}
+
+    def message(self, token: str, chat_id: int, message_id: int | None = None, **fields) -> dict:
+        if message_id is None:
+            self.message_ids[chat_id] += 1
+            message_id = self.message_ids[chat_id]
+        return {
+            "message_id": message_id,
+            "date": int(time.time()),
+            "chat": {"id": chat_id, "type": "private"},
+            "from": self.bot_user(token),
+            **fields,
+        }
+
+    # ─── Bot API ─────────────────────────────────────────────────────────────
+
+    async def handle(self, request: web.Request) -> web.Response:
+        token = request.match_info["token"]
+        method = request.match_info["method"]
+        params = await self._params(request)
+        started = time.monotonic()
+
+        response = await self._dispatch(token, method, params)
+
+        self.stats[method][response.status] += 1
+        if self.record:
+            self.record.write(json.dumps({
+                "ts": round(time.time(), 3),
+                "method": method,
+                "chat_id": params.get("chat_id"),
+                "status": response.status,
+                "ms": round((time.monotonic() - started) * 1000, 1),
+            }) + "\n")
+        return response
+
+    async def _params(self, request: web.Request) -> dict:
+        if request.content_type == "application/json":
+            return await request.json()
+        params = {}
+        for key, value in (await request.post()).items():
+            params[key] = value if isinstance(value, str) else "<file>"
+        return params
+
+    async def _dispatch(self, token: str, method: str, params: dict) -> web.Response:
+        name = method.lower()
+        if name == "getupdates":
+            return await self.get_updates(params)
+
+        if self.args.latency or self.args.jitter:
+            await asyncio.sleep((self.args.latency + random.uniform(0, self.args.jitter)) / 1000)
+
+        if name in SEND_METHODS:
+            chat_id = int(params.get("chat_id", 0))
+            limited = self._throttle(chat_id)
+            if limited:
+                return self.error(
+                    429, f"Too Many Requests: retry after {limited}", retry_after=limited,
+                )
+            if chat_id in self.blocked:
+                return self.error(403, "Forbidden: bot was blocked by the user")
+            if random.random() < self.args.error_rate:
+                return self.error(502, "Bad Gateway")
+
+        if name == "getme":
+            return self.ok(self.bot_user(token))
+        if name == "setwebhook":
+            self.webhook = {"url": params.get("url"), "secret": params.get("secret_token")}
+            return self.ok(True)
+        if name == "deletewebhook":
+            self.webhook = None
+            return self.ok(True)
+        if name == "sendmessage":
+            return self.ok(self.message(token, int(params["chat_id"]), text=params.get("text", "")))
+        if name == "editmessagetext":
+            if "inline_message_id" in params:
+                return self.ok(True)
+            return self.ok(self.message(
+                token, int(params["chat_id"]), int(params["message_id"]),
+                text=params.get("text", ""), edit_date=int(time.time()),
+            ))
+        if name == "answercallbackquery":
+            return self.ok(True)
+        if name == "senddocument":
+            self.file_ids += 1
+            document = {"file_id": f"sim-file-{self.file_ids}", "file_unique_id": f"u{self.file_ids}"}
+            return self.ok(self.message(token, int(params["chat_id"]), document=document))
+        return self.error(404, "Not Found")
+
+    def _throttle(self, chat_id: int) -> int:
+        """0 — в пределах лимитов, иначе retry_after (целые секунды, как у Telegram)."""
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self.chat_buckets[chat_id] = Bucket(self.args.chat_rate, self.args.chat_burst)
+        wait = max(bucket.take(), self.global_bucket.take())
+        return math.ceil(wait) if wait else 0
+
+    async def get_updates(self, params: dict) -> web.Response:
+        if self.webhook:
+            return self.error(409, "Conflict: can't use getUpdates method while webhook is active")
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        timeout = float(params.get("timeout") or 0)
+        self.updates = [u for u in self.updates if u["update_id"] >= offset]
+        if not self.updates and timeout:
+            self.new_updates.clear()
+            try:
+                await asyncio.wait_for(self.new_updates.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.stats["getUpdates"]["delivered"] += len(self.updates[:limit])
+        return self.ok(self.updates[:limit])
+
+    # ─── Управление ──────────────────────────────────────────────────────────
+
+    async def inject(self, request: web.Request) -> web.Response:
+        updates = await request.json()
+        if isinstance(updates, dict):
+            updates = [updates]
+        for update in updates:
+            self.update_id += 1
+            update.setdefault("update_id", self.update_id)
+        if self.webhook:
+            asyncio.create_task(self._post_webhook(updates))
+        else:
+            self.updates.extend(updates)
+            self.new_updates.set()
+        return web.json_response({"ok": True, "queued": len(updates)})
+
+    async def _post_webhook(self, updates: list[dict]):
+        if self.client is None:
+            self.client = aiohttp.ClientSession()
+        headers = {SECRET_HEADER: self.webhook["secret"]} if self.webhook.get("secret") else {}
+        for update in updates:
+            try:
+                async with self.client.post(self.webhook["url"], json=update, headers=headers) as resp:
+                    self.stats["webhook"][resp.status] += 1
+            except aiohttp.ClientError as e:
+                self.stats["webhook"][type(e).__name__] += 1
+
+    async def get_stats(self, request: web.Request) -> web.Response:
+        return web.json_response({
+            "calls": {method: dict(codes) for method, codes in self.stats.items()},
+            "pending_updates": len(self.updates),
+            "webhook": self.webhook,
+        })
+
+    async def reset(self, request: web.Request) -> web.Response:
+        self.stats.clear()
+        self.chat_buckets.clear()
+        return web.json_response({"ok": True})
+
+    async def _close(self, app: web.Application):
+        if self.client:
+            await self.client.close()
+        if self.record:
+            self.record.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="мс")
+    parser.add_argument("--jitter", type=float, default=0.0, help="мс, равномерно сверху")
+    parser.add_argument("--global-rate", type=float, default=30.0)
+    parser.add_argument("--global-burst", type=float, default=30.0)
+    parser.add_argument("--chat-rate", type=float, default=1.0)
+    parser.add_argument("--chat-burst", type=float, default=3.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--blocked", type=int, nargs="*", default=[])
+    parser.add_argument("--record", help="JSONL-журнал вызовов")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    sim = BotApiSimulator(args)
+    web.run_app(sim.app, host=args.host, port=args.port)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,389 @@
+"""
+Нагрузочный прогон горячих путей: запись на смену и подтверждение участия.
+
+    python tools/load_bench.py --users 1000 --cities 5 --shifts 2 \
+        --main-slots 20 --reserve-slots 10 --concurrency 1000 \
+        --output bench.json --baseline prev.json
+
+Засевает базу из DATABASE_URL (только локальная/тестовая!) городами, сменами и
+пользователями с заполненной анкетой, затем гонит через настоящие роутеры бота
+синтетические нажатия — как их прислал бы Telegram:
+1. register — «Записаться» (register_shift:) и выбор кнопки из ответа бота (slot:);
+2. confirm  — «Подтверждаю» (confirm_shift:) от каждого записавшегося.
+Бот работает с подменной сессией: запросы к Bot API не уходят в сеть
+(--api-latency имитирует время ответа Telegram).
+
+Печатает и пишет в --output (JSON): пропускную способность, p50/p95/p99 задержки
+обработки обновления, число SQL-запросов и соединений пула на обновление,
+нарушения заполненности (основа/резерв сверх мест, дубли позиций и записей).
+С --baseline — разница с прошлым прогоном. Код выхода 1, если есть нарушения.
+Созданные смены, пользователи и их состояния удаляются (кроме --keep).
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from aiogram import Bot, Dispatcher  # noqa: E402
+from aiogram.client.session.base import BaseSession  # noqa: E402
+from aiogram.methods import EditMessageText, SendMessage  # noqa: E402
+from aiogram.types import Chat, Message  # noqa: E402
+
+from config import CITIES  # noqa: E402
+from database import init_db, create_shift, get_db  # noqa: E402
+from handlers import user, shift_register, admin, confirmations, shift_report, unblock  # noqa: E402
+from utils import db_stats  # noqa: E402
+from utils.fsm_storage import make_storage  # noqa: E402
+
+BENCH_BOT_TOKEN = "4242:bench"
+BENCH_ADDRESS = "load_bench"
+
+
+# ─── Подменная сессия Bot API ─────────────────────────────────────────────────
+
+class FakeSession(BaseSession):
+    """Отвечает на запросы бота без сети и запоминает последний ответ в каждый чат."""
+
+    def __init__(self, latency: float):
+        super().__init__()
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self.markups: dict[int, object] = {}
+        self.texts: dict[int, str] = {}
+
+    async def make_request(self, bot: Bot, method, timeout=None):
+        self.calls[type(method).__name__] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        if isinstance(method, (SendMessage, EditMessageText)):
+            self.markups[method.chat_id] = method.reply_markup
+            self.texts[method.chat_id] = method.text
+        if isinstance(method, SendMessage):
+            return Message(
+                message_id=1,
+                date=datetime.now(timezone.utc),
+                chat=Chat(id=method.chat_id, type="private"),
+                text=method.text,
+            )
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536,
+                             raise_for_status=True):
+        raise NotImplementedError
+        yield b""
+
+    async def close(self):
+        pass
+
+
+# ─── Данные ───────────────────────────────────────────────────────────────────
+
+async def seed(args) -> tuple[list[dict], dict[int, dict]]:
+    """Смены по городам и пользователи с анкетой; пользователь → своя смена."""
+    shift_date = date.today() + timedelta(days=1)
+    shifts = []
+    for city in CITIES[:args.cities]:
+        for n in range(args.shifts):
+            shift_id = await create_shift(
+                city, shift_date.strftime("%d.%m.%Y"), BENCH_ADDRESS, "1000", "",
+                args.main_slots, args.reserve_slots, "18:00", "08:00", shift_date,
+            )
+            shifts.append({"id": shift_id, "city": city})
+
+    rnd = random.Random(args.seed)
+    ids = [args.first_user + i for i in range(args.users)]
+    targets = {tid: rnd.choice(shifts) for tid in ids}
+    async with get_db("bench_seed") as db:
+        async with db.transaction():
+            await db.execute(
+                """INSERT INTO users (telegram_id, username)
+                   SELECT t, 'bench' || t FROM unnest($1::BIGINT[]) t
+                   ON CONFLICT (telegram_id) DO NOTHING""",
+                ids,
+            )
+            await db.execute(
+                """INSERT INTO user_profiles (telegram_id, city, full_name, age, phone)
+                   SELECT t, c, 'Bench ' || t, 25, '+7900' || t
+                   FROM unnest($1::BIGINT[], $2::TEXT[]) AS u(t, c)
+                   ON CONFLICT (telegram_id) DO NOTHING""",
+                ids, [targets[t]["city"] for t in ids],
+            )
+    return shifts, targets
+
+
+async def violations(shift_ids: list[int]) -> list[dict]:
+    """Смены, где занято больше мест, чем есть, или есть дубли позиций/записей."""
+    async with get_db("bench_verify") as db:
+        rows = await db.fetch(
+            """WITH active AS (
+                   SELECT * FROM shift_members
+                   WHERE shift_id = ANY($1) AND status NOT IN ('refused','removed')
+               )
+               SELECT s.id, s.main_slots, s.reserve_slots,
+                      COUNT(a.id) FILTER (WHERE a.member_type = 'main') AS main_taken,
+                      COUNT(a.id) FILTER (WHERE a.member_type = 'reserve') AS reserve_taken,
+                      COUNT(a.id) - COUNT(DISTINCT (a.member_type, a.position)) AS dup_positions,
+                      COUNT(a.id) - COUNT(DISTINCT a.telegram_id) AS dup_members
+               FROM shifts s
+               LEFT JOIN active a ON a.shift_id = s.id
+               WHERE s.id = ANY($1)
+               GROUP BY s.id""",
+            shift_ids,
+        )
+    return [
+        dict(r) for r in rows
+        if r["main_taken"] > r["main_slots"] or r["reserve_taken"] > r["reserve_slots"]
+        or r["dup_positions"] or r["dup_members"]
+    ]
+
+
+async def members(shift_ids: list[int]) -> list[tuple[int, int]]:
+    async with get_db("bench_members") as db:
+        rows = await db.fetch(
+            """SELECT shift_id, telegram_id FROM shift_members
+               WHERE shift_id = ANY($1) AND status NOT IN ('refused','removed')""",
+            shift_ids,
+        )
+    return [(r["shift_id"], r["telegram_id"]) for r in rows]
+
+
+async def cleanup(args, shift_ids: list[int], bot_id: int):
+    last_user = args.first_user + args.users
+    async with get_db("bench_cleanup") as db:
+        async with db.transaction():
+            await db.execute("DELETE FROM shifts WHERE id = ANY($1)", shift_ids)
+            await db.execute(
+                "DELETE FROM outbox WHERE chat_id >= $1 AND chat_id < $2",
+                args.first_user, last_user,
+            )
+            await db.execute(
+                "DELETE FROM users WHERE telegram_id >= $1 AND telegram_id < $2",
+                args.first_user, last_user,
+            )
+            await db.execute("DELETE FROM fsm_storage WHERE key LIKE $1", f"{bot_id}:%")
+
+
+# ─── Прогон ───────────────────────────────────────────────────────────────────
+
+def callback_update(update_id: int, telegram_id: int, data: str) -> dict:
+    chat = {"id": telegram_id, "type": "private"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": {"id": telegram_id, "is_bot": False, "first_name": f"Bench{telegram_id}"},
+            "chat_instance": "bench",
+            "data": data,
+            "message": {
+                "message_id": 1, "date": int(time.time()), "chat": chat, "text": "…",
+            },
+        },
+    }
+
+
+def _db_totals() -> tuple[int, int]:
+    stats = db_stats.stats().values()
+    return sum(s.queries for s in stats), sum(s.exec.count for s in stats)
+
+
+def _latency(values: list[float]) -> dict:
+    ms = sorted(v * 1000 for v in values)
+    if not ms:
+        return {}
+    if len(ms) == 1:
+        return {"p50": ms[0], "p95": ms[0], "p99": ms[0], "max": ms[0]}
+    q = statistics.quantiles(ms, n=100, method="inclusive")
+    return {
+        "p50": round(q[49], 3), "p95": round(q[94], 3),
+        "p99": round(q[98], 3), "max": round(ms[-1], 3),
+    }
+
+
+class Phase:
+    """Задержки и ошибки одного этапа; ключ — префикс callback (до первого ':')."""
+
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self.samples: dict[str, list[float]] = {}
+        self.errors: Counter = Counter()
+
+    async def feed(self, update: dict):
+        label = update["callback_query"]["data"].split(":")[0]
+        started = time.perf_counter()
+        try:
+            await self.dp.feed_raw_update(self.bot, update)
+        except Exception as e:
+            self.errors[f"{label}: {type(e).__name__}"] += 1
+        finally:
+            self.samples.setdefault(label, []).append(time.perf_counter() - started)
+
+    async def run(self, flows, concurrency: int) -> dict:
+        sem = asyncio.Semaphore(concurrency)
+
+        async def bounded(flow):
+            async with sem:
+                await flow
+
+        queries, acquires = _db_totals()
+        started = time.perf_counter()
+        await asyncio.gather(*(bounded(f) for f in flows))
+        elapsed = time.perf_counter() - started
+        queries_after, acquires_after = _db_totals()
+
+        updates = sum(len(v) for v in self.samples.values())
+        everything = [x for v in self.samples.values() for x in v]
+        return {
+            "updates": updates,
+            "seconds": round(elapsed, 3),
+            "throughput": round(updates / elapsed, 1) if elapsed else 0,
+            "latency_ms": _latency(everything),
+            "handlers": {label: _latency(v) for label, v in self.samples.items()},
+            "db_queries_per_update": round((queries_after - queries) / max(updates, 1), 2),
+            "db_acquires_per_update": round((acquires_after - acquires) / max(updates, 1), 2),
+            "errors": dict(self.errors),
+        }
+
+
+def _outcome(text: str | None) -> str:
+    if not text:
+        return "no_slots"
+    if text.startswith("✅"):
+        return "registered"
+    if text.startswith("😔"):
+        return "lost_race"
+    return "other"
+
+
+async def run(args) -> dict:
+    await init_db()
+    session = FakeSession(args.api_latency / 1000)
+    bot = Bot(BENCH_BOT_TOKEN, session=session)
+    dp = Dispatcher(storage=make_storage())
+    # Порядок роутеров — как в main.py
+    for module in (admin, confirmations, shift_report, user, shift_register, unblock):
+        dp.include_router(module.router)
+
+    shifts, targets = await seed(args)
+    shift_ids = [s["id"] for s in shifts]
+    result = {
+        "started_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "params": vars(args),
+        "phases": {},
+    }
+    update_ids = iter(range(1, 10**9))
+    outcomes: Counter = Counter()
+
+    try:
+        register = Phase(bot, dp)
+
+        async def register_flow(tid: int, shift_id: int):
+            session.markups.pop(tid, None)
+            session.texts.pop(tid, None)
+            await register.feed(callback_update(next(update_ids), tid, f"register_shift:{shift_id}"))
+            markup = session.markups.get(tid)
+            if markup is None:
+                outcomes[_outcome(None)] += 1
+                return
+            # Первая предложенная кнопка: основа, если есть места, иначе резерв
+            slot = markup.inline_keyboard[0][0].callback_data
+            await register.feed(callback_update(next(update_ids), tid, slot))
+            outcomes[_outcome(session.texts.get(tid))] += 1
+
+        result["phases"]["register"] = await register.run(
+            [register_flow(tid, s["id"]) for tid, s in targets.items()], args.concurrency,
+        )
+
+        confirm = Phase(bot, dp)
+        result["phases"]["confirm"] = await confirm.run(
+            [
+                confirm.feed(callback_update(next(update_ids), tid, f"confirm_shift:{shift_id}"))
+                for shift_id, tid in await members(shift_ids)
+            ],
+            args.concurrency,
+        )
+
+        await dp.storage.close()
+        result["outcomes"] = dict(outcomes)
+        result["api_calls"] = dict(session.calls)
+        result["violations"] = await violations(shift_ids)
+    finally:
+        if not args.keep:
+            await cleanup(args, shift_ids, bot.id)
+    return result
+
+
+# ─── Вывод ────────────────────────────────────────────────────────────────────
+
+def _delta(now: float, before: float | None) -> str:
+    if not before:
+        return ""
+    return f" ({(now - before) / before * 100:+.1f}%)"
+
+
+def print_report(result: dict, baseline: dict | None):
+    for name, phase in result["phases"].items():
+        old = (baseline or {}).get("phases", {}).get(name, {})
+        lat, old_lat = phase["latency_ms"], old.get("latency_ms", {})
+        print(f"\n[{name}] {phase['updates']} обновлений за {phase['seconds']} с — "
+              f"{phase['throughput']}/с{_delta(phase['throughput'], old.get('throughput'))}")
+        if lat:
+            print("  задержка, мс: " + ", ".join(
+                f"{q} {lat[q]:.1f}{_delta(lat[q], old_lat.get(q))}" for q in ("p50", "p95", "p99")
+            ))
+        for label, h in phase["handlers"].items():
+            print(f"    {label}: p50 {h['p50']:.1f} / p95 {h['p95']:.1f} / p99 {h['p99']:.1f}")
+        print(f"  SQL на обновление: {phase['db_queries_per_update']}"
+              f"{_delta(phase['db_queries_per_update'], old.get('db_queries_per_update'))}, "
+              f"соединений пула: {phase['db_acquires_per_update']}")
+        if phase["errors"]:
+            print(f"  ошибки: {phase['errors']}")
+    print(f"\nИтоги записи: {result.get('outcomes')}")
+    print(f"Вызовы Bot API: {result.get('api_calls')}")
+    bad = result.get("violations") or []
+    print(f"Нарушения заполненности: {len(bad)}")
+    for row in bad:
+        print(f"  {row}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--cities", type=int, default=3)
+    parser.add_argument("--shifts", type=int, default=1, help="смен на город")
+    parser.add_argument("--main-slots", type=int, default=20)
+    parser.add_argument("--reserve-slots", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=1000)
+    parser.add_argument("--api-latency", type=float, default=0.0, help="мс на запрос к Bot API")
+    parser.add_argument("--first-user", type=int, default=8_000_000_000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="куда записать результат (JSON)")
+    parser.add_argument("--baseline", help="результат прошлого прогона для сравнения")
+    parser.add_argument("--keep", action="store_true", help="не удалять засеянные данные")
+    args = parser.parse_args()
+
+    baseline = None
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)
+
+    result = await run(args)
+    print_report(result, baseline)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2, default=str)
+    if result.get("violations"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,81 @@
+"""
+Локальная проверка вебхука: POST-ит синтетические обновления как Telegram.
+
+    python tools/webhook_harness.py --url http://127.0.0.1:8080/webhook \
+        --secret $WEBHOOK_SECRET --count 500 --users 50 --duplicates 0.1
+
+Каждое обновление — текстовое сообщение от одного из --users пользователей;
+доля --duplicates отправляется повторно с тем же update_id (повторная доставка).
+Печатает коды ответов и скорость приёма.
+"""
+
+import argparse
+import asyncio
+import random
+import time
+from collections import Counter
+
+import aiohttp
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+def synthetic_update(update_id: int, user_id: int, text: str) -> dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"User{user_id}"}
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private", "first_name": user["first_name"]},
+            "from": user,
+            "text": text,
+        },
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://127.0.0.1:8080/webhook")
+    parser.add_argument("--secret", default="")
+    parser.add_argument("--count", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--first-user", type=int, default=900_000_000)
+    parser.add_argument("--duplicates", type=float, default=0.0)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--text", default="привет")
+    args = parser.parse_args()
+
+    updates = [
+        synthetic_update(
+            1_000_000 + i, args.first_user + random.randrange(args.users), args.text,
+        )
+        for i in range(args.count)
+    ]
+    updates += random.sample(updates, int(len(updates) * args.duplicates))
+    random.shuffle(updates)
+
+    statuses = Counter()
+    sem = asyncio.Semaphore(args.concurrency)
+    headers = {SECRET_HEADER: args.secret} if args.secret else {}
+
+    async with aiohttp.ClientSession(headers=headers) as session:
+        async def post(update: dict):
+            async with sem:
+                try:
+                    async with session.post(args.url, json=update) as resp:
+                        statuses[resp.status] += 1
+                except aiohttp.ClientError as e:
+                    statuses[type(e).__name__] += 1
+
+        started = time.monotonic()
+        await asyncio.gather(*(post(u) for u in updates))
+        elapsed = time.monotonic() - started
+
+    print(f"Отправлено {len(updates)} за {elapsed:.2f} с ({len(updates) / elapsed:.0f}/с)")
+    for status, n in sorted(statuses.items(), key=lambda x: str(x[0])):
+        print(f"  {status}: {n}")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,150 @@
+"""
+Очередь уведомлений админу.
+Рядовые события (записи, подтверждения, отказы, переводы из резерва) копятся
+по сменам и типам и уходят одной сводкой раз в ADMIN_DIGEST_INTERVAL секунд.
+Срочные (блокировка, пустой резерв) отправляются сразу, минуя интервал.
+Хендлеры только кладут событие в очередь и не ждут отправки.
+Строки событий — простой текст (экранируются здесь), срочные уведомления — готовый
+HTML: введённые пользователем значения в них экранирует вызывающий.
+"""
+
+import asyncio
+import html
+import logging
+
+from aiogram import Bot
+
+from config import ADMIN_ID, ADMIN_DIGEST_INTERVAL
+from utils.broadcast import deliver
+
+logger = logging.getLogger(__name__)
+
+# Заголовки групп сводки в порядке вывода
+EVENT_TITLES = {
+    "signup": "📝 Новые записи",
+    "filled": "🎉 Заполнено",
+    "confirm": "✅ Подтвердили",
+    "morning_confirm": "🌅 Утром подтвердили",
+    "refuse": "❌ Отказались",
+    "ignored": "⏰ Сняты за игнор",
+    "promoted": "🔄 Резерв → основа",
+}
+
+MESSAGE_LIMIT = 4000
+NAMES_PER_GROUP = 30
+
+
+class AdminDigest:
+    def __init__(self):
+        self.bot: Bot | None = None
+        # shift_id → (заголовок смены, {тип события → строки})
+        self._shifts: dict[int, tuple[str, dict[str, list[str]]]] = {}
+        self._pending = asyncio.Event()
+        self._urgent: asyncio.Queue[str] = asyncio.Queue()
+        # Готовые к отправке сообщения; удаляются только после отправки,
+        # чтобы остановка бота посреди рассылки их не потеряла
+        self._outbox: list[str] = []
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._tasks = [
+            asyncio.create_task(self._run_digest()),
+            asyncio.create_task(self._run_urgent()),
+        ]
+
+    async def shutdown(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        while not self._urgent.empty():
+            self._outbox.append(self._urgent.get_nowait())
+        await self.flush()
+
+    def event(self, kind: str, shift: dict, line: str):
+        # Один «<» или «&» в имени — и Telegram отклонит всю сводку по всем сменам
+        title = html.escape(f"📅 {shift['date']} | {shift['city']}")
+        _, events = self._shifts.setdefault(shift["id"], (title, {}))
+        events.setdefault(kind, []).append(html.escape(line))
+        self._pending.set()
+
+    def alert(self, text: str):
+        self._urgent.put_nowait(text)
+
+    def _render(self) -> list[str]:
+        """Сводка, разбитая на сообщения не длиннее лимита Telegram."""
+        shifts, self._shifts = self._shifts, {}
+        blocks = []
+        for title, events in shifts.values():
+            lines = [title]
+            for kind, header in EVENT_TITLES.items():
+                names = events.get(kind)
+                if not names:
+                    continue
+                shown = names[:NAMES_PER_GROUP]
+                more = f" … и ещё {len(names) - len(shown)}" if len(names) > len(shown) else ""
+                lines.append(f"{header} ({len(names)}): " + ", ".join(shown) + more)
+            blocks.append("\n".join(lines))
+
+        messages, current = [], "🗂 <b>Сводка событий</b>"
+        for block in blocks:
+            if len(current) + len(block) + 2 > MESSAGE_LIMIT:
+                messages.append(current)
+                current = block[:MESSAGE_LIMIT]
+            else:
+                current += "\n\n" + block
+        messages.append(current)
+        return messages
+
+    async def _send(self, text: str) -> bool:
+        bot = self.bot
+        if bot is None:
+            return False
+        return await deliver(ADMIN_ID, lambda: bot.send_message(ADMIN_ID, text, parse_mode="HTML"))
+
+    async def flush(self):
+        self._pending.clear()
+        if self._shifts:
+            self._outbox.extend(self._render())
+        while self._outbox:
+            if not await self._send(self._outbox[0]):
+                # Не доставлено — оставляем в очереди до следующего интервала
+                logger.error(f"Сводка админу не доставлена, в очереди: {len(self._outbox)}")
+                self._pending.set()
+                return
+            self._outbox.pop(0)
+
+    async def _run_digest(self):
+        while True:
+            await self._pending.wait()
+            await asyncio.sleep(ADMIN_DIGEST_INTERVAL)
+            try:
+                await self.flush()
+            except Exception as e:
+                logger.error(f"Сводка админу: {e}")
+
+    async def _run_urgent(self):
+        while True:
+            text = await self._urgent.get()
+            try:
+                delivered = await self._send(text)
+            except Exception as e:
+                logger.error(f"Срочное уведомление админу: {e}")
+                delivered = False
+            if not delivered:
+                # Не теряем: уйдёт со следующей сводкой
+                self._outbox.append(text)
+                self._pending.set()
+
+
+digest = AdminDigest()
+
+
+def admin_event(kind: str, shift: dict, line: str):
+    """Рядовое событие по смене → в ближайшую сводку."""
+    digest.event(kind, shift, line)
+
+
+def admin_alert(text: str):
+    """Срочное уведомление — отправляется сразу, без ожидания сводки."""
+    digest.alert(text)
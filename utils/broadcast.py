@@ -0,0 +1,192 @@
+"""
+Рассылки с учётом лимитов Telegram.
+• Общий token bucket на бота (~30 сообщений/сек) + лимит на один чат
+• Ограниченное число параллельных отправок
+• RetryAfter (429) — пауза для всех отправителей, сетевые/5xx — повтор с backoff
+• Живое сообщение-прогресс «отправлено X / не доставлено Y»
+"""
+
+import asyncio
+import logging
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Iterable
+
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import Message
+
+from config import BROADCAST_RATE, BROADCAST_PER_CHAT_RATE, BROADCAST_CONCURRENCY
+
+logger = logging.getLogger(__name__)
+
+SEND_ATTEMPTS = 4          # попыток на одно сообщение при временных ошибках
+BACKOFF_BASE = 0.5         # секунды, удваивается с каждой попыткой
+PROGRESS_INTERVAL = 3.0    # как часто обновлять сообщение-прогресс
+
+
+# ─── Лимитер ──────────────────────────────────────────────────────────────────
+
+class RateLimiter:
+    """Глобальный token bucket + минимальный интервал между сообщениями в один чат."""
+
+    def __init__(self, rate: float, per_chat_rate: float):
+        self.rate = rate
+        self.capacity = rate
+        self.chat_interval = 1.0 / per_chat_rate
+        self._tokens = rate
+        self._updated = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = asyncio.Lock()
+        self._chat_next: dict[int, float] = {}
+
+    def pause(self, seconds: float):
+        """Telegram вернул 429 — все отправители ждут retry_after."""
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+        self._tokens = 0
+
+    async def _acquire_chat(self, chat_id: int):
+        now = time.monotonic()
+        slot = max(now, self._chat_next.get(chat_id, 0.0))
+        self._chat_next[chat_id] = slot + self.chat_interval
+        if len(self._chat_next) > 10_000:
+            self._chat_next = {c: t for c, t in self._chat_next.items() if t > now}
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+    async def acquire(self, chat_id: int):
+        await self._acquire_chat(chat_id)
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                if now < self._paused_until:
+                    await asyncio.sleep(self._paused_until - now)
+                    continue
+                self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+
+limiter = RateLimiter(BROADCAST_RATE, BROADCAST_PER_CHAT_RATE)
+
+
+# ─── Одна отправка ────────────────────────────────────────────────────────────
+
+async def deliver(
+    chat_id: int,
+    call: Callable[[], Awaitable],
+    attempts: int = SEND_ATTEMPTS,
+    wait_flood: bool = True,
+) -> bool:
+    """
+    Выполнить вызов Bot API для chat_id через общий лимитер.
+    True — доставлено, False — окончательная ошибка (бот заблокирован, чат не найден и т.п.).
+    attempts — попытки при временных ошибках; RetryAfter их не тратит: сообщение
+    не отклонено, просто надо подождать. wait_flood=False — на RetryAfter сдаёмся
+    сразу (необязательные правки вроде прогресса рассылки).
+    """
+    attempt = 0
+    while attempt < attempts:
+        await limiter.acquire(chat_id)
+        try:
+            await call()
+            return True
+        except TelegramRetryAfter as e:
+            logger.warning(f"RetryAfter {e.retry_after}s (чат {chat_id})")
+            limiter.pause(e.retry_after)
+            if not wait_flood:
+                return False
+        except (TelegramNetworkError, TelegramServerError) as e:
+            delay = BACKOFF_BASE * (2 ** attempt)
+            attempt += 1
+            logger.warning(f"Временная ошибка отправки {chat_id}: {e}, повтор через {delay}s")
+            await asyncio.sleep(delay)
+        except TelegramAPIError as e:
+            logger.info(f"Не доставлено {chat_id}: {e}")
+            return False
+        except Exception:
+            # Одна сломанная отправка не должна обрывать всю рассылку
+            logger.exception(f"Не доставлено {chat_id}: непредвиденная ошибка")
+            return False
+    return False
+
+
+# ─── Рассылка ─────────────────────────────────────────────────────────────────
+
+@dataclass
+class BroadcastResult:
+    total: int = 0
+    sent: int = 0
+    failed: int = 0
+
+    @property
+    def done(self) -> int:
+        return self.sent + self.failed
+
+
+async def _edit_progress(message: Message, text: str):
+    # Прогресс не должен ждать флуд-контроль и тормозить саму рассылку
+    await deliver(
+        message.chat.id, lambda: message.edit_text(text, parse_mode="HTML"),
+        attempts=1, wait_flood=False,
+    )
+
+
+async def broadcast(
+    chat_ids: Iterable[int],
+    send: Callable[[int], Awaitable],
+    progress: Message | None = None,
+    render: Callable[[BroadcastResult], str] | None = None,
+    concurrency: int = BROADCAST_CONCURRENCY,
+) -> BroadcastResult:
+    """
+    Разослать send(chat_id) всем chat_ids.
+    Если передан progress — раз в PROGRESS_INTERVAL сек. редактирует его текстом render(result).
+    Финальное сообщение с итогом вызывающий код формирует сам.
+    """
+    chat_ids = list(chat_ids)
+    result = BroadcastResult(total=len(chat_ids))
+    queue = iter(chat_ids)
+
+    async def worker():
+        for chat_id in queue:
+            if await deliver(chat_id, lambda: send(chat_id)):
+                result.sent += 1
+            else:
+                result.failed += 1
+
+    async def reporter():
+        last = -1
+        while True:
+            await asyncio.sleep(PROGRESS_INTERVAL)
+            if result.done != last:
+                last = result.done
+                await _edit_progress(progress, render(result))
+
+    reporter_task = None
+    if progress is not None and render is not None:
+        await _edit_progress(progress, render(result))
+        reporter_task = asyncio.create_task(reporter())
+
+    try:
+        await asyncio.gather(*(worker() for _ in range(max(1, min(concurrency, len(chat_ids))))))
+    finally:
+        if reporter_task:
+            reporter_task.cancel()
+
+    logger.info(f"Рассылка: отправлено {result.sent}, не доставлено {result.failed}")
+    return result
+
+
+def progress_line(result: BroadcastResult) -> str:
+    return (
+        f"📨 Рассылка: отправлено {result.sent} из {result.total}, "
+        f"не доставлено {result.failed}"
+    )
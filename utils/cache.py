@@ -0,0 +1,53 @@
+"""
+Кэш в памяти процесса с TTL и ограничением размера (вытесняется самая старая запись).
+Запись не сохраняется, если пока шёл запрос к базе ключ успели инвалидировать —
+иначе в кэш попали бы данные, прочитанные до изменения.
+"""
+
+import time
+from collections import OrderedDict
+
+MISSING = object()
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict = OrderedDict()
+        self._generation = 0
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key):
+        item = self._data.get(key)
+        if item is None:
+            return MISSING
+        expires, value = item
+        if expires < time.monotonic():
+            del self._data[key]
+            return MISSING
+        self._data.move_to_end(key)
+        return value
+
+    def stamp(self) -> int:
+        """Запомнить перед чтением из базы и передать в set()."""
+        return self._generation
+
+    def set(self, key, value, stamp: int | None = None):
+        if self.ttl <= 0 or (stamp is not None and stamp != self._generation):
+            return  # ttl 0 — кэш выключен
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.maxsize:
+            self._data.popitem(last=False)
+
+    def invalidate(self, *keys):
+        self._generation += 1
+        for key in keys:
+            self._data.pop(key, None)
+
+    def clear(self):
+        self._generation += 1
+        self._data.clear()
@@ -0,0 +1,115 @@
+"""
+Даты смен.
+Админ вводит дату свободным текстом («25.07.2025», «Суббота 26 июля»), здесь она
+разбирается в настоящую DATE, а по часовому поясу города заранее считаются моменты
+(UTC) вечернего и утреннего напоминания и начала смены.
+"""
+
+import re
+from datetime import date, datetime, time, timedelta, timezone
+
+from city_timezones import get_city_tz
+
+MONTHS = {
+    "янв": 1, "фев": 2, "мар": 3, "апр": 4, "мая": 5, "май": 5,
+    "июн": 6, "июл": 7, "авг": 8, "сен": 9, "окт": 10, "ноя": 11, "дек": 12,
+}
+
+_NUMERIC = re.compile(r"\b(\d{1,2})[./-](\d{1,2})(?:[./-](\d{2}|\d{4}))?\b")
+_ISO = re.compile(r"\b(\d{4})-(\d{1,2})-(\d{1,2})\b")
+_WORDS = re.compile(r"\b(\d{1,2})\s+([а-яё]+)(?:\s+(\d{4}))?", re.IGNORECASE)
+
+
+def _with_year(day: int, month: int, year: int | None, today: date) -> date | None:
+    try:
+        if year is not None:
+            return date(year if year >= 100 else 2000 + year, month, day)
+        candidate = date(today.year, month, day)
+        if candidate < today:
+            candidate = date(today.year + 1, month, day)
+        return candidate
+    except ValueError:
+        return None
+
+
+def parse_shift_date(text: str, today: date) -> date | None:
+    """
+    Разобрать дату смены. Без года — ближайшая такая дата не раньше today.
+    Возвращает None, если дату распознать не удалось.
+    """
+    text = (text or "").strip().lower()
+
+    m = _ISO.search(text)
+    if m:
+        try:
+            return date(int(m[1]), int(m[2]), int(m[3]))
+        except ValueError:
+            return None
+
+    m = _NUMERIC.search(text)
+    if m:
+        return _with_year(int(m[1]), int(m[2]), int(m[3]) if m[3] else None, today)
+
+    m = _WORDS.search(text)
+    if m:
+        month = MONTHS.get(m[2][:3])
+        if month:
+            return _with_year(int(m[1]), month, int(m[3]) if m[3] else None, today)
+
+    return None
+
+
+def parse_hhmm(value: str | None) -> time | None:
+    try:
+        h, m = (int(p) for p in (value or "").split(":"))
+        return time(h, m)
+    except ValueError:
+        return None
+
+
+def shift_instants(
+    city: str,
+    shift_date: date | None,
+    reminder_time: str | None,
+    morning_reminder_time: str | None,
+    created_at: datetime | None = None,
+) -> dict:
+    """
+    Моменты смены в UTC:
+    • starts_at — начало дня смены (местная полночь)
+    • reminder_at — вечернее напоминание накануне
+    • morning_reminder_at — утреннее напоминание в день смены
+    Если «накануне» уже прошло на момент создания — вечернее уходит в ближайшее
+    reminder_time, но не позже дня смены (иначе вечернего напоминания нет).
+    """
+    instants = {"starts_at": None, "reminder_at": None, "morning_reminder_at": None}
+    if shift_date is None:
+        return instants
+
+    tz = get_city_tz(city)
+    created_at = created_at or datetime.now(timezone.utc)
+
+    instants["starts_at"] = datetime.combine(shift_date, time(0, 0), tzinfo=tz).astimezone(timezone.utc)
+
+    morning = parse_hhmm(morning_reminder_time)
+    if morning:
+        instants["morning_reminder_at"] = (
+            datetime.combine(shift_date, morning, tzinfo=tz).astimezone(timezone.utc)
+        )
+
+    evening = parse_hhmm(reminder_time)
+    if evening:
+        at = datetime.combine(shift_date - timedelta(days=1), evening, tzinfo=tz)
+        if at < created_at:
+            created_local = created_at.astimezone(tz)
+            at = datetime.combine(created_local.date(), evening, tzinfo=tz)
+            if at < created_at:
+                at += timedelta(days=1)
+        if at < instants["starts_at"] + timedelta(days=1):
+            instants["reminder_at"] = at.astimezone(timezone.utc)
+
+    return instants
+
+
+def format_date(value: date) -> str:
+    return value.strftime("%d.%m.%Y")
@@ -0,0 +1,146 @@
+"""
+Время запросов к базе по именам (имя = функция database.py).
+• wait — сколько ждали свободное соединение пула
+• exec — сколько соединение было занято запросом(ами) функции
+Запросы дольше DB_SLOW_QUERY_MS пишутся в лог: текст SQL и типы параметров,
+сами значения (телефоны, имена, id) в лог не попадают.
+"""
+
+import functools
+import logging
+import re
+import time
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+
+import asyncpg
+from asyncpg.connection import LoggedQuery
+
+from config import DB_SLOW_QUERY_MS, DB_ACQUIRE_TIMEOUT
+from utils.histogram import Histogram
+
+logger = logging.getLogger(__name__)
+
+SQL_LOG_LIMIT = 300
+REPORT_TOP = 15
+
+current_query: ContextVar[str | None] = ContextVar("current_query", default=None)
+
+
+class QueryStat:
+    def __init__(self):
+        self.wait = Histogram()
+        self.exec = Histogram()
+        self.queries = 0        # SQL-выражений (одна функция может выполнить несколько)
+        self.slow = 0
+        self.errors = 0
+
+
+_stats: dict[str, QueryStat] = {}
+
+
+def stats() -> dict[str, QueryStat]:
+    return _stats
+
+
+def _stat(name: str) -> QueryStat:
+    stat = _stats.get(name)
+    if stat is None:
+        stat = _stats[name] = QueryStat()
+    return stat
+
+
+def timed(fn):
+    """Всё, что функция делает с базой, учитывается под её именем."""
+    @functools.wraps(fn)
+    async def wrapper(*args, **kwargs):
+        token = current_query.set(fn.__name__)
+        try:
+            return await fn(*args, **kwargs)
+        finally:
+            current_query.reset(token)
+    return wrapper
+
+
+@asynccontextmanager
+async def acquire(pool: asyncpg.Pool):
+    """pool.acquire() с замером ожидания соединения и времени работы с ним."""
+    stat = _stat(current_query.get() or "—")
+    started = time.perf_counter()
+    token = None
+    try:
+        async with pool.acquire(timeout=DB_ACQUIRE_TIMEOUT) as conn:
+            acquired = time.perf_counter()
+            stat.wait.observe(acquired - started)
+            try:
+                yield conn
+            finally:
+                stat.exec.observe(time.perf_counter() - acquired)
+                # Connection.reset при возврате в пул идёт внутри __aexit__ —
+                # без имени запроса его отбросит log_query
+                token = current_query.set(None)
+    finally:
+        if token is not None:
+            current_query.reset(token)
+
+
+def _redact(args: tuple) -> str:
+    def kind(value) -> str:
+        if value is None:
+            return "NULL"
+        if isinstance(value, (list, tuple)):
+            return f"{type(value).__name__}[{len(value)}]"
+        if isinstance(value, (str, bytes)):
+            return f"{type(value).__name__}({len(value)})"
+        return type(value).__name__
+    return "(" + ", ".join(kind(a) for a in args) + ")"
+
+
+def log_query(record: LoggedQuery):
+    """Query logger соединений пула (см. database.init_db)."""
+    name = current_query.get()
+    if name is None:
+        return  # служебные запросы пула (reset при возврате соединения)
+    _stat(name).queries += 1
+    if record.exception is not None:
+        _stat(name).errors += 1
+    elapsed_ms = record.elapsed * 1000
+    if elapsed_ms >= DB_SLOW_QUERY_MS:
+        _stat(name).slow += 1
+        sql = re.sub(r"\s+", " ", record.query).strip()[:SQL_LOG_LIMIT]
+        logger.warning(
+            f"Медленный запрос {name}: {elapsed_ms:.0f} мс, "
+            f"параметры {_redact(record.args or ())}: {sql}"
+        )
+
+
+def _ms(seconds: float) -> str:
+    return f"{seconds * 1000:.1f}"
+
+
+def report(pool: dict) -> str:
+    """Текст для админа: пул + самые затратные запросы по суммарному времени."""
+    lines = [
+        "🗄 <b>База данных</b>",
+        f"Пул: занято {pool['size'] - pool['idle']} из {pool['size']} "
+        f"(мин {pool['min']}, макс {pool['max']})",
+        "",
+        "<b>Запросы</b> (мс: ожидание p99 | выполнение p50/p95/p99)",
+    ]
+    top = sorted(_stats.items(), key=lambda kv: kv[1].exec.sum + kv[1].wait.sum, reverse=True)
+    for name, s in top[:REPORT_TOP]:
+        if not s.exec.count:
+            continue
+        extra = ""
+        if s.slow:
+            extra += f", медленных {s.slow}"
+        if s.errors:
+            extra += f", ошибок {s.errors}"
+        lines.append(
+            f"• <code>{name}</code> ×{s.exec.count}: {_ms(s.wait.quantile(0.99))} | "
+            f"{_ms(s.exec.quantile(0.5))}/{_ms(s.exec.quantile(0.95))}/"
+            f"{_ms(s.exec.quantile(0.99))}{extra}"
+        )
+    if len(lines) == 4:
+        lines.append("Пока нет данных")
+    return "\n".join(lines)
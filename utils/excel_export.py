@@ -1,32 +1,149 @@
-import io
+"""
+Excel-выгрузки: база сотрудников города и отчёт по смене.
+Строки читаются из базы курсором пачками и складываются во временный файл
+(сериализация пачки и ширина колонок — в потоке-исполнителе). Сама книга (write-only openpyxl) собирается
+в отдельном потоке и сохраняется во временный .xlsx — бот не замирает,
+а память не растёт с числом строк. Вызывающий удаляет файл после отправки.
+"""
+
+import asyncio
+import os
+import pickle
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+
 from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
 from openpyxl.styles import Font, PatternFill, Alignment
+from openpyxl.utils import get_column_letter
+
+from config import EXPORT_WORKERS
 from database import get_db
 
 HEADER_FILL = PatternFill("solid", fgColor="4F81BD")
 HEADER_FONT = Font(color="FFFFFF", bold=True)
 
-
-def _write_header_row(ws, headers: list[str], row: int):
-    for col, h in enumerate(headers, 1):
-        cell = ws.cell(row, col, h)
-        cell.fill = HEADER_FILL
-        cell.font = HEADER_FONT
-        cell.alignment = Alignment(horizontal="center")
-
-
-def _autowidth(ws):
-    for col in ws.columns:
-        try:
-            width = max(len(str(cell.value or "")) for cell in col) + 4
-            ws.column_dimensions[col[0].column_letter].width = width
-        except AttributeError:
-            pass
+# Строк за одно чтение курсора
+CHUNK_SIZE = 1000
+
+_executor = ThreadPoolExecutor(max_workers=EXPORT_WORKERS, thread_name_prefix="excel")
+
+
+class _Spool:
+    """Готовые строки листа во временном файле + ширина колонок по ходу записи."""
+
+    def __init__(self, headers: list[str]):
+        self.headers = headers
+        self.widths = [len(h) for h in headers]
+        self.file = tempfile.TemporaryFile()
+
+    def write(self, rows: list[list]):
+        """Вызывается в потоке-исполнителе: pickle большой пачки не должен держать цикл событий."""
+        for row in rows:
+            for i, value in enumerate(row):
+                self.widths[i] = max(self.widths[i], len(str(value if value is not None else "")))
+        pickle.dump(rows, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def read(self):
+        """Читается в _build_workbook, то есть тоже в потоке-исполнителе."""
+        self.file.seek(0)
+        while True:
+            try:
+                yield from pickle.load(self.file)
+            except EOFError:
+                return
+
+    def close(self):
+        self.file.close()
+
+
+def _build_workbook(sheet_title: str, title: str, title_size: int, spool: _Spool | None) -> str:
+    """Собрать книгу в потоке-исполнителе; возвращает путь к временному .xlsx."""
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet(sheet_title)
+
+    if spool:
+        for col, width in enumerate(spool.widths, 1):
+            ws.column_dimensions[get_column_letter(col)].width = width + 4
+
+    title_cell = WriteOnlyCell(ws, value=title)
+    title_cell.font = Font(bold=True, size=title_size)
+    if spool:
+        title_cell.alignment = Alignment(horizontal="center")
+    ws.append([title_cell])
+
+    if spool:
+        ws.merged_cells.add(f"A1:{get_column_letter(len(spool.headers))}1")
+        ws.append([])
+
+        header = []
+        for h in spool.headers:
+            cell = WriteOnlyCell(ws, value=h)
+            cell.fill = HEADER_FILL
+            cell.font = HEADER_FONT
+            cell.alignment = Alignment(horizontal="center")
+            header.append(cell)
+        ws.append(header)
+
+        for row in spool.read():
+            ws.append(row)
+
+    fd, path = tempfile.mkstemp(suffix=".xlsx")
+    os.close(fd)
+    try:
+        wb.save(path)
+    except Exception:
+        os.remove(path)
+        raise
+    return path
+
+
+async def _export(sheet_title: str, title: str, title_size: int, spool: _Spool | None) -> str:
+    loop = asyncio.get_running_loop()
+    try:
+        return await loop.run_in_executor(
+            _executor, _build_workbook, sheet_title, title, title_size, spool,
+        )
+    finally:
+        if spool:
+            spool.close()
+
+
+async def _stream(spool: _Spool, query: str, *args, convert):
+    """Прочитать запрос курсором по CHUNK_SIZE строк в spool."""
+    loop = asyncio.get_running_loop()
+    async with get_db("excel_stream") as db:
+        async with db.transaction():
+            cursor = await db.cursor(query, *args)
+            while rows := await cursor.fetch(CHUNK_SIZE):
+                await loop.run_in_executor(_executor, spool.write, [convert(r) for r in rows])
+
+
+def _city_row(r) -> list:
+    return [
+        r["full_name"],
+        r["phone"],
+        f"@{r['username']}" if r["username"] else "—",
+        r["age"],
+        r["rating"],
+        r["total_shifts"],
+        r["confirmed_shifts"],
+        r["refused_shifts"],
+        r["ignored_shifts"],
+        r["consecutive_failures"],
+        "✅" if r["is_active"] else "🚫",
+    ]
 
 
-async def excel_city_base(city: str) -> io.BytesIO:
-    async with get_db() as db:
-        rows = await db.fetch(
+async def excel_city_base(city: str) -> str:
+    spool = _Spool([
+        "ФИО", "Телефон", "Telegram", "Возраст", "Рейтинг",
+        "Всего смен", "Подтверждено", "Отказов", "Игноров",
+        "Подряд провалов", "Активен"
+    ])
+    try:
+        await _stream(
+            spool,
             """
             SELECT up.full_name, up.phone, u.username,
                    up.age, up.rating, up.total_shifts, up.confirmed_shifts,
@@ -37,57 +154,53 @@ async def excel_city_base(city: str) -> io.BytesIO:
             WHERE up.city = $1
             ORDER BY up.full_name
             """,
-            city
+            city,
+            convert=_city_row,
         )
+    except Exception:
+        spool.close()
+        raise
+
+    return await _export(city, f"База сотрудников — {city}", 14, spool)
+
+
+def _shift_row(r) -> list:
+    worked = "—"
+    if r["worked"] == 1:
+        worked = "Да"
+    elif r["worked"] == 0:
+        worked = "Нет"
+
+    return [
+        r["full_name"],
+        r["phone"],
+        r["rating"],
+        "Основа" if r["member_type"] == "main" else "Резерв",
+        r["status"],
+        r["position"],
+        worked,
+        r["decline_reason"] or "",
+    ]
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = city
-
-    ws.append([f"База сотрудников — {city}"])
-    ws["A1"].font = Font(bold=True, size=14)
-    ws.merge_cells("A1:K1")
-    ws["A1"].alignment = Alignment(horizontal="center")
-    ws.append([])
 
-    headers = [
-        "ФИО", "Телефон", "Telegram", "Возраст", "Рейтинг",
-        "Всего смен", "Подтверждено", "Отказов", "Игноров",
-        "Подряд провалов", "Активен"
-    ]
-    _write_header_row(ws, headers, 3)
-
-    for r in rows:
-        ws.append([
-            r["full_name"],
-            r["phone"],
-            f"@{r['username']}" if r["username"] else "—",
-            r["age"],
-            r["rating"],
-            r["total_shifts"],
-            r["confirmed_shifts"],
-            r["refused_shifts"],
-            r["ignored_shifts"],
-            r["consecutive_failures"],
-            "✅" if r["is_active"] else "🚫",
-        ])
-
-    _autowidth(ws)
-
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf
-
-
-async def excel_shift_report(shift_id: int) -> io.BytesIO:
-    async with get_db() as db:
+async def excel_shift_report(shift_id: int) -> str:
+    async with get_db("excel_shift") as db:
         shift = await db.fetchrow(
             "SELECT * FROM shifts WHERE id = $1",
             shift_id
         )
 
-        rows = await db.fetch(
+    # Если смена не найдена — не падаем, а формируем понятный файл
+    if not shift:
+        return await _export(f"Смена {shift_id}", f"Смена #{shift_id} не найдена", 12, None)
+
+    spool = _Spool([
+        "ФИО", "Телефон", "Рейтинг",
+        "Тип", "Статус", "Позиция", "Отработал", "Причина"
+    ])
+    try:
+        await _stream(
+            spool,
             """
             SELECT up.full_name, up.phone, up.rating,
                    sm.member_type, sm.status, sm.position,
@@ -99,57 +212,12 @@ async def excel_shift_report(shift_id: int) -> io.BytesIO:
             WHERE sm.shift_id = $1
             ORDER BY sm.member_type, sm.position
             """,
-            shift_id
+            shift_id,
+            convert=_shift_row,
         )
+    except Exception:
+        spool.close()
+        raise
 
-    wb = Workbook()
-    ws = wb.active
-    ws.title = f"Смена {shift_id}"
-
-    # Если смена не найдена — не падаем, а формируем понятный файл
-    if not shift:
-        ws.append([f"Смена #{shift_id} не найдена"])
-        ws["A1"].font = Font(bold=True, size=12)
-        buf = io.BytesIO()
-        wb.save(buf)
-        buf.seek(0)
-        return buf
-
-    # shift: id=0, city=1, date=2, address=3 (оставляю совместимость с твоей логикой)
-    title = f"Смена #{shift_id} | {shift[1]} | {shift[2]} | {shift[3]}"
-    ws.append([title])
-    ws["A1"].font = Font(bold=True, size=12)
-    ws.merge_cells("A1:H1")
-    ws["A1"].alignment = Alignment(horizontal="center")
-    ws.append([])
-
-    headers = [
-        "ФИО", "Телефон", "Рейтинг",
-        "Тип", "Статус", "Позиция", "Отработал", "Причина"
-    ]
-    _write_header_row(ws, headers, 3)
-
-    for r in rows:
-        worked = "—"
-        if r["worked"] == 1:
-            worked = "Да"
-        elif r["worked"] == 0:
-            worked = "Нет"
-
-        ws.append([
-            r["full_name"],
-            r["phone"],
-            r["rating"],
-            "Основа" if r["member_type"] == "main" else "Резерв",
-            r["status"],
-            r["position"],
-            worked,
-            r["decline_reason"] or "",
-        ])
-
-    _autowidth(ws)
-
-    buf = io.BytesIO()
-    wb.save(buf)
-    buf.seek(0)
-    return buf
\ No newline at end of file
+    title = f"Смена #{shift_id} | {shift['city']} | {shift['date']} | {shift['address']}"
+    return await _export(f"Смена {shift_id}", title, 12, spool)
@@ -0,0 +1,76 @@
+"""
+Кэш Excel-выгрузок по Telegram file_id.
+Ключ — (тип отчёта, город/смена, версия данных). Пока данные не менялись, повторный
+запрос отправляет уже загруженный в Telegram файл по file_id — без запросов к базе,
+сборки книги и повторной загрузки. Храним только file_id (строки), число ключей
+ограничено, временные .xlsx удаляются сразу после загрузки.
+"""
+
+import asyncio
+import logging
+import os
+from typing import Awaitable, Callable
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import FSInputFile, Message
+
+from config import EXPORT_CACHE_SIZE, EXPORT_CACHE_TTL
+from utils.cache import TTLCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+_files = TTLCache(EXPORT_CACHE_SIZE, EXPORT_CACHE_TTL)
+# Lock сборки на ключ и число его владельцев/ожидающих: lock удаляется, только когда
+# их не осталось (разбуженный ожидающий ещё не взял lock, но уже в очереди)
+_building: dict[tuple, asyncio.Lock] = {}
+_users: dict[tuple, int] = {}
+
+
+async def _send_cached(message: Message, key: tuple, caption: str) -> bool:
+    file_id = _files.get(key)
+    if file_id is MISSING:
+        return False
+    try:
+        await message.answer_document(file_id, caption=caption)
+        return True
+    except TelegramBadRequest as e:
+        logger.warning(f"Выгрузка {key}: file_id устарел ({e})")
+        _files.invalidate(key)
+        return False
+
+
+async def send_export(
+    message: Message,
+    key: tuple,
+    build: Callable[[], Awaitable[str]],
+    filename: str,
+    caption: str,
+):
+    """
+    Отправить выгрузку в чат message. build() собирает .xlsx и возвращает путь —
+    вызывается, только если файла с такой версией данных ещё нет.
+    Параллельные запросы одного ключа (двойное нажатие) собирают файл один раз.
+    """
+    if await _send_cached(message, key, caption):
+        return
+
+    lock = _building.setdefault(key, asyncio.Lock())
+    _users[key] = _users.get(key, 0) + 1
+    try:
+        async with lock:
+            if await _send_cached(message, key, caption):
+                return
+
+            path = await build()
+            try:
+                sent = await message.answer_document(
+                    FSInputFile(path, filename=filename), caption=caption,
+                )
+            finally:
+                os.remove(path)
+            _files.set(key, sent.document.file_id)
+    finally:
+        _users[key] -= 1
+        if not _users[key]:
+            del _users[key]
+            del _building[key]
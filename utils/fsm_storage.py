@@ -0,0 +1,243 @@
+"""
+Хранилище FSM в базе вместо MemoryStorage.
+Анкета, создание смены и отчёт переживают перезапуск/деплой, брошенные диалоги
+удаляются по TTL. Подряд идущие set_state/update_data одного хендлера склеиваются
+в одну запись (FSM_FLUSH_DELAY), свежие состояния читаются из кэша процесса.
+"""
+
+import abc
+import asyncio
+import json
+import logging
+import time
+from typing import Any
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, StateType, StorageKey
+from aiogram.fsm.storage.memory import MemoryStorage
+
+from config import (
+    FSM_STORAGE, FSM_SQLITE_PATH, FSM_TTL, FSM_FLUSH_DELAY,
+    FSM_CACHE_TTL, FSM_CACHE_SIZE,
+)
+from database import fsm_load, fsm_save, fsm_purge, fsm_count
+from utils.cache import TTLCache, MISSING
+
+logger = logging.getLogger(__name__)
+
+# Как часто удалять истёкшие диалоги из базы
+PURGE_INTERVAL = 600
+
+Record = tuple[str | None, dict[str, Any]]
+
+
+def _key(key: StorageKey) -> str:
+    return f"{key.bot_id}:{key.chat_id}:{key.user_id}:{key.thread_id or ''}:{key.destiny}"
+
+
+def _state_name(state: StateType) -> str | None:
+    return state.state if isinstance(state, State) else state
+
+
+class CoalescingStorage(BaseStorage, abc.ABC):
+    """
+    Общая часть: изменения копятся в _pending и пишутся пачкой после паузы,
+    чтение — _pending → кэш → база. Наследник реализует _load/_save/_purge/_count.
+    """
+
+    def __init__(self):
+        self._pending: dict[str, Record] = {}
+        self._cache = TTLCache(FSM_CACHE_SIZE, FSM_CACHE_TTL)
+        self._flush_task: asyncio.Task | None = None
+        self._last_purge = 0.0
+        self._stored: int | None = None
+
+    @abc.abstractmethod
+    async def _load(self, key: str) -> Record | None:
+        ...
+
+    @abc.abstractmethod
+    async def _save(self, records: dict[str, Record]):
+        ...
+
+    @abc.abstractmethod
+    async def _purge(self) -> int:
+        ...
+
+    @abc.abstractmethod
+    async def _count(self) -> int:
+        ...
+
+    def sizes(self) -> dict[str, int]:
+        """Для метрик: ждут записи, в кэше, в хранилище (на момент последней очистки)."""
+        sizes = {"pending": len(self._pending), "cached": len(self._cache)}
+        if self._stored is not None:
+            sizes["stored"] = self._stored
+        return sizes
+
+    async def _record(self, key: str) -> Record:
+        if key in self._pending:
+            return self._pending[key]
+        record = self._cache.get(key)
+        if record is MISSING:
+            stamp = self._cache.stamp()
+            record = await self._load(key) or (None, {})
+            self._cache.set(key, record, stamp)
+        return record
+
+    def _put(self, key: str, record: Record):
+        self._pending[key] = record
+        self._cache.set(key, record)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(FSM_FLUSH_DELAY)
+        await self.flush()
+
+    async def flush(self):
+        batch, self._pending = self._pending, {}
+        if batch:
+            try:
+                await self._save(batch)
+            except Exception as e:
+                logger.error(f"FSM: запись {len(batch)} состояний: {e}")
+                # Не теряем изменения — вернём в очередь, новые поверх старых
+                self._pending = {**batch, **self._pending}
+                self._flush_task = asyncio.create_task(self._flush_later())
+                return
+
+        if time.monotonic() - self._last_purge > PURGE_INTERVAL:
+            self._last_purge = time.monotonic()
+            try:
+                purged = await self._purge()
+                if purged:
+                    logger.info(f"FSM: удалено {purged} брошенных диалогов")
+                self._stored = await self._count()
+            except Exception as e:
+                logger.warning(f"FSM: очистка: {e}")
+
+        # Записи, пришедшие пока шёл _save/_purge, _put не запланировал: задача
+        # записи ещё не завершилась (это мы сами) — ставим следующую пачку здесь
+        if self._pending and (
+            self._flush_task is None
+            or self._flush_task.done()
+            or self._flush_task is asyncio.current_task()
+        ):
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        k = _key(key)
+        _, data = await self._record(k)
+        self._put(k, (_state_name(state), data))
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        return (await self._record(_key(key)))[0]
+
+    async def set_data(self, key: StorageKey, data: dict[str, Any]) -> None:
+        k = _key(key)
+        state, _ = await self._record(k)
+        self._put(k, (state, dict(data)))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        return dict((await self._record(_key(key)))[1])
+
+    async def close(self) -> None:
+        # Дожидаемся отложенной записи, а не отменяем её — иначе пачка потеряется
+        if self._flush_task and not self._flush_task.done():
+            await self._flush_task
+        await self.flush()
+
+
+class PostgresStorage(CoalescingStorage):
+    """Таблица fsm_storage в основной базе — общая для нескольких процессов бота."""
+
+    async def _load(self, key: str) -> Record | None:
+        return await fsm_load(key, FSM_TTL)
+
+    async def _save(self, records: dict[str, Record]):
+        await fsm_save(records)
+
+    async def _purge(self) -> int:
+        return await fsm_purge(FSM_TTL)
+
+    async def _count(self) -> int:
+        return await fsm_count()
+
+
+class SqliteStorage(CoalescingStorage):
+    """Локальный файл SQLite — для небольших установок с одним процессом."""
+
+    def __init__(self, path: str):
+        super().__init__()
+        self.path = path
+        self._db = None
+
+    async def _conn(self):
+        if self._db is None:
+            import aiosqlite
+            self._db = await aiosqlite.connect(self.path)
+            await self._db.execute(
+                """CREATE TABLE IF NOT EXISTS fsm_storage (
+                       key TEXT PRIMARY KEY,
+                       state TEXT,
+                       data TEXT NOT NULL DEFAULT '{}',
+                       updated_at REAL NOT NULL
+                   )"""
+            )
+            await self._db.commit()
+        return self._db
+
+    async def _load(self, key: str) -> Record | None:
+        db = await self._conn()
+        async with db.execute(
+            "SELECT state, data FROM fsm_storage WHERE key = ? AND updated_at > ?",
+            (key, time.time() - FSM_TTL),
+        ) as cursor:
+            row = await cursor.fetchone()
+        return (row[0], json.loads(row[1])) if row else None
+
+    async def _save(self, records: dict[str, Record]):
+        db = await self._conn()
+        now = time.time()
+        keep = [
+            (k, state, json.dumps(data, ensure_ascii=False), now)
+            for k, (state, data) in records.items() if state is not None or data
+        ]
+        drop = [(k,) for k, (state, data) in records.items() if state is None and not data]
+        await db.executemany(
+            """INSERT INTO fsm_storage (key, state, data, updated_at) VALUES (?, ?, ?, ?)
+               ON CONFLICT (key) DO UPDATE SET
+                   state = excluded.state, data = excluded.data, updated_at = excluded.updated_at""",
+            keep,
+        )
+        await db.executemany("DELETE FROM fsm_storage WHERE key = ?", drop)
+        await db.commit()
+
+    async def _purge(self) -> int:
+        db = await self._conn()
+        cursor = await db.execute(
+            "DELETE FROM fsm_storage WHERE updated_at < ?", (time.time() - FSM_TTL,)
+        )
+        await db.commit()
+        return cursor.rowcount
+
+    async def _count(self) -> int:
+        db = await self._conn()
+        async with db.execute("SELECT COUNT(*) FROM fsm_storage") as cursor:
+            return (await cursor.fetchone())[0]
+
+    async def close(self) -> None:
+        await super().close()
+        if self._db is not None:
+            await self._db.close()
+            self._db = None
+
+
+def make_storage() -> BaseStorage:
+    """Хранилище по FSM_STORAGE; postgres требует уже выполненного init_db()."""
+    if FSM_STORAGE == "memory":
+        return MemoryStorage()
+    if FSM_STORAGE == "sqlite":
+        return SqliteStorage(FSM_SQLITE_PATH)
+    return PostgresStorage()
@@ -0,0 +1,50 @@
+"""
+Гистограмма с фиксированными корзинами (секунды) — для времени запросов к базе,
+хендлеров и задач планировщика. Памяти — несколько чисел на гистограмму,
+квантили оцениваются по верхней границе корзины.
+"""
+
+import bisect
+
+# От 0.5 мс до 10 с
+DEFAULT_BUCKETS = (
+    0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+)
+
+
+class Histogram:
+    def __init__(self, buckets: tuple[float, ...] = DEFAULT_BUCKETS):
+        self.buckets = buckets
+        # Последняя корзина — всё, что больше buckets[-1]
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q: float) -> float:
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i, n in enumerate(self.counts):
+            seen += n
+            if seen >= rank:
+                return min(self.buckets[i], self.max) if i < len(self.buckets) else self.max
+        return self.max
+
+    def cumulative(self) -> list[tuple[float, int]]:
+        """(верхняя граница, число наблюдений ≤ неё) — для формата Prometheus."""
+        result, seen = [], 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            result.append((bound, seen))
+        result.append((float("inf"), self.count))
+        return result
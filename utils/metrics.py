@@ -0,0 +1,343 @@
+"""
+Метрики процесса бота в текстовом формате Prometheus (GET METRICS_PATH).
+• хендлеры: задержка и ошибки по префиксу callback / команде / состоянию FSM,
+  число обновлений (updates/s — rate() в Prometheus)
+• планировщик: длительность задач и отставание от запланированного момента
+• Telegram: запросы по методам, ошибки, 429
+• база: занятость пула, время запросов по именам (utils/db_stats.py)
+• FSM: несохранённые, закэшированные и хранимые состояния
+В режиме webhook метрики отдаёт тот же aiohttp-сервер, в polling — свой на METRICS_PORT.
+"""
+
+import abc
+import hmac
+import logging
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Any, Awaitable, Callable
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramAPIError, TelegramRetryAfter
+from aiogram.types import Update
+
+from config import METRICS_HOST, METRICS_PORT, METRICS_PATH, METRICS_TOKEN
+from database import pool_stats
+from utils import db_stats
+from utils.histogram import Histogram, DEFAULT_BUCKETS
+
+logger = logging.getLogger(__name__)
+
+# Отставание планировщика — от долей секунды до часа (MISFIRE_GRACE)
+LAG_BUCKETS = (0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0, 900.0, 3600.0)
+
+
+# ─── Типы метрик ──────────────────────────────────────────────────────────────
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _labels(names: tuple[str, ...], values: tuple, extra: str = "") -> str:
+    pairs = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _histogram_lines(name: str, labels: str, hist: Histogram) -> list[str]:
+    inner = labels[1:-1] if labels else ""
+    lines = []
+    for bound, count in hist.cumulative():
+        le = "+Inf" if bound == float("inf") else repr(bound)
+        le_label = f'le="{le}"'
+        lines.append(f"{name}_bucket{{{inner + ',' if inner else ''}{le_label}}} {count}")
+    lines.append(f"{name}_sum{labels} {hist.sum}")
+    lines.append(f"{name}_count{labels} {hist.count}")
+    return lines
+
+
+class _Metric(abc.ABC):
+    kind = ""
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        _registry.append(self)
+
+    def header(self) -> list[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+    @abc.abstractmethod
+    def lines(self) -> list[str]:
+        ...
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labels: tuple[str, ...] = ()):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+
+    def inc(self, *labels, amount: float = 1):
+        self._values[labels] = self._values.get(labels, 0) + amount
+
+    def lines(self) -> list[str]:
+        return [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение задаётся set() или читается в момент выгрузки из collect()."""
+    kind = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        collect: Callable[[], dict[tuple, float]] | None = None,
+    ):
+        super().__init__(name, help, labels)
+        self._values: dict[tuple, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, *labels):
+        self._values[labels] = value
+
+    def collect_from(self, collect: Callable[[], dict[tuple, float]]):
+        self._collect = collect
+
+    def lines(self) -> list[str]:
+        values = self._values
+        if self._collect:
+            try:
+                values = self._collect()
+            except Exception as e:
+                logger.warning(f"Метрика {self.name}: {e}")
+                return []
+        return [f"{self.name}{_labels(self.labels, k)} {v}" for k, v in values.items()]
+
+
+class HistogramMetric(_Metric):
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        help: str,
+        labels: tuple[str, ...] = (),
+        buckets: tuple[float, ...] = DEFAULT_BUCKETS,
+        collect: Callable[[], dict[tuple, Histogram]] | None = None,
+    ):
+        super().__init__(name, help, labels)
+        self.buckets = buckets
+        self._values: dict[tuple, Histogram] = {}
+        self._collect = collect
+
+    def observe(self, value: float, *labels):
+        hist = self._values.get(labels)
+        if hist is None:
+            hist = self._values[labels] = Histogram(self.buckets)
+        hist.observe(value)
+
+    def lines(self) -> list[str]:
+        values = self._collect() if self._collect else self._values
+        result = []
+        for k, hist in values.items():
+            result += _histogram_lines(self.name, _labels(self.labels, k), hist)
+        return result
+
+
+_registry: list[_Metric] = []
+
+
+def render() -> str:
+    out = []
+    for metric in _registry:
+        lines = metric.lines()
+        if lines:
+            out += metric.header() + lines
+    return "\n".join(out) + "\n"
+
+
+# ─── Метрики ──────────────────────────────────────────────────────────────────
+
+UPDATES = Counter("bot_updates_total", "Обработанные обновления", ("type",))
+HANDLER_SECONDS = HistogramMetric(
+    "bot_handler_seconds", "Время обработки обновления", ("handler",),
+)
+HANDLER_ERRORS = Counter("bot_handler_errors_total", "Исключения в хендлерах", ("handler",))
+
+SCHEDULER_JOB_SECONDS = HistogramMetric(
+    "bot_scheduler_job_seconds", "Длительность задачи планировщика", ("kind",),
+)
+SCHEDULER_LAG_SECONDS = HistogramMetric(
+    "bot_scheduler_lag_seconds", "Отставание запуска от запланированного момента",
+    ("kind",), buckets=LAG_BUCKETS,
+)
+
+TELEGRAM_REQUESTS = Counter("bot_telegram_requests_total", "Запросы к Bot API", ("method",))
+TELEGRAM_FAILURES = Counter(
+    "bot_telegram_failures_total", "Ошибки Bot API", ("method", "error"),
+)
+TELEGRAM_RETRY_AFTER = Counter(
+    "bot_telegram_retry_after_total", "Ответы 429 (RetryAfter)", ("method",),
+)
+TELEGRAM_SECONDS = HistogramMetric(
+    "bot_telegram_request_seconds", "Время запроса к Bot API", ("method",),
+)
+
+OUTBOX_DELAY = HistogramMetric(
+    "bot_outbox_delay_seconds", "Отправка относительно запланированного момента (напоминания)",
+    ("kind",), buckets=LAG_BUCKETS,
+)
+
+DB_POOL = Gauge(
+    "bot_db_pool_connections", "Соединения пула базы", ("state",),
+    collect=lambda: {
+        ("busy",): (p := pool_stats())["size"] - p["idle"],
+        ("idle",): p["idle"],
+        ("max",): p["max"],
+    },
+)
+DB_QUERY_WAIT = HistogramMetric(
+    "bot_db_query_wait_seconds", "Ожидание соединения пула", ("query",),
+    collect=lambda: {(name, ): s.wait for name, s in db_stats.stats().items()},
+)
+DB_QUERY_EXEC = HistogramMetric(
+    "bot_db_query_exec_seconds", "Время работы запроса с соединением", ("query",),
+    collect=lambda: {(name, ): s.exec for name, s in db_stats.stats().items()},
+)
+
+WEBHOOK_QUEUE = Gauge("bot_webhook_queue", "Обновления в очереди вебхука")
+
+_fsm_storage = None
+
+
+def watch_fsm(storage):
+    """Отдавать размеры хранилища FSM (если оно их умеет — см. CoalescingStorage.sizes)."""
+    global _fsm_storage
+    _fsm_storage = storage if hasattr(storage, "sizes") else None
+
+
+FSM_STATES = Gauge(
+    "bot_fsm_states", "Состояния FSM: pending — ждут записи, cached — в кэше, "
+    "stored — в хранилище (на момент последней очистки)", ("kind",),
+    collect=lambda: {
+        (kind,): n for kind, n in (_fsm_storage.sizes() if _fsm_storage else {}).items()
+    },
+)
+
+
+# ─── Middleware ───────────────────────────────────────────────────────────────
+
+def _handler_label(update: Update, data: dict[str, Any]) -> str:
+    """Метка с ограниченным числом значений: без id смен и пользователей."""
+    if update.callback_query and update.callback_query.data:
+        parts = []
+        for part in update.callback_query.data.split(":")[:2]:
+            if part.lstrip("-").isdigit():
+                break
+            parts.append(part)
+        return "callback:" + (":".join(parts) or "?")
+    if update.message:
+        text = update.message.text or ""
+        if text.startswith("/"):
+            return "command:" + text.split()[0].split("@")[0]
+        state = data.get("raw_state")
+        if state:
+            return "state:" + state
+        return "message"
+    return update.event_type
+
+
+class UpdateMetricsMiddleware(BaseMiddleware):
+    """Outer-middleware на dp.update: время и ошибки обработки каждого обновления."""
+
+    async def __call__(
+        self,
+        handler: Callable[[Update, dict[str, Any]], Awaitable[Any]],
+        event: Update,
+        data: dict[str, Any],
+    ) -> Any:
+        label = _handler_label(event, data)
+        UPDATES.inc(event.event_type)
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(label)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, label)
+
+
+class TelegramMetricsMiddleware(BaseRequestMiddleware):
+    """Middleware сессии бота: учитывает каждый вызов Bot API, откуда бы он ни шёл."""
+
+    async def __call__(self, make_request, bot, method):
+        name = type(method).__name__
+        TELEGRAM_REQUESTS.inc(name)
+        started = time.perf_counter()
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter:
+            TELEGRAM_RETRY_AFTER.inc(name)
+            TELEGRAM_FAILURES.inc(name, "TelegramRetryAfter")
+            raise
+        except TelegramAPIError as e:
+            TELEGRAM_FAILURES.inc(name, type(e).__name__)
+            raise
+        finally:
+            TELEGRAM_SECONDS.observe(time.perf_counter() - started, name)
+
+
+# ─── Планировщик ──────────────────────────────────────────────────────────────
+
+@contextmanager
+def job_timer(kind: str, when: datetime):
+    """Задача планировщика: отставание старта от when и длительность."""
+    SCHEDULER_LAG_SECONDS.observe(
+        max(0.0, (datetime.now(timezone.utc) - when).total_seconds()), kind,
+    )
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        SCHEDULER_JOB_SECONDS.observe(time.perf_counter() - started, kind)
+
+
+# ─── HTTP ─────────────────────────────────────────────────────────────────────
+
+async def metrics_handler(request: web.Request) -> web.Response:
+    if METRICS_TOKEN and not hmac.compare_digest(
+        request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"
+    ):
+        return web.Response(status=401)
+    return web.Response(text=render(), content_type="text/plain", charset="utf-8")
+
+
+class MetricsServer:
+    """Отдельный HTTP-сервер метрик для режима polling."""
+
+    def __init__(self):
+        self._runner: web.AppRunner | None = None
+
+    async def start(self):
+        if not METRICS_PORT:
+            return
+        app = web.Application()
+        app.router.add_get(METRICS_PATH, metrics_handler)
+        self._runner = web.AppRunner(app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, METRICS_HOST, METRICS_PORT).start()
+        logger.info(f"Метрики: {METRICS_HOST}:{METRICS_PORT}{METRICS_PATH}")
+
+    async def stop(self):
+        if self._runner:
+            await self._runner.cleanup()
+            self._runner = None
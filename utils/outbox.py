@@ -0,0 +1,197 @@
+"""
+Outbox исходящих сообщений.
+Напоминания, уведомления о снятии и переводе из резерва пишутся в таблицу outbox
+той же транзакцией, что и изменение состояния, — хендлер и планировщик не ждут
+Telegram. Диспетчер (в каждом процессе бота) забирает готовые пачками
+(FOR UPDATE SKIP LOCKED), отправляет через общий лимитер и отмечает итог:
+• отправлено — sent + отметки on_sent (время напоминания = фактическое время отправки);
+• RetryAfter — пауза лимитера, повтор без траты попытки;
+• сеть/5xx — повтор с экспоненциальной задержкой, после OUTBOX_MAX_ATTEMPTS — dead;
+• прочие ошибки API (бот заблокирован, чат не найден) — сразу dead.
+Очередь общая для всех смен и разбирается по сроку (deadline): если в одну минуту
+срабатывают напоминания многих смен, основа всех смен уходит раньше информации
+резерву, а темп задаёт общий лимитер Telegram. Для напоминаний запланированное
+время сравнивается с фактическим (метрика bot_outbox_delay_seconds).
+Доставка at-least-once: сообщение, отправленное перед падением процесса, но не
+отмеченное, уйдёт повторно после OUTBOX_LEASE. Дубли постановки отсекает key.
+"""
+
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from aiogram import Bot
+from aiogram.exceptions import (
+    TelegramAPIError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+    TelegramServerError,
+)
+from aiogram.types import InlineKeyboardMarkup
+
+from config import (
+    OUTBOX_BATCH, OUTBOX_POLL_INTERVAL, OUTBOX_MAX_ATTEMPTS,
+    OUTBOX_LEASE, OUTBOX_CONCURRENCY, OUTBOX_RETENTION,
+)
+from database import claim_outbox, complete_outbox, purge_outbox
+from utils.broadcast import limiter
+from utils.metrics import OUTBOX_DELAY
+from utils.timer_heap import schedule_ignore_check
+
+logger = logging.getLogger(__name__)
+
+BACKOFF_BASE = 2.0          # секунды, удваивается с каждой попыткой
+BACKOFF_MAX = 600.0
+PURGE_INTERVAL = 3600.0
+SHUTDOWN_TIMEOUT = 10.0     # сколько ждать текущую пачку при остановке
+
+
+def outbox_payload(text: str, reply_markup: InlineKeyboardMarkup | None = None) -> dict:
+    """Тело сообщения (HTML) — одно на всех получателей рассылки."""
+    payload = {"text": text, "parse_mode": "HTML"}
+    if reply_markup is not None:
+        payload["reply_markup"] = reply_markup.model_dump(mode="json", exclude_none=True)
+    return payload
+
+
+def outbox_message(
+    key: str,
+    chat_id: int,
+    text: str,
+    reply_markup: InlineKeyboardMarkup | None = None,
+    on_sent: dict | None = None,
+) -> dict:
+    """Сообщение для outbox (HTML). on_sent — см. database.complete_outbox."""
+    return {
+        "key": key, "chat_id": chat_id,
+        "payload": outbox_payload(text, reply_markup), "on_sent": on_sent,
+    }
+
+
+class OutboxDispatcher:
+    def __init__(self):
+        self.bot: Bot | None = None
+        self._wake = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task | None = None
+
+    def start(self, bot: Bot):
+        self.bot = bot
+        self._stopping = False
+        self._task = asyncio.create_task(self._run())
+
+    async def shutdown(self):
+        """Дождаться текущей пачки (чтобы не слать её повторно) и остановиться."""
+        if not self._task:
+            return
+        self._stopping = True
+        self._wake.set()
+        try:
+            await asyncio.wait_for(self._task, SHUTDOWN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning("Outbox: пачка не завершилась к остановке, досылка после lease")
+        except Exception:
+            pass
+        self._task = None
+
+    def wake(self):
+        """В очередь что-то положили в этом процессе — не ждать следующего опроса."""
+        self._wake.set()
+
+    async def _run(self):
+        last_purge = 0.0
+        while not self._stopping:
+            self._wake.clear()
+            handled = 0
+            try:
+                handled = await self.drain_once()
+                if time.monotonic() - last_purge > PURGE_INTERVAL:
+                    last_purge = time.monotonic()
+                    await purge_outbox(OUTBOX_RETENTION)
+            except Exception as e:
+                logger.error(f"Outbox: {e}")
+            if handled < OUTBOX_BATCH and not self._stopping:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), OUTBOX_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def drain_once(self) -> int:
+        """Одна пачка: забрать, отправить, отметить. Возвращает размер пачки."""
+        rows = await claim_outbox(OUTBOX_BATCH, OUTBOX_LEASE)
+        if not rows:
+            return 0
+
+        sent, retry, dead = [], [], []
+        sem = asyncio.Semaphore(OUTBOX_CONCURRENCY)
+
+        async def send(row: dict):
+            async with sem:
+                await self._send(row, sent, retry, dead)
+
+        await asyncio.gather(*(send(row) for row in rows))
+        self._observe_delays(rows, sent)
+
+        checks = await complete_outbox(sent, retry, dead)
+        for check in checks:
+            await schedule_ignore_check(check["kind"], check["shift_id"])
+
+        if retry or dead:
+            logger.info(
+                f"Outbox: отправлено {len(sent)}, повтор {len(retry)}, не доставлено {len(dead)}"
+            )
+        return len(rows)
+
+    @staticmethod
+    def _observe_delays(rows: list[dict], sent: list):
+        """Запланированное время против фактического — по напоминаниям пачки."""
+        sent_at = dict(sent)
+        delays = []
+        for row in rows:
+            if row["scheduled_at"] and row["id"] in sent_at:
+                delay = max(0.0, (sent_at[row["id"]] - row["scheduled_at"]).total_seconds())
+                OUTBOX_DELAY.observe(delay, row["dedup_key"].split(":")[0])
+                delays.append(delay)
+        if delays:
+            logger.info(
+                f"Outbox: напоминаний {len(delays)}, от плана "
+                f"{min(delays):.0f}–{max(delays):.0f} с"
+            )
+
+    async def _send(self, row: dict, sent: list, retry: list, dead: list):
+        payload = row["payload"]
+        markup = payload.get("reply_markup")
+        await limiter.acquire(row["chat_id"])
+        try:
+            await self.bot.send_message(
+                row["chat_id"],
+                payload["text"],
+                parse_mode=payload.get("parse_mode"),
+                reply_markup=InlineKeyboardMarkup.model_validate(markup) if markup else None,
+            )
+            sent.append((row["id"], datetime.now(timezone.utc)))
+        except TelegramRetryAfter as e:
+            limiter.pause(e.retry_after)
+            retry.append((row["id"], float(e.retry_after), False, str(e)))
+        except (TelegramNetworkError, TelegramServerError) as e:
+            self._backoff(row, e, retry, dead)
+        except TelegramAPIError as e:
+            logger.info(f"Outbox {row['id']}: не доставлено {row['chat_id']}: {e}")
+            dead.append((row["id"], str(e)))
+        except Exception as e:
+            logger.error(f"Outbox {row['id']} → {row['chat_id']}: {e}")
+            self._backoff(row, e, retry, dead)
+
+    @staticmethod
+    def _backoff(row: dict, error: Exception, retry: list, dead: list):
+        attempt = row["attempts"] + 1
+        if attempt >= OUTBOX_MAX_ATTEMPTS:
+            logger.warning(f"Outbox {row['id']} → {row['chat_id']}: попытки кончились ({error})")
+            dead.append((row["id"], str(error)))
+        else:
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** (attempt - 1)))
+            retry.append((row["id"], delay, True, str(error)))
+
+
+outbox = OutboxDispatcher()
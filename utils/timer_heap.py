@@ -0,0 +1,201 @@
+"""
+Куча таймеров планировщика.
+Каждое событие — (момент UTC, тип, id смены). Планировщик спит до ближайшего
+события, хендлеры добавляют события при создании смены и снимают при закрытии.
+Кучу держит только процесс-лидер (см. leader.py); остальные процессы пересылают
+ему события через schedule_* / unschedule_shift.
+"""
+
+import asyncio
+import heapq
+import itertools
+import json
+import logging
+from datetime import datetime, date, timedelta, timezone
+from typing import Awaitable, Callable
+
+from city_timezones import get_city_tz
+from config import SHIFT_COMPLETE_HOUR
+from utils.dates import parse_hhmm
+
+logger = logging.getLogger(__name__)
+
+EVENING_REMINDER = "evening_reminder"
+MORNING_REMINDER = "morning_reminder"
+EVENING_IGNORES = "evening_ignores"
+MORNING_IGNORES = "morning_ignores"
+SHIFT_COMPLETE = "shift_complete"
+SHIFT_SWEEP = "shift_sweep"
+
+EVENING_IGNORE_AFTER = timedelta(minutes=30)
+MORNING_IGNORE_AFTER = timedelta(minutes=10)
+IGNORE_CHECK_SLACK = timedelta(seconds=5)
+
+
+class TimerHeap:
+    def __init__(self):
+        self._heap: list[tuple[datetime, int, str, int]] = []
+        self._seq = itertools.count()
+        self._live: set[tuple[datetime, str, int]] = set()
+        self._wakeup = asyncio.Event()
+
+    def __len__(self) -> int:
+        return len(self._live)
+
+    def push(self, when: datetime, kind: str, shift_id: int):
+        key = (when, kind, shift_id)
+        if key in self._live:
+            return
+        self._live.add(key)
+        seq = next(self._seq)
+        heapq.heappush(self._heap, (when, seq, kind, shift_id))
+        if self._heap[0][1] == seq:
+            self._wakeup.set()
+
+    def cancel(self, shift_id: int, kinds: tuple[str, ...] | None = None):
+        """Снять события смены (ленивое удаление — записи в куче пропускаются при извлечении)."""
+        self._live = {
+            k for k in self._live
+            if not (k[2] == shift_id and (kinds is None or k[1] in kinds))
+        }
+        if len(self._heap) > 2 * len(self._live) + 64:
+            self._heap = [e for e in self._heap if (e[0], e[2], e[3]) in self._live]
+            heapq.heapify(self._heap)
+
+    def clear(self):
+        self._live.clear()
+        self._heap.clear()
+
+    def next_at(self) -> datetime | None:
+        while self._heap and (self._heap[0][0], self._heap[0][2], self._heap[0][3]) not in self._live:
+            heapq.heappop(self._heap)
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime) -> list[tuple[datetime, str, int]]:
+        """Все события с моментом <= now (включая пропущенные — misfire catch-up)."""
+        due = []
+        while self._heap and self._heap[0][0] <= now:
+            when, _, kind, shift_id = heapq.heappop(self._heap)
+            key = (when, kind, shift_id)
+            if key in self._live:
+                self._live.discard(key)
+                due.append(key)
+        return due
+
+    async def wait(self):
+        """Спать до ближайшего события или до добавления более раннего."""
+        self._wakeup.clear()
+        next_at = self.next_at()
+        timeout = None
+        if next_at is not None:
+            timeout = max(0.0, (next_at - datetime.now(timezone.utc)).total_seconds())
+        try:
+            await asyncio.wait_for(self._wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+
+
+timers = TimerHeap()
+
+
+# ─── Расчёт моментов срабатывания ────────────────────────────────────────────
+
+def next_local_occurrence(
+    city: str, hhmm: str | None, after: datetime, grace: timedelta = timedelta(0),
+) -> datetime | None:
+    """
+    Ближайший момент (UTC) местного времени hhmm в городе.
+    Если сегодняшний момент прошёл не более чем на grace — возвращаем его (догоняем пропуск).
+    """
+    at = parse_hhmm(hhmm)
+    if at is None:
+        return None
+    tz = get_city_tz(city)
+    local_day: date = after.astimezone(tz).date()
+    candidate = datetime.combine(local_day, at, tzinfo=tz)
+    if candidate < after - grace:
+        candidate = datetime.combine(local_day + timedelta(days=1), at, tzinfo=tz)
+    return candidate.astimezone(timezone.utc)
+
+
+def shift_complete_at(shift: dict) -> datetime | None:
+    """Автозавершение: следующий день после даты смены, SHIFT_COMPLETE_HOUR по местному."""
+    if not shift.get("starts_at"):
+        return None
+    return shift["starts_at"] + timedelta(days=1, hours=SHIFT_COMPLETE_HOUR)
+
+
+def arm_shift(shift: dict, now: datetime | None = None, grace: timedelta = timedelta(0)):
+    """
+    Поставить вечернее и утреннее напоминание смены в кучу.
+    Для смен с разобранной датой моменты уже посчитаны в базе (reminder_at /
+    morning_reminder_at); смены со старой текстовой датой — по ближайшему времени суток.
+    Завершение ставится всегда, даже давно прошедшее, — забытая смена закроется сразу.
+    """
+    now = now or datetime.now(timezone.utc)
+    if shift.get("shift_date"):
+        for kind, field in ((EVENING_REMINDER, "reminder_at"), (MORNING_REMINDER, "morning_reminder_at")):
+            at = shift.get(field)
+            if at and at >= now - grace:
+                timers.push(at, kind, shift["id"])
+        complete_at = shift_complete_at(shift)
+        if complete_at:
+            timers.push(complete_at, SHIFT_COMPLETE, shift["id"])
+        return
+
+    evening = next_local_occurrence(shift["city"], shift.get("reminder_time"), now, grace)
+    if evening:
+        timers.push(evening, EVENING_REMINDER, shift["id"])
+    morning = next_local_occurrence(shift["city"], shift.get("morning_reminder_time"), now, grace)
+    if morning:
+        timers.push(morning, MORNING_REMINDER, shift["id"])
+
+
+def arm_ignore_check(kind: str, shift_id: int, sent_at: datetime | None = None):
+    """Проверка игнора через 30 (вечер) / 10 (утро) минут после отправки напоминания."""
+    sent_at = sent_at or datetime.now(timezone.utc)
+    delay = EVENING_IGNORE_AFTER if kind == EVENING_IGNORES else MORNING_IGNORE_AFTER
+    timers.push(sent_at + delay + IGNORE_CHECK_SLACK, kind, shift_id)
+
+
+def disarm_shift(shift_id: int):
+    timers.cancel(shift_id)
+
+
+# ─── Вызовы из хендлеров ─────────────────────────────────────────────────────
+
+# None — планировщик работает в этом процессе, событие идёт прямо в кучу;
+# иначе — функция, отправляющая событие лидеру
+_publish: Callable[[str], Awaitable] | None = None
+
+
+def set_publisher(publish: Callable[[str], Awaitable] | None):
+    global _publish
+    _publish = publish
+
+
+async def _announce(event: dict) -> bool:
+    if _publish is None:
+        return False
+    try:
+        await _publish(json.dumps(event))
+    except Exception as e:
+        logger.error(f"Событие планировщика {event}: {e}")
+    return True
+
+
+async def schedule_shift(shift: dict):
+    if not await _announce({"op": "arm", "shift_id": shift["id"]}):
+        arm_shift(shift)
+
+
+async def unschedule_shift(shift_id: int):
+    if not await _announce({"op": "disarm", "shift_id": shift_id}):
+        disarm_shift(shift_id)
+
+
+async def schedule_ignore_check(kind: str, shift_id: int):
+    sent_at = datetime.now(timezone.utc)
+    event = {"op": "ignores", "kind": kind, "shift_id": shift_id, "sent_at": sent_at.isoformat()}
+    if not await _announce(event):
+        arm_ignore_check(kind, shift_id, sent_at)
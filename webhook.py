@@ -0,0 +1,123 @@
+"""
+Приём обновлений через вебхук (BOT_MODE=webhook).
+Telegram POST-ит обновление → проверяем секрет и update_id → кладём в очередь
+и сразу отвечаем 200. Обработчики (WEBHOOK_WORKERS) разбирают очередь параллельно.
+Пока бот перезапускается, Telegram копит обновления у себя и дошлёт их после старта.
+"""
+
+import asyncio
+import hmac
+import logging
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+
+from config import (
+    WEBHOOK_URL, WEBHOOK_PATH, WEBHOOK_SECRET, WEBHOOK_HOST, WEBHOOK_PORT,
+    WEBHOOK_QUEUE_SIZE, WEBHOOK_WORKERS, METRICS_PATH,
+)
+from utils.cache import TTLCache, MISSING
+from utils.metrics import WEBHOOK_QUEUE, metrics_handler
+
+logger = logging.getLogger(__name__)
+
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+# Сколько последних update_id помнить для отсева повторных доставок
+SEEN_UPDATES = 10_000
+SEEN_TTL = 3600
+
+# Сколько ждать разбора очереди при остановке
+DRAIN_TIMEOUT = 10
+
+
+class WebhookServer:
+    def __init__(self, bot: Bot, dp: Dispatcher):
+        self.bot = bot
+        self.dp = dp
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=WEBHOOK_QUEUE_SIZE)
+        self._seen = TTLCache(SEEN_UPDATES, SEEN_TTL)
+        self._workers: list[asyncio.Task] = []
+        self._runner: web.AppRunner | None = None
+
+        self.app = web.Application()
+        self.app.router.add_post(WEBHOOK_PATH, self.handle)
+        self.app.router.add_get("/", self.health)
+        self.app.router.add_get(METRICS_PATH, metrics_handler)
+        WEBHOOK_QUEUE.collect_from(lambda: {(): self.queue.qsize()})
+
+    async def health(self, request: web.Request) -> web.Response:
+        return web.json_response({"ok": True, "queued": self.queue.qsize()})
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if WEBHOOK_SECRET and not hmac.compare_digest(
+            request.headers.get(SECRET_HEADER, ""), WEBHOOK_SECRET
+        ):
+            return web.Response(status=401)
+
+        try:
+            update = await request.json()
+            update_id = int(update["update_id"])
+        except (ValueError, KeyError, TypeError):
+            return web.Response(status=400)
+
+        if self._seen.get(update_id) is not MISSING:
+            return web.Response()  # повторная доставка — уже в работе
+
+        try:
+            self.queue.put_nowait(update)
+        except asyncio.QueueFull:
+            # Не подтверждаем — Telegram повторит доставку позже
+            logger.warning(f"Вебхук: очередь заполнена, update {update_id} отложен")
+            return web.Response(status=503)
+
+        self._seen.set(update_id, True)
+        return web.Response()
+
+    async def _worker(self):
+        while True:
+            update = await self.queue.get()
+            try:
+                await self.dp.feed_raw_update(self.bot, update)
+            except Exception as e:
+                logger.error(f"Вебхук: update {update.get('update_id')}: {e}")
+            finally:
+                self.queue.task_done()
+
+    async def start(self):
+        await self.dp.emit_startup(bot=self.bot)
+        self._workers = [asyncio.create_task(self._worker()) for _ in range(WEBHOOK_WORKERS)]
+
+        self._runner = web.AppRunner(self.app)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+
+        await self.bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=self.dp.resolve_used_update_types(),
+            max_connections=WEBHOOK_WORKERS,
+        )
+        logger.info(f"Вебхук: слушаем {WEBHOOK_HOST}:{WEBHOOK_PORT}{WEBHOOK_PATH}")
+
+    async def stop(self):
+        # Сначала перестаём принимать, потом дорабатываем то, что уже в очереди.
+        # Вебхук не снимаем — пока бот лежит, Telegram копит обновления.
+        if self._runner:
+            await self._runner.cleanup()
+        try:
+            await asyncio.wait_for(self.queue.join(), DRAIN_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.warning(f"Вебхук: не разобрано {self.queue.qsize()} обновлений")
+        for task in self._workers:
+            task.cancel()
+        await self.dp.emit_shutdown(bot=self.bot)
+
+
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    server = WebhookServer(bot, dp)
+    await server.start()
+    try:
+        await asyncio.Event().wait()
+    finally:
+        await server.stop()